@@ -1,4 +1,5 @@
 import asyncio
+import os
 from logging.config import fileConfig
 
 from sqlalchemy import pool
@@ -15,6 +16,11 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
+# Migrate the database the application is configured with, sqlalchemy.url is the default for
+# development. ConfigParser interpolates %, which URL-encoded passwords may contain.
+if database_url := os.getenv("DATABASE_URL"):
+    config.set_main_option("sqlalchemy.url", database_url.replace("%", "%%"))
+
 # add your model's MetaData object here
 # for 'autogenerate' support
 from advanced_alchemy.base import orm_registry
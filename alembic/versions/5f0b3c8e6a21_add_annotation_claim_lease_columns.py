@@ -0,0 +1,45 @@
+"""Add claim lease columns to annotations
+
+Revision ID: 5f0b3c8e6a21
+Revises: c4e1a7d2b9f3
+Create Date: 2026-10-17 11:03:27.540193
+
+"""
+
+from collections.abc import Sequence
+
+import advanced_alchemy
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5f0b3c8e6a21"
+down_revision: str | None = "c4e1a7d2b9f3"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # batch mode since SQLite cannot add a foreign key constraint with ALTER TABLE
+    with op.batch_alter_table("annotations") as batch_op:
+        batch_op.add_column(
+            sa.Column("claimed_by", advanced_alchemy.types.GUID(length=16), nullable=True)
+        )
+        batch_op.add_column(
+            sa.Column(
+                "lease_expires_at",
+                advanced_alchemy.types.DateTimeUTC(timezone=True),
+                nullable=True,
+            )
+        )
+        batch_op.create_foreign_key(
+            op.f("fk_annotations_claimed_by_users"), "users", ["claimed_by"], ["id"]
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("annotations") as batch_op:
+        batch_op.drop_constraint(op.f("fk_annotations_claimed_by_users"), type_="foreignkey")
+        batch_op.drop_column("lease_expires_at")
+        batch_op.drop_column("claimed_by")
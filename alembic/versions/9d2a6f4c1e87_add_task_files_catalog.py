@@ -0,0 +1,51 @@
+"""Add task_files catalog
+
+Revision ID: 9d2a6f4c1e87
+Revises: 5f0b3c8e6a21
+Create Date: 2026-10-17 15:20:08.913472
+
+"""
+
+from collections.abc import Sequence
+
+import advanced_alchemy
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9d2a6f4c1e87"
+down_revision: str | None = "5f0b3c8e6a21"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "task_files",
+        sa.Column("task_id", advanced_alchemy.types.GUID(length=16), nullable=False),
+        sa.Column("path", sa.String(), nullable=False),
+        sa.Column("size", sa.BigInteger(), nullable=False),
+        sa.Column("mtime_ns", sa.BigInteger(), nullable=False),
+        sa.Column("extension", sa.String(), nullable=False),
+        sa.Column("id", sa.BigInteger().with_variant(sa.Integer(), "sqlite"), nullable=False),
+        sa.Column("created_at", advanced_alchemy.types.DateTimeUTC(timezone=True), nullable=False),
+        sa.Column("updated_at", advanced_alchemy.types.DateTimeUTC(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["task_id"], ["tasks.id"], name=op.f("fk_task_files_task_id_tasks"), ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_task_files")),
+        sa.UniqueConstraint("task_id", "path", name=op.f("uq_task_files_task_id")),
+        comment="Catalog of the image files in each task's root folder",
+    )
+    op.add_column("tasks", sa.Column("root_folder_mtime_ns", sa.BigInteger(), nullable=True))
+    op.create_index(
+        "ix_annotations_task_id_filepath", "annotations", ["task_id", "filepath"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_annotations_task_id_filepath", table_name="annotations")
+    with op.batch_alter_table("tasks") as batch_op:
+        batch_op.drop_column("root_folder_mtime_ns")
+    op.drop_table("task_files")
@@ -0,0 +1,30 @@
+"""Add composite index for delta exports of annotations
+
+Revision ID: a7f3d9e2c5b8
+Revises: e3b5c7a9d1f2
+Create Date: 2026-10-17 23:41:17.582903
+
+"""
+
+from collections.abc import Sequence
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "a7f3d9e2c5b8"
+down_revision: str | None = "e3b5c7a9d1f2"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_annotations_task_id_updated_at_id",
+        "annotations",
+        ["task_id", "updated_at", "id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_annotations_task_id_updated_at_id", table_name="annotations")
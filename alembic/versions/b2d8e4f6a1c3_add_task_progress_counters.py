@@ -0,0 +1,114 @@
+"""Add task progress counters maintained by annotation triggers
+
+Revision ID: b2d8e4f6a1c3
+Revises: a7f3d9e2c5b8
+Create Date: 2026-10-18 10:12:44.301958
+
+"""
+
+from collections.abc import Sequence
+
+import advanced_alchemy
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b2d8e4f6a1c3"
+down_revision: str | None = "a7f3d9e2c5b8"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+# The SQLite triggers as this revision created them, copied so later edits to the schema's
+# triggers leave this migration unchanged. An annotation is counted out of its old task and
+# labeler and into its new ones; labeled is stored as 0 or 1.
+_COUNT_ANNOTATION_IN = """
+    UPDATE tasks SET total_count = total_count + 1, labeled_count = labeled_count + NEW.labeled
+    WHERE id = NEW.task_id;
+    INSERT INTO task_user_progress (task_id, user_id, labeled_count)
+    SELECT NEW.task_id, NEW.labeled_by, 1 WHERE NEW.labeled AND NEW.labeled_by IS NOT NULL
+    ON CONFLICT (task_id, user_id) DO UPDATE SET labeled_count = labeled_count + 1;
+"""
+_COUNT_ANNOTATION_OUT = """
+    UPDATE tasks SET total_count = total_count - 1, labeled_count = labeled_count - OLD.labeled
+    WHERE id = OLD.task_id;
+    UPDATE task_user_progress SET labeled_count = labeled_count - 1
+    WHERE OLD.labeled AND task_id = OLD.task_id AND user_id = OLD.labeled_by;
+"""
+# By trigger name
+ANNOTATION_PROGRESS_TRIGGERS = {
+    "annotations_progress_insert": f"""
+    CREATE TRIGGER annotations_progress_insert AFTER INSERT ON annotations
+    BEGIN {_COUNT_ANNOTATION_IN} END
+    """,
+    "annotations_progress_delete": f"""
+    CREATE TRIGGER annotations_progress_delete AFTER DELETE ON annotations
+    BEGIN {_COUNT_ANNOTATION_OUT} END
+    """,
+    "annotations_progress_update": f"""
+    CREATE TRIGGER annotations_progress_update AFTER UPDATE OF labeled, labeled_by, task_id
+    ON annotations
+    WHEN OLD.labeled IS NOT NEW.labeled
+        OR OLD.labeled_by IS NOT NEW.labeled_by
+        OR OLD.task_id IS NOT NEW.task_id
+    BEGIN {_COUNT_ANNOTATION_OUT} {_COUNT_ANNOTATION_IN} END
+    """,
+}
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tasks", sa.Column("labeled_count", sa.Integer(), server_default="0", nullable=False)
+    )
+    op.add_column(
+        "tasks", sa.Column("total_count", sa.Integer(), server_default="0", nullable=False)
+    )
+    op.create_table(
+        "task_user_progress",
+        sa.Column("task_id", advanced_alchemy.types.GUID(length=16), nullable=False),
+        sa.Column("user_id", advanced_alchemy.types.GUID(length=16), nullable=False),
+        sa.Column("labeled_count", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["task_id"],
+            ["tasks.id"],
+            name=op.f("fk_task_user_progress_task_id_tasks"),
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["user_id"],
+            ["users.id"],
+            name=op.f("fk_task_user_progress_user_id_users"),
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("task_id", "user_id", name=op.f("pk_task_user_progress")),
+    )
+    # Counters of existing tasks, from before the triggers
+    op.execute(
+        """
+        UPDATE tasks SET
+            total_count = (SELECT count(*) FROM annotations WHERE task_id = tasks.id),
+            labeled_count = (SELECT count(*) FROM annotations WHERE task_id = tasks.id AND labeled)
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO task_user_progress (task_id, user_id, labeled_count)
+        SELECT task_id, labeled_by, count(*) FROM annotations
+        WHERE labeled AND labeled_by IS NOT NULL
+        GROUP BY task_id, labeled_by
+        """
+    )
+    # PostgreSQL's triggers are created by d9f1b3a5c7e2
+    if op.get_bind().dialect.name == "sqlite":
+        for trigger in ANNOTATION_PROGRESS_TRIGGERS.values():
+            op.execute(trigger)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == "sqlite":
+        for name in ANNOTATION_PROGRESS_TRIGGERS:
+            op.execute(f"DROP TRIGGER IF EXISTS {name}")
+    op.drop_table("task_user_progress")
+    with op.batch_alter_table("tasks") as batch_op:
+        batch_op.drop_column("total_count")
+        batch_op.drop_column("labeled_count")
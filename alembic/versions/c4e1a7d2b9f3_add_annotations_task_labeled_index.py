@@ -0,0 +1,30 @@
+"""Add composite index for next unlabeled annotation lookups
+
+Revision ID: c4e1a7d2b9f3
+Revises: 80064de40646
+Create Date: 2026-10-17 09:12:41.208214
+
+"""
+
+from collections.abc import Sequence
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c4e1a7d2b9f3"
+down_revision: str | None = "80064de40646"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_annotations_task_id_labeled_id",
+        "annotations",
+        ["task_id", "labeled", "id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_annotations_task_id_labeled_id", table_name="annotations")
@@ -0,0 +1,111 @@
+"""Add the progress triggers of a PostgreSQL database
+
+Revision ID: d9f1b3a5c7e2
+Revises: b2d8e4f6a1c3
+Create Date: 2026-10-18 14:37:09.518302
+
+"""
+
+from collections.abc import Sequence
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d9f1b3a5c7e2"
+down_revision: str | None = "b2d8e4f6a1c3"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+# The PostgreSQL triggers as this revision created them, copied so later edits to the schema's
+# triggers leave this migration unchanged. They fire once per statement and count the rows it
+# changed from its transition tables; rows counted out carry a sign of -1.
+_COUNT_ANNOTATION_CHANGES = """
+    CREATE OR REPLACE FUNCTION {name}() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        WITH changes AS ({changes}),
+        task_deltas AS (
+            SELECT task_id, sum(sign) AS total, sum(sign * labeled::int) AS labeled
+            FROM changes GROUP BY task_id
+        ),
+        updated_tasks AS (
+            UPDATE tasks SET
+                total_count = total_count + task_deltas.total,
+                labeled_count = labeled_count + task_deltas.labeled
+            FROM task_deltas WHERE tasks.id = task_deltas.task_id
+        )
+        INSERT INTO task_user_progress (task_id, user_id, labeled_count)
+        SELECT changes.task_id, changes.labeled_by, sum(changes.sign)
+        FROM changes JOIN tasks ON tasks.id = changes.task_id
+        WHERE changes.labeled AND changes.labeled_by IS NOT NULL
+        GROUP BY changes.task_id, changes.labeled_by
+        ON CONFLICT (task_id, user_id) DO UPDATE
+        SET labeled_count = task_user_progress.labeled_count + EXCLUDED.labeled_count;
+        RETURN NULL;
+    END $$
+"""
+_UPDATED_ANNOTATIONS = """
+    FROM old_annotations old_row
+    JOIN new_annotations new_row ON new_row.id = old_row.id
+    WHERE old_row.labeled IS DISTINCT FROM new_row.labeled
+        OR old_row.labeled_by IS DISTINCT FROM new_row.labeled_by
+        OR old_row.task_id IS DISTINCT FROM new_row.task_id
+"""
+# By trigger name, its function and then the trigger, each function being named after its trigger
+ANNOTATION_PROGRESS_TRIGGERS_POSTGRESQL = {
+    "annotations_progress_insert": (
+        _COUNT_ANNOTATION_CHANGES.format(
+            name="annotations_progress_insert",
+            changes="SELECT task_id, labeled_by, labeled, 1 AS sign FROM new_annotations",
+        ),
+        """
+        CREATE TRIGGER annotations_progress_insert AFTER INSERT ON annotations
+        REFERENCING NEW TABLE AS new_annotations
+        FOR EACH STATEMENT EXECUTE FUNCTION annotations_progress_insert()
+        """,
+    ),
+    "annotations_progress_delete": (
+        _COUNT_ANNOTATION_CHANGES.format(
+            name="annotations_progress_delete",
+            changes="SELECT task_id, labeled_by, labeled, -1 AS sign FROM old_annotations",
+        ),
+        """
+        CREATE TRIGGER annotations_progress_delete AFTER DELETE ON annotations
+        REFERENCING OLD TABLE AS old_annotations
+        FOR EACH STATEMENT EXECUTE FUNCTION annotations_progress_delete()
+        """,
+    ),
+    "annotations_progress_update": (
+        _COUNT_ANNOTATION_CHANGES.format(
+            name="annotations_progress_update",
+            changes=f"""
+                SELECT old_row.task_id, old_row.labeled_by, old_row.labeled, -1 AS sign
+                {_UPDATED_ANNOTATIONS}
+                UNION ALL
+                SELECT new_row.task_id, new_row.labeled_by, new_row.labeled, 1 AS sign
+                {_UPDATED_ANNOTATIONS}
+            """,
+        ),
+        # Transition tables rule out an UPDATE OF column list, unchanged rows are filtered out
+        """
+        CREATE TRIGGER annotations_progress_update AFTER UPDATE ON annotations
+        REFERENCING OLD TABLE AS old_annotations NEW TABLE AS new_annotations
+        FOR EACH STATEMENT EXECUTE FUNCTION annotations_progress_update()
+        """,
+    ),
+}
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    for function, trigger in ANNOTATION_PROGRESS_TRIGGERS_POSTGRESQL.values():
+        op.execute(function)
+        op.execute(trigger)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    for name in ANNOTATION_PROGRESS_TRIGGERS_POSTGRESQL:
+        op.execute(f"DROP TRIGGER IF EXISTS {name} ON annotations")
+        op.execute(f"DROP FUNCTION IF EXISTS {name}()")
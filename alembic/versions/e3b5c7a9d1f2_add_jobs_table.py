@@ -0,0 +1,51 @@
+"""Add jobs table
+
+Revision ID: e3b5c7a9d1f2
+Revises: 9d2a6f4c1e87
+Create Date: 2026-10-17 21:05:41.227730
+
+"""
+
+from collections.abc import Sequence
+
+import advanced_alchemy
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e3b5c7a9d1f2"
+down_revision: str | None = "9d2a6f4c1e87"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "jobs",
+        sa.Column("kind", sa.String(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("user_id", advanced_alchemy.types.GUID(length=16), nullable=True),
+        sa.Column("task_id", advanced_alchemy.types.GUID(length=16), nullable=True),
+        sa.Column("progress", sa.Integer(), nullable=False),
+        sa.Column("result", sa.String(), nullable=True),
+        sa.Column("error", sa.String(), nullable=True),
+        sa.Column("started_at", advanced_alchemy.types.DateTimeUTC(timezone=True), nullable=True),
+        sa.Column("finished_at", advanced_alchemy.types.DateTimeUTC(timezone=True), nullable=True),
+        sa.Column("id", advanced_alchemy.types.GUID(length=16), nullable=False),
+        sa.Column("sa_orm_sentinel", sa.Integer(), nullable=True),
+        sa.Column("created_at", advanced_alchemy.types.DateTimeUTC(timezone=True), nullable=False),
+        sa.Column("updated_at", advanced_alchemy.types.DateTimeUTC(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["task_id"], ["tasks.id"], name=op.f("fk_jobs_task_id_tasks"), ondelete="SET NULL"
+        ),
+        sa.ForeignKeyConstraint(
+            ["user_id"], ["users.id"], name=op.f("fk_jobs_user_id_users"), ondelete="SET NULL"
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_jobs")),
+        comment="Long running operations executed by the background job runner",
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("jobs")
@@ -1,6 +1,13 @@
 import {routes} from '../../shared/scripts/routes.js';
 import Panzoom from '@panzoom/panzoom';
 
+// Number of upcoming images kept fetched and decoded ahead of the one being labeled
+const PREFETCH_WINDOW_SIZE = 4;
+// Number of decoded deep zoom tiles kept in memory for redrawing while panning
+const DEEP_ZOOM_TILE_LIMIT = 256;
+// Zoom limit for images without a deep zoom pyramid loaded
+const DEFAULT_MAX_SCALE = 5;
+
 class AnnotationHistoryBuffer {
   constructor(bufferKey, bufferLimit) {
     this.bufferKey = bufferKey;
@@ -37,6 +44,228 @@ class AnnotationHistoryBuffer {
   }
 }
 
+class PrefetchRingBuffer {
+  /**
+   * Fixed-capacity FIFO of upcoming images that have already been fetched and decoded
+   * @param {integer} capacity: maximum number of images held at once
+   */
+  constructor(capacity) {
+    this.capacity = capacity;
+    this.slots = new Array(capacity).fill(null);
+    this.head = 0;
+    this.size = 0;
+  }
+
+  isEmpty() {
+    return this.size === 0;
+  }
+
+  isFull() {
+    return this.size === this.capacity;
+  }
+
+  has(annotationId) {
+    for (let i = 0; i < this.size; i++) {
+      if (this.slots[(this.head + i) % this.capacity].annotationId === annotationId) {
+        return true;
+      }
+    }
+    return false;
+  }
+
+  push(entry) {
+    if (this.isFull()) {
+      return false;
+    }
+    this.slots[(this.head + this.size) % this.capacity] = entry;
+    this.size++;
+    return true;
+  }
+
+  shift() {
+    if (this.isEmpty()) {
+      return null;
+    }
+    let entry = this.slots[this.head];
+    this.slots[this.head] = null;
+    this.head = (this.head + 1) % this.capacity;
+    this.size--;
+    return entry;
+  }
+}
+
+class DeepZoomLayer {
+  /**
+   * Draws Deep Zoom tiles of the visible region over the displayed image once it is zoomed in
+   * past the resolution of the downscaled image served for labeling
+   * @param {HTMLImageElement} imageElement: panzoomed image element the tiles are drawn over
+   * @param {string} taskId: id of the task
+   */
+  constructor(imageElement, taskId) {
+    this.imageElement = imageElement;
+    this.container = imageElement.parentElement;
+    this.taskId = taskId;
+    this.canvas = document.createElement('canvas');
+    this.canvas.className = 'deep-zoom-layer';
+    this.container.appendChild(this.canvas);
+    this.annotationId = null;
+    this.pyramid = null;
+    this.pyramidRequest = null;
+    this.tiles = new Map();
+    this.redrawScheduled = false;
+    this.onPyramidLoaded = () => {};
+  }
+
+  /**
+   * Forget the tiles of the previous image, the pyramid of the new one is only requested once
+   * the user zooms in (see `ensurePyramid`)
+   * @param {string} annotationId: annotation being displayed
+   */
+  reset(annotationId) {
+    this.annotationId = annotationId;
+    this.pyramid = null;
+    this.pyramidRequest = null;
+    this.tiles.clear();
+    this.scheduleRedraw();
+  }
+
+  scheduleRedraw() {
+    if (this.redrawScheduled) {
+      return;
+    }
+    this.redrawScheduled = true;
+    requestAnimationFrame(() => {
+      this.redrawScheduled = false;
+      this.redraw();
+    });
+  }
+
+  async loadPyramid(annotationId) {
+    let params = new URLSearchParams({task_id: this.taskId, annotation_id: annotationId});
+    let response = await fetch(`${routes.getAnnotationDzi}?${params.toString()}`);
+    if (!response.ok) throw new Error(response.statusText);
+    let descriptor = new DOMParser().parseFromString(await response.text(), 'application/xml');
+    let image = descriptor.documentElement;
+    let size = image.getElementsByTagName('Size')[0];
+    let width = Number(size.getAttribute('Width'));
+    let height = Number(size.getAttribute('Height'));
+    return {
+      width: width,
+      height: height,
+      tileSize: Number(image.getAttribute('TileSize')),
+      overlap: Number(image.getAttribute('Overlap')),
+      maxLevel: Math.ceil(Math.log2(Math.max(width, height, 1))),
+    };
+  }
+
+  ensurePyramid() {
+    let annotationId = this.annotationId;
+    if (this.pyramidRequest !== null || annotationId === null || Number(annotationId) < 0) {
+      return;
+    }
+    this.pyramidRequest = this.loadPyramid(annotationId)
+      .then((pyramid) => {
+        if (annotationId === this.annotationId) {
+          this.pyramid = pyramid;
+          this.onPyramidLoaded(pyramid);
+          this.scheduleRedraw();
+        }
+      })
+      .catch((error) => console.error('Failed to load deep zoom pyramid:', error));
+  }
+
+  getTile(level, col, row) {
+    let tileKey = `${level}/${col}_${row}`;
+    let tile = this.tiles.get(tileKey);
+    if (tile === undefined) {
+      tile = new Image();
+      tile.onload = () => this.scheduleRedraw();
+      tile.src = `${routes.getAnnotationTile}?${new URLSearchParams({
+        task_id: this.taskId,
+        annotation_id: this.annotationId,
+        level: level,
+        col: col,
+        row: row,
+      }).toString()}`;
+      if (this.tiles.size >= DEEP_ZOOM_TILE_LIMIT) {
+        this.tiles.delete(this.tiles.keys().next().value); // oldest requested tile
+      }
+    } else {
+      this.tiles.delete(tileKey); // re-inserted below as the most recently used
+    }
+    this.tiles.set(tileKey, tile);
+    return tile;
+  }
+
+  redraw() {
+    let pixelRatio = window.devicePixelRatio || 1;
+    let containerRect = this.container.getBoundingClientRect();
+    let imageRect = this.imageElement.getBoundingClientRect();
+    this.canvas.width = containerRect.width * pixelRatio;
+    this.canvas.height = containerRect.height * pixelRatio;
+    let context = this.canvas.getContext('2d');
+    context.clearRect(0, 0, this.canvas.width, this.canvas.height);
+
+    // Nothing to add while the downscaled image still has a pixel for every screen pixel
+    let zoomedPastImage = imageRect.width * pixelRatio > this.imageElement.naturalWidth;
+    let pyramid = this.pyramid;
+    if (!zoomedPastImage || pyramid === null || pyramid.width <= this.imageElement.naturalWidth) {
+      return;
+    }
+
+    // Lowest level with at least one pixel per screen pixel at the current zoom
+    let screenScale = (imageRect.width * pixelRatio) / pyramid.width;
+    let level = Math.min(
+      pyramid.maxLevel,
+      Math.max(0, pyramid.maxLevel + Math.ceil(Math.log2(screenScale)))
+    );
+    let levelScale = 2 ** (level - pyramid.maxLevel);
+    let levelWidth = Math.ceil(pyramid.width * levelScale);
+    let levelHeight = Math.ceil(pyramid.height * levelScale);
+    // Screen pixels (CSS) per level pixel
+    let drawScale = imageRect.width / levelWidth;
+
+    let visibleLeft = Math.max(imageRect.left, containerRect.left) - imageRect.left;
+    let visibleTop = Math.max(imageRect.top, containerRect.top) - imageRect.top;
+    let visibleRight = Math.min(imageRect.right, containerRect.right) - imageRect.left;
+    let visibleBottom = Math.min(imageRect.bottom, containerRect.bottom) - imageRect.top;
+    if (visibleRight <= visibleLeft || visibleBottom <= visibleTop) {
+      return;
+    }
+
+    let tileSize = pyramid.tileSize;
+    let firstCol = Math.floor(visibleLeft / drawScale / tileSize);
+    let firstRow = Math.floor(visibleTop / drawScale / tileSize);
+    let lastCol = Math.min(
+      Math.floor(visibleRight / drawScale / tileSize),
+      Math.ceil(levelWidth / tileSize) - 1
+    );
+    let lastRow = Math.min(
+      Math.floor(visibleBottom / drawScale / tileSize),
+      Math.ceil(levelHeight / tileSize) - 1
+    );
+
+    for (let row = firstRow; row <= lastRow; row++) {
+      for (let col = firstCol; col <= lastCol; col++) {
+        let tile = this.getTile(level, col, row);
+        if (!tile.complete || tile.naturalWidth === 0) {
+          continue; // drawn on a later redraw, once loaded
+        }
+        // Tiles other than the first in each direction start `overlap` pixels early
+        let tileLeft = col * tileSize - (col > 0 ? pyramid.overlap : 0);
+        let tileTop = row * tileSize - (row > 0 ? pyramid.overlap : 0);
+        context.drawImage(
+          tile,
+          (imageRect.left - containerRect.left + tileLeft * drawScale) * pixelRatio,
+          (imageRect.top - containerRect.top + tileTop * drawScale) * pixelRatio,
+          tile.naturalWidth * drawScale * pixelRatio,
+          tile.naturalHeight * drawScale * pixelRatio
+        );
+      }
+    }
+  }
+}
+
 class ImageNavigator {
   /**
    * @param {HTMLImageElement} imageElementId: id of the image element to display the image
@@ -47,35 +276,178 @@ class ImageNavigator {
     this.imageViewer = document.getElementById(imageElementId);
     this.container = this.imageViewer.parentElement;
     this.undoHistory = new AnnotationHistoryBuffer('undoBuffer', 10000);
+    this.prefetchBuffer = new PrefetchRingBuffer(PREFETCH_WINDOW_SIZE);
+    this.labeledIds = new Set();
+    this.pendingUpdates = 0;
+    this.isRefilling = false;
     this.currentAnnotationId;
     this.panzoom;
+    this.deepZoomLayer = new DeepZoomLayer(this.imageViewer, taskId);
+    this.deepZoomLayer.onPyramidLoaded = (pyramid) => this.allowFullResolutionZoom(pyramid);
+    this.imageViewer.addEventListener('load', () => {
+      this.deepZoomLayer.reset(this.currentAnnotationId);
+      if (this.panzoom) {
+        this.panzoom.setOptions({maxScale: DEFAULT_MAX_SCALE});
+        if (this.panzoom.getScale() > 1) {
+          this.deepZoomLayer.ensurePyramid();
+        }
+      }
+    });
   }
 
   setupPanzoom() {
     this.panzoom = Panzoom(this.imageViewer, {
-      maxScale: 5,
+      maxScale: DEFAULT_MAX_SCALE,
       minScale: 0.5,
     });
 
     this.container.addEventListener('wheel', this.panzoom.zoomWithWheel);
+    this.imageViewer.addEventListener('panzoomchange', (event) => {
+      if (event.detail.scale > 1) {
+        this.deepZoomLayer.ensurePyramid();
+      }
+      this.deepZoomLayer.scheduleRedraw();
+    });
+    window.addEventListener('resize', () => this.deepZoomLayer.scheduleRedraw());
+  }
+
+  allowFullResolutionZoom(pyramid) {
+    if (!this.panzoom) {
+      return;
+    }
+    // Zoom is relative to the width of the image at scale 1
+    let baseWidth = this.imageViewer.getBoundingClientRect().width / this.panzoom.getScale();
+    let fullResolutionScale = pyramid.width / (baseWidth * (window.devicePixelRatio || 1));
+    this.panzoom.setOptions({maxScale: Math.max(DEFAULT_MAX_SCALE, fullResolutionScale)});
+  }
+
+  /**
+   * Ask again later when every remaining image is leased to another annotator
+   * @param {Response} response: response of the next annotation route
+   * @param {Function} retry: called once the delay requested by the server has elapsed
+   * @return {boolean} whether the response carried no image
+   */
+  retryWhenLeased(response, retry) {
+    if (response.status !== 204) {
+      return false;
+    }
+    let delaySeconds = Number(response.headers.get('Retry-After')) || 5;
+    setTimeout(retry, delaySeconds * 1000);
+    return true;
   }
 
   initializeImage() {
     fetch(`${routes.getNextAnnotation}?task_id=${encodeURIComponent(this.taskId)}`)
       .then((response) => {
+        if (this.retryWhenLeased(response, () => this.initializeImage())) {
+          return null;
+        }
         this.currentAnnotationId = response.headers.get('X-Metadata-AnnotationID');
         return response.blob();
       })
       .then((imageBlob) => {
+        if (imageBlob === null) {
+          return;
+        }
         const imageObjectURL = URL.createObjectURL(imageBlob);
         this.imageViewer.src = imageObjectURL;
         this.imageViewer.onload = () => {
           this.setupPanzoom();
         };
+        this.refillPrefetchBuffer();
       })
       .catch((error) => console.error('Failed to load initial image:', error));
   }
 
+  displayImage(annotationId, imageObjectURL) {
+    if (this.imageViewer.src.startsWith('blob:')) {
+      URL.revokeObjectURL(this.imageViewer.src);
+    }
+    this.currentAnnotationId = annotationId;
+    this.imageViewer.src = imageObjectURL;
+  }
+
+  isKnownAnnotation(annotationId) {
+    return (
+      annotationId === this.currentAnnotationId ||
+      this.labeledIds.has(annotationId) ||
+      this.prefetchBuffer.has(annotationId)
+    );
+  }
+
+  async prefetchAnnotation(annotationId) {
+    let params = new URLSearchParams({
+      task_id: this.taskId,
+      annotation_id: annotationId,
+    });
+    let response = await fetch(`${routes.getAnyAnnotation}?${params.toString()}`);
+    let imageObjectURL = URL.createObjectURL(await response.blob());
+    let image = new Image();
+    image.src = imageObjectURL;
+    try {
+      await image.decode();
+    } catch (error) {
+      console.error(`Failed to decode prefetched image ${annotationId}:`, error);
+    }
+    // Holding on to the decoded image keeps it ready to paint when it is displayed
+    return {annotationId: annotationId, imageObjectURL: imageObjectURL, image: image};
+  }
+
+  async refillPrefetchBuffer() {
+    if (this.isRefilling || this.prefetchBuffer.isFull()) {
+      return;
+    }
+    this.isRefilling = true;
+
+    try {
+      // The server returns the claims this user already holds first, which include the current
+      // image, buffered images and labels still in flight, so ask for enough to skip past them
+      let params = new URLSearchParams({
+        task_id: this.taskId,
+        count: this.prefetchBuffer.capacity + this.pendingUpdates + 1,
+      });
+      let response = await fetch(`${routes.getAnnotationWindow}?${params.toString()}`);
+      let annotationWindow = await response.json();
+
+      let annotationIds = annotationWindow
+        .map((annotation) => String(annotation.annotation_id))
+        .filter((annotationId) => !this.isKnownAnnotation(annotationId))
+        .slice(0, this.prefetchBuffer.capacity - this.prefetchBuffer.size);
+      let entries = await Promise.all(annotationIds.map((id) => this.prefetchAnnotation(id)));
+
+      for (const entry of entries) {
+        if (this.isKnownAnnotation(entry.annotationId) || !this.prefetchBuffer.push(entry)) {
+          URL.revokeObjectURL(entry.imageObjectURL);
+        }
+      }
+    } catch (error) {
+      console.error('Failed to prefetch upcoming images:', error);
+    } finally {
+      this.isRefilling = false;
+    }
+  }
+
+  /**
+   * Show the next prefetched image without waiting for the current label to be saved
+   * @param {Promise} updatePromise: pending label update for the current image
+   */
+  async showNextImage(updatePromise) {
+    let entry = this.prefetchBuffer.shift();
+    while (entry !== null && this.labeledIds.has(entry.annotationId)) {
+      URL.revokeObjectURL(entry.imageObjectURL);
+      entry = this.prefetchBuffer.shift();
+    }
+
+    if (entry !== null) {
+      this.displayImage(entry.annotationId, entry.imageObjectURL);
+    } else {
+      // Nothing prefetched: the label must be saved first or the server hands back this image
+      await updatePromise;
+      this.loadNextImage();
+    }
+    this.refillPrefetchBuffer();
+  }
+
   loadNextImage(annotationId) {
     let params = new URLSearchParams({
       task_id: encodeURIComponent(this.taskId),
@@ -91,24 +463,34 @@ class ImageNavigator {
 
     fetch(updateRoute)
       .then((response) => {
-        this.currentAnnotationId = response.headers.get('X-Metadata-AnnotationID');
-        return response.blob();
+        if (this.retryWhenLeased(response, () => this.loadNextImage(annotationId))) {
+          return null;
+        }
+        let nextAnnotationId = response.headers.get('X-Metadata-AnnotationID');
+        return response.blob().then((imageBlob) => [nextAnnotationId, imageBlob]);
       })
-      .then((imageBlob) => {
-        const imageObjectURL = URL.createObjectURL(imageBlob);
-        this.imageViewer.src = imageObjectURL;
+      .then((result) => {
+        if (result === null) {
+          return;
+        }
+        let [nextAnnotationId, imageBlob] = result;
+        this.displayImage(nextAnnotationId, URL.createObjectURL(imageBlob));
       })
       .catch((error) => console.error('Failed to load next image:', error));
   }
 
   async updateAnnotation(label) {
+    // The next image may be displayed before this request completes, so pin the annotation id
+    let annotationId = this.currentAnnotationId;
     let params = new URLSearchParams({
       task_id: encodeURIComponent(this.taskId),
-      annotation_id: encodeURIComponent(this.currentAnnotationId),
+      annotation_id: encodeURIComponent(annotationId),
     });
     let updateRoute = `${routes.updateAnnotation}?${params.toString()}`;
 
     let data = {label: label};
+    this.labeledIds.add(annotationId);
+    this.pendingUpdates++;
     try {
       let response = await fetch(updateRoute, {
         method: 'PATCH',
@@ -120,16 +502,19 @@ class ImageNavigator {
 
       let progressData = await response.json();
       console.log(progressData);
-      this.undoHistory.addToBuffer(this.currentAnnotationId);
+      this.undoHistory.addToBuffer(annotationId);
 
       return progressData;
     } catch (error) {
       console.error(`Failed annotation update due to ${error}`);
+    } finally {
+      this.pendingUpdates--;
     }
   }
 
   async undoAnnotation() {
     this.currentAnnotationId = this.undoHistory.popFromBuffer();
+    this.labeledIds.delete(this.currentAnnotationId);
 
     let params = new URLSearchParams({
       task_id: encodeURIComponent(this.taskId),
@@ -181,13 +566,14 @@ function main() {
 
   const labelKeybindMap = new Map();
   let isProcessingKeypress = false;
-  let updateProgress;
 
   document.querySelectorAll('.label-btn').forEach((btn) => {
-    btn.addEventListener('click', async () => {
-      updateProgress = await imageNavigator.updateAnnotation(btn.dataset.label);
-      updateUI(updateProgress.labeled, updateProgress.total, updateProgress.progress);
-      imageNavigator.loadNextImage();
+    btn.addEventListener('click', () => {
+      let updatePromise = imageNavigator.updateAnnotation(btn.dataset.label);
+      imageNavigator.showNextImage(updatePromise);
+      updatePromise.then((updateProgress) => {
+        updateUI(updateProgress.labeled, updateProgress.total, updateProgress.progress);
+      });
 
       btn.classList.add('label-button-pressed');
       setTimeout(() => {
@@ -227,9 +613,9 @@ function main() {
       if (labelKeybindMap.has(event.key.toUpperCase())) {
         let label = labelKeybindMap.get(event.key.toUpperCase());
         let updatePromise = imageNavigator.updateAnnotation(label);
+        imageNavigator.showNextImage(updatePromise);
         updatePromise.then((updateProgress) => {
           updateUI(updateProgress.labeled, updateProgress.total, updateProgress.progress);
-          imageNavigator.loadNextImage();
         });
 
         document
@@ -16,6 +16,24 @@ import {LabelKeybindInput} from '../../components/label-keybind-input.ts';
 
 // GLOBAL VARIABLES
 let lkSelectControls = 2; // the html template always starts with 2 label-keybind select fields
+const JOB_POLL_INTERVAL_MS = 1000;
+
+/**
+ * Poll a background job until it is done or has failed
+ * @param {string} jobUrl
+ * @returns {Promise<Object>} the finished job
+ */
+async function waitForJob(jobUrl) {
+  for (;;) {
+    const response = await fetch(jobUrl);
+    if (!response.ok) throw new Error(response.statusText);
+
+    const job = await response.json();
+    if (job.status === 'done') return job;
+    if (job.status === 'failed') throw new Error(job.error);
+    await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+  }
+}
 
 function populateModal(target, taskData) {
   target.querySelector('form').innerHTML = `
@@ -199,7 +217,18 @@ async function handleTaskExportButtonClick(event) {
   const taskId = event.target.closest('.task-display-card').dataset.task_id;
 
   try {
-    const response = await fetch(`${routes.exportTask}?task_id=${encodeURIComponent(taskId)}`);
+    // Exports run as a background job, the file is downloaded once it has been written
+    const submitResponse = await fetch(routes.submitJob, {
+      method: 'POST',
+      body: JSON.stringify({kind: 'export_task', task_id: taskId}),
+      headers: {
+        'Content-Type': 'application/json',
+      },
+    });
+    if (!submitResponse.ok) throw new Error(`Export failed: ${submitResponse.statusText}`);
+    const job = await waitForJob((await submitResponse.json()).url);
+
+    const response = await fetch(job.result_url);
     if (!response.ok) throw new Error(`Download failed: ${response.statusText}`);
 
     const blob = await response.blob();
@@ -462,6 +491,7 @@ function handleTaskCreationFormSubmit(event) {
       }
       return response.json();
     })
+    .then((content) => waitForJob(content.job_url)) // annotations are created in the background
     .then(() => {
       window.location.reload();
     })
@@ -12,6 +12,8 @@ export const routes = {
   getLabelPage: '/label',
 
   checkPath: '/api/system/check_path',
+  getBackupStatus: '/api/system/get_backup_status',
+  getMetrics: '/api/system/get_metrics',
 
   checkUsername: '/api/users/check_username',
   loginUser: '/api/users/login',
@@ -23,9 +25,17 @@ export const routes = {
   updateTask: '/api/tasks/update',
   exportTask: '/api/tasks/export_annotations',
 
+  submitJob: '/api/jobs/submit',
+  getJob: '/api/jobs/get_job',
+  getJobResult: '/api/jobs/get_job_result',
+
   annotateTask: '/api/annotations/annotate',
   updateAnnotation: '/api/annotations/update_annotation',
+  bulkUpdateAnnotations: '/api/annotations/bulk_update_annotations',
   getNextAnnotation: '/api/annotations/get_next_annotation',
   getAnyAnnotation: '/api/annotations/get_annotation',
+  getAnnotationWindow: '/api/annotations/get_annotation_window',
+  getAnnotationDzi: '/api/annotations/get_annotation_dzi',
+  getAnnotationTile: '/api/annotations/get_annotation_tile',
   getImage: '/api/annotations/get_image',
 };
@@ -5,27 +5,35 @@ from app.config import get_settings
 settings = get_settings()
 
 
-async def backup_database() -> None:
-    """Check for and create backup of sqlite database on application shutdown"""
-    import sqlite3
-    from pathlib import Path
-    from urllib.parse import urlparse
+async def coordinate_workers() -> None:
+    """Check the worker processes can share the configuration and take turns writing to SQLite"""
+    from app.config.plugin_config import alchemy_config
+    from app.domain.workers import coordinator
 
-    if not settings.db.BACKUP:
-        return
+    coordinator.check(settings)
+    write_engine = alchemy_config.get_engine()
+    if coordinator.multi_process and write_engine.dialect.name == "sqlite":
+        # Worker processes wait their turn to write instead of failing once busy_timeout runs out
+        timeout = settings.db.SQLITE_BUSY_TIMEOUT_MS / 1000
+        coordinator.serialize_writes(write_engine, timeout=timeout)
 
-    database_url = settings.db.URL
-    dbname = urlparse(database_url).path[1:]  # '/dev.db' --> 'dev.db'
-    current_path = Path().resolve()
-    dbpath = current_path / Path(dbname)
-    backup_path = f"{dbpath}.bak"
 
-    with sqlite3.connect(dbpath) as conn:
-        try:
-            with sqlite3.connect(backup_path) as backup_conn:
-                conn.backup(backup_conn)
-        except sqlite3.Error as e:
-            print(f"Backup failed: {e}")
+async def resume_jobs() -> None:
+    """Fail background jobs interrupted by the last shutdown and queue those that never ran"""
+    from app.config.plugin_config import alchemy_config
+    from app.domain.jobs import job_runner
+
+    await job_runner.resume(alchemy_config.get_engine(), alchemy_config.read_engine_instance)
+
+
+async def replay_label_journal() -> None:
+    """Write label updates journaled but not yet written to the database before the last shutdown"""
+    from app.config.plugin_config import alchemy_config
+    from app.domain.journal import label_journal
+    from app.domain.workers import coordinator
+
+    if coordinator.is_leader():  # a single worker process replays it
+        await label_journal.replay(alchemy_config.get_engine())
 
 
 def create_app() -> Litestar:
@@ -39,13 +47,20 @@ def create_app() -> Litestar:
         static_files_router,
         template_config,
     )
+    from app.domain.backups import backup_scheduler
+    from app.domain.cli import TaskCLIPlugin
     from app.domain.controllers import (
         AnnotationController,
+        JobController,
         PageController,
         SystemController,
         TaskController,
         UserController,
     )
+    from app.domain.jobs import job_runner
+    from app.domain.journal import label_journal
+    from app.domain.metrics import MetricsMiddleware
+    from app.domain.renditions import rendition_cache
 
     return Litestar(
         debug=settings.app.DEBUG,
@@ -55,13 +70,24 @@ def create_app() -> Litestar:
             SystemController,
             TaskController,
             AnnotationController,
+            JobController,
             static_files_router,
         ],
-        plugins=[SQLAlchemyPlugin(alchemy_config), AppDirCLIPlugin(settings.cli)],
+        plugins=[
+            SQLAlchemyPlugin(alchemy_config),
+            AppDirCLIPlugin(settings.cli),
+            TaskCLIPlugin(),
+        ],
         template_config=template_config,
         on_app_init=[session_auth.on_app_init],
-        middleware=[session_auth.middleware],
-        on_shutdown=[backup_database],
+        middleware=[MetricsMiddleware, session_auth.middleware],
+        on_startup=[coordinate_workers, resume_jobs, replay_label_journal, backup_scheduler.start],
+        on_shutdown=[
+            job_runner.shutdown,
+            label_journal.shutdown,
+            backup_scheduler.shutdown,
+            rendition_cache.shutdown,
+        ],
     )
 
 
@@ -2,26 +2,84 @@ import os
 from dataclasses import dataclass, field
 from os import urandom
 from pathlib import Path
+from typing import Any
 
 from advanced_alchemy.base import orm_registry
+from sqlalchemy import event, make_url
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.schema import MetaData
 
 TRUE_VALUES = {"True", "true", "1", "yes", "Y", "T"}
 
+# Engine profiles, see DatabaseSettings.PROFILE
+ENGINE_PROFILE_DEFAULT = "default"
+ENGINE_PROFILE_SQLITE_WAL = "sqlite_wal"
+
 
 @dataclass
 class DatabaseSettings:
     """Settings for SQLAlchemy and database instantiation"""
 
-    BACKUP: bool = field(
-        default_factory=lambda: os.getenv("DATABASE_BACKUP", "True") in TRUE_VALUES
-    )
     ECHO: bool = field(default_factory=lambda: os.getenv("DATABASE_ECHO", "False") in TRUE_VALUES)
     URL: str = field(
         default_factory=lambda: os.getenv("DATABASE_URL", "sqlite+aiosqlite:///dev.db")
     )
+    """
+    "default" creates a single engine with the driver defaults. "sqlite_wal" puts a SQLite
+    database in WAL mode with the pragmas below, serves read-only handlers from a pool of
+    read-only connections and serializes every write through a single writer connection, so
+    long reads and label writes no longer block each other
+    """
+    PROFILE: str = field(
+        default_factory=lambda: os.getenv("DATABASE_PROFILE", ENGINE_PROFILE_DEFAULT)
+    )
+    """ PRAGMA synchronous of sqlite_wal, NORMAL can lose the last commits on power loss """
+    SQLITE_SYNCHRONOUS: str = field(
+        default_factory=lambda: os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+    )
+    """ PRAGMA mmap_size, bytes of the database file read through memory mapping """
+    SQLITE_MMAP_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024**2)))
+    )
+    """ PRAGMA cache_size per connection, negative values are in KiB """
+    SQLITE_CACHE_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))
+    )
+    """ PRAGMA busy_timeout, milliseconds waited on a lock before "database is locked" errors """
+    SQLITE_BUSY_TIMEOUT_MS: int = field(
+        default_factory=lambda: int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    )
+    """ lock_timeout of PostgreSQL connections, milliseconds a statement waits on a lock """
+    PG_LOCK_TIMEOUT_MS: int = field(
+        default_factory=lambda: int(os.getenv("PG_LOCK_TIMEOUT_MS", "5000"))
+    )
+    """ Read-only connections of the sqlite_wal profile """
+    READ_POOL_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("DATABASE_READ_POOL_SIZE", "4"))
+    )
+    """
+    Connection pool of a PostgreSQL database, shared by every request and job of an app node.
+    Writers are no longer serialized, so size it for the concurrent annotators of a node
+    """
+    POOL_SIZE: int = field(default_factory=lambda: int(os.getenv("DATABASE_POOL_SIZE", "10")))
+    """ Connections opened past POOL_SIZE under load, closed again once returned """
+    MAX_OVERFLOW: int = field(default_factory=lambda: int(os.getenv("DATABASE_MAX_OVERFLOW", "10")))
+    """ Seconds waited for a connection of an exhausted pool before failing """
+    POOL_TIMEOUT: float = field(
+        default_factory=lambda: float(os.getenv("DATABASE_POOL_TIMEOUT", "30"))
+    )
+    """ Test connections as they are checked out, replacing ones the server has dropped """
+    POOL_PRE_PING: bool = field(
+        default_factory=lambda: os.getenv("DATABASE_POOL_PRE_PING", "True") in TRUE_VALUES
+    )
+    """ Seconds after which a connection is replaced, -1 keeps connections indefinitely """
+    POOL_RECYCLE: int = field(
+        default_factory=lambda: int(os.getenv("DATABASE_POOL_RECYCLE", "1800"))
+    )
     ENGINE_DEPENDENCY_KEY: str = field(default="db_engine")
+    READ_ENGINE_DEPENDENCY_KEY: str = field(default="db_read_engine")
+    READ_SESSION_MAKER_CLASS_DEPENDENCY_KEY: str = field(default="read_session_maker_class")
     SESSION_DEPENDENCY_KEY: str = field(default="db_session")
     ENGINE_APP_STATE_DEPENDENCY_KEY: str = field(default="db_engine")
     SESSION_MAKER_CLASS_DEPENDENCY_KEY: str = field(default="session_maker_class")
@@ -31,6 +89,7 @@ class DatabaseSettings:
     METADATA_SOURCE: MetaData | None = orm_registry.metadata if GENERATE_SCHEMA_ON_INIT else None
 
     _engine_instance: AsyncEngine | None = None
+    _read_engine_instance: AsyncEngine | None = None
 
     @property
     def engine(self) -> AsyncEngine:
@@ -38,10 +97,76 @@ class DatabaseSettings:
             return self._engine_instance
         return self.get_engine()
 
+    @property
+    def read_engine(self) -> AsyncEngine | None:
+        if self._read_engine_instance is not None:
+            return self._read_engine_instance
+        return self.get_read_engine()
+
     def get_engine(self) -> AsyncEngine:
-        self._engine_instance = create_async_engine(url=self.URL)
+        """Create the engine every write goes through."""
+        if self.PROFILE == ENGINE_PROFILE_SQLITE_WAL:
+            # Writers queue for the one connection rather than for SQLite's lock
+            self._engine_instance = create_async_engine(
+                url=self.URL, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0
+            )
+            self._set_sqlite_pragmas(self._engine_instance, query_only=False)
+        elif self.PROFILE == ENGINE_PROFILE_DEFAULT:
+            self._engine_instance = create_async_engine(url=self.URL, **self._get_pool_options())
+        else:
+            raise ValueError(f"Unknown database engine profile {self.PROFILE!r}")
         return self._engine_instance
 
+    def get_read_engine(self) -> AsyncEngine | None:
+        """Create the engine of read-only connections, None when reads share the write engine."""
+        if self.PROFILE != ENGINE_PROFILE_SQLITE_WAL:
+            return None
+        # Pooled, aiosqlite otherwise opens and sets up a connection per session
+        self._read_engine_instance = create_async_engine(
+            url=self.URL,
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=self.READ_POOL_SIZE,
+            max_overflow=0,
+        )
+        self._set_sqlite_pragmas(self._read_engine_instance, query_only=True)
+        return self._read_engine_instance
+
+    def _get_pool_options(self) -> dict[str, Any]:
+        """
+        Pool options of the engine, PostgreSQL connections are pooled as the settings say, and
+        bound how long they wait on a lock.
+        """
+        if make_url(self.URL).get_backend_name() != "postgresql":
+            return {}
+        return {
+            "pool_size": self.POOL_SIZE,
+            "max_overflow": self.MAX_OVERFLOW,
+            "pool_timeout": self.POOL_TIMEOUT,
+            "pool_pre_ping": self.POOL_PRE_PING,
+            "pool_recycle": self.POOL_RECYCLE,
+            "connect_args": {"server_settings": {"lock_timeout": str(self.PG_LOCK_TIMEOUT_MS)}},
+        }
+
+    def _set_sqlite_pragmas(self, engine: AsyncEngine, query_only: bool) -> None:
+        url = make_url(self.URL)
+        if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+            raise ValueError(f"The {self.PROFILE} profile requires a SQLite database file")
+        pragmas = [
+            "journal_mode = WAL",  # readers and the writer no longer block each other
+            f"synchronous = {self.SQLITE_SYNCHRONOUS}",
+            f"mmap_size = {self.SQLITE_MMAP_SIZE}",
+            f"cache_size = {self.SQLITE_CACHE_SIZE}",
+            f"busy_timeout = {self.SQLITE_BUSY_TIMEOUT_MS}",
+            f"query_only = {int(query_only)}",
+        ]
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(f"PRAGMA {pragma}")
+            cursor.close()
+
 
 @dataclass
 class TemplateSettings:
@@ -52,6 +177,96 @@ class TemplateSettings:
     ASSETS_ENDPOINT: str = field(default="/static")
 
 
+@dataclass
+class RenditionSettings:
+    """Settings for the on-disk cache of downscaled image renditions"""
+
+    CACHE_DIR: str = field(
+        default_factory=lambda: os.getenv("RENDITION_CACHE_DIR", ".cache/renditions")
+    )
+    """ Byte budget of the cache, least recently used renditions are evicted beyond it """
+    MAX_BYTES: int = field(
+        default_factory=lambda: int(os.getenv("RENDITION_CACHE_MAX_BYTES", str(1024**3)))
+    )
+    WORKERS: int = field(default_factory=lambda: int(os.getenv("RENDITION_WORKERS", "2")))
+    """ Longest side, in pixels, of each rendition variant """
+    THUMBNAIL_SIZE: int = field(default=256)
+    DISPLAY_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("RENDITION_DISPLAY_SIZE", "2048"))
+    )
+    QUALITY: int = field(default=90)
+    """ Edge and overlap, in pixels, of the Deep Zoom tiles served for very large images """
+    TILE_SIZE: int = field(default=254)
+    TILE_OVERLAP: int = field(default=1)
+    """
+    Largest image, in pixels, tiled into a pyramid. Its full resolution level is cut from the
+    image decoded whole, about 3 bytes per pixel (4 with alpha) in each rendition worker
+    """
+    MAX_PYRAMID_PIXELS: int = field(
+        default_factory=lambda: int(os.getenv("RENDITION_MAX_PYRAMID_PIXELS", str(2**29)))
+    )
+    """ Number of upcoming annotations rendered in the background on task creation/assignment """
+    PREWARM_COUNT: int = field(default=32)
+
+
+@dataclass
+class JobSettings:
+    """Background job runner configuration"""
+
+    """ Jobs run concurrently, more are queued until a worker frees up """
+    WORKERS: int = field(default_factory=lambda: int(os.getenv("JOB_WORKERS", "2")))
+    """ Directory job outputs such as exports are written to """
+    RESULT_DIR: str = field(
+        default_factory=lambda: os.getenv("JOB_RESULT_DIR", ".cache/job_results")
+    )
+    """ Seconds between checks for jobs submitted through other worker processes """
+    POLL_INTERVAL_SECONDS: float = field(
+        default_factory=lambda: float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "1"))
+    )
+
+
+@dataclass
+class BackupSettings:
+    """Periodic online backups of the database"""
+
+    ENABLED: bool = field(
+        default_factory=lambda: os.getenv("DATABASE_BACKUP", "True") in TRUE_VALUES
+    )
+    """ Directory the timestamped backup generations are written to """
+    DIR: str = field(default_factory=lambda: os.getenv("BACKUP_DIR", ".backups"))
+    INTERVAL_SECONDS: int = field(
+        default_factory=lambda: int(os.getenv("BACKUP_INTERVAL_SECONDS", "3600"))
+    )
+    """ Generations kept, older ones are deleted once a new backup is verified """
+    RETAIN: int = field(default_factory=lambda: int(os.getenv("BACKUP_RETAIN", "24")))
+    """ Database pages copied per step, the database is released for writers between steps """
+    PAGES_PER_STEP: int = field(
+        default_factory=lambda: int(os.getenv("BACKUP_PAGES_PER_STEP", "1024"))
+    )
+    STEP_SLEEP_MS: int = field(default_factory=lambda: int(os.getenv("BACKUP_STEP_SLEEP_MS", "10")))
+    """ pg_dump and pg_restore binaries backing up a PostgreSQL database, looked up in PATH """
+    PG_DUMP: str = field(default_factory=lambda: os.getenv("BACKUP_PG_DUMP", "pg_dump"))
+    PG_RESTORE: str = field(default_factory=lambda: os.getenv("BACKUP_PG_RESTORE", "pg_restore"))
+
+
+@dataclass
+class JournalSettings:
+    """Write-behind journal of label updates"""
+
+    """ Acknowledge label updates once journaled and write them to the database in batches """
+    WRITE_BEHIND: bool = field(
+        default_factory=lambda: os.getenv("LABEL_WRITE_BEHIND", "False") in TRUE_VALUES
+    )
+    """ Append-only file holding label updates until they are written to the database """
+    PATH: str = field(
+        default_factory=lambda: os.getenv("LABEL_JOURNAL_PATH", ".cache/label_journal.jsonl")
+    )
+    """ Milliseconds between batched writes of journaled label updates """
+    FLUSH_INTERVAL_MS: int = field(
+        default_factory=lambda: int(os.getenv("LABEL_FLUSH_INTERVAL_MS", "250"))
+    )
+
+
 @dataclass
 class ServerSettings:
     """Settings for uvicorn server"""
@@ -63,6 +278,10 @@ class ServerSettings:
         default_factory=lambda: os.getenv("LITESTAR_RELOAD", "False") in TRUE_VALUES
     )
     RELOAD_DIRS: list[str] = field(default_factory=lambda: ["src"])
+    """ Worker processes serving the app, `app run --wc` sets it for the workers it starts """
+    WORKERS: int = field(default_factory=lambda: int(os.getenv("WEB_CONCURRENCY", "1")))
+    """ Directory of the lock and counter files worker processes coordinate through """
+    RUN_DIR: str = field(default_factory=lambda: os.getenv("RUN_DIR", ".cache/run"))
 
 
 @dataclass
@@ -76,6 +295,32 @@ class AppSettings:
     )
     NAME: str = field(default_factory=lambda: "app")
     AUTHENTICATE: bool = field(default_factory=lambda: os.getenv("TESTING", "True") in TRUE_VALUES)
+    """ Seconds an annotator holds a claimed annotation before other contributors may take it """
+    ANNOTATION_LEASE_SECONDS: int = field(
+        default_factory=lambda: int(os.getenv("ANNOTATION_LEASE_SECONDS", "300"))
+    )
+    """ Image files inserted per transaction when populating a new task from its root folder """
+    INGEST_BATCH_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("INGEST_BATCH_SIZE", "10000"))
+    )
+    """ Annotations fetched from the database per round trip when exporting a task """
+    EXPORT_BATCH_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+    )
+    """ Authenticated users whose identity is kept in memory between requests """
+    USER_CACHE_SIZE: int = field(default_factory=lambda: int(os.getenv("USER_CACHE_SIZE", "1024")))
+    """ Seconds a cached identity is trusted before it is reloaded from the database """
+    USER_CACHE_TTL_SECONDS: float = field(
+        default_factory=lambda: float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+    )
+    """ Executions of one statement by a request above which it is reported as a likely N+1 """
+    QUERY_REPEAT_THRESHOLD: int = field(
+        default_factory=lambda: int(os.getenv("QUERY_REPEAT_THRESHOLD", "10"))
+    )
+    """ Fail a request from the statement that exceeds its handler's query budget, for tests """
+    QUERY_BUDGET_STRICT: bool = field(
+        default_factory=lambda: os.getenv("QUERY_BUDGET_STRICT", "False") in TRUE_VALUES
+    )
 
 
 @dataclass
@@ -91,7 +336,11 @@ class Settings:
     app: AppSettings = field(default_factory=AppSettings)
     server: ServerSettings = field(default_factory=ServerSettings)
     db: DatabaseSettings = field(default_factory=DatabaseSettings)
+    backup: BackupSettings = field(default_factory=BackupSettings)
     template: TemplateSettings = field(default_factory=TemplateSettings)
+    rendition: RenditionSettings = field(default_factory=RenditionSettings)
+    job: JobSettings = field(default_factory=JobSettings)
+    journal: JournalSettings = field(default_factory=JournalSettings)
     cli: CLISettings = field(default_factory=CLISettings)
 
     @classmethod
@@ -1,7 +1,11 @@
 import os
 import posixpath
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
+from uuid import UUID
 
 from advanced_alchemy.extensions.litestar import (
     AsyncSessionConfig,
@@ -10,18 +14,20 @@ from advanced_alchemy.extensions.litestar import (
 )
 from click import Command, Context, Group, Option
 from jinja2 import Environment, FileSystemLoader
+from litestar import Litestar
 from litestar.connection import ASGIConnection
 from litestar.contrib.jinja import JinjaTemplateEngine
+from litestar.datastructures import State
 from litestar.middleware.session.client_side import ClientSideSessionBackend, CookieBackendConfig
 from litestar.plugins import CLIPluginProtocol
 from litestar.security.session_auth import SessionAuth
 from litestar.static_files import create_static_files_router  # type: ignore
 from litestar.template.config import TemplateConfig
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
+from litestar.types import Scope
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
 from app.domain import urls
-from app.domain.schema import User
+from app.domain.identity import AuthUser, identity_cache
 from app.domain.template_filters import (
     format_and_localize_timestamp,
     get_basefile_name,
@@ -33,8 +39,66 @@ from .base import CLISettings, get_settings
 
 settings = get_settings()
 
-alchemy_config = SQLAlchemyAsyncConfig(
+""" Route handler option of read-only methods (GET, HEAD) that write nonetheless, e.g. claims """
+WRITER_OPT = "uses_writer"
+READ_ONLY_METHODS = {"GET", "HEAD"}
+
+
+@dataclass
+class ReadWriteSQLAlchemyConfig(SQLAlchemyAsyncConfig):
+    """
+    Config giving the requests of read-only handlers a session on a separate engine of read-only
+    connections. Every other request, and everything outside of requests, uses the write engine.
+    Without a read engine it behaves as SQLAlchemyAsyncConfig.
+    """
+
+    read_engine_instance: AsyncEngine | None = None
+
+    def provide_session(self, state: State, scope: Scope) -> AsyncSession:
+        if self.read_engine_instance is not None and is_read_only(scope):
+            read_session_maker = state[settings.db.READ_SESSION_MAKER_CLASS_DEPENDENCY_KEY]
+            state = State({self.session_maker_app_state_key: read_session_maker})
+        return super().provide_session(state, scope)
+
+    def create_app_state_items(self) -> dict[str, Any]:
+        items = super().create_app_state_items()
+        if self.read_engine_instance is not None:
+            items[settings.db.READ_ENGINE_DEPENDENCY_KEY] = self.read_engine_instance
+            items[settings.db.READ_SESSION_MAKER_CLASS_DEPENDENCY_KEY] = self.session_maker_class(
+                **{**self.session_config_dict, "bind": self.read_engine_instance}
+            )
+        return items
+
+    @asynccontextmanager
+    async def lifespan(self, app: Litestar) -> AsyncGenerator[None, None]:
+        try:
+            async with super().lifespan(app):
+                yield
+        finally:
+            if self.read_engine_instance is not None:
+                await self.read_engine_instance.dispose()
+
+
+def is_read_only(scope: Scope) -> bool:
+    """Whether a request is served by a read-only handler."""
+    route_handler = scope.get("route_handler")
+    return (
+        scope.get("method") in READ_ONLY_METHODS
+        and route_handler is not None
+        and not route_handler.opt.get(WRITER_OPT, False)
+    )
+
+
+def get_read_engine(state: State) -> AsyncEngine:
+    """Engine for reads outside of the request's session, e.g. streamed responses."""
+    return state.get(settings.db.READ_ENGINE_DEPENDENCY_KEY) or state.get(
+        settings.db.ENGINE_DEPENDENCY_KEY
+    )
+
+
+alchemy_config = ReadWriteSQLAlchemyConfig(
     engine_instance=settings.db.get_engine(),
+    read_engine_instance=settings.db.get_read_engine(),
     before_send_handler=async_autocommit_before_send_handler,
     session_config=AsyncSessionConfig(expire_on_commit=True),
     engine_dependency_key=settings.db.ENGINE_DEPENDENCY_KEY,
@@ -46,19 +110,17 @@ alchemy_config = SQLAlchemyAsyncConfig(
 
 async def retrieve_user_handler(
     session: dict[str, str], connection: ASGIConnection[Any, Any, Any, Any]
-) -> User | None:
+) -> AuthUser | None:
     user_id: str = session.get("user_id", "user_id")
-    if not user_id:
+    try:
+        coerced_user_id = UUID(str(user_id))
+    except ValueError:
         return None
 
-    engine = connection.app.state.get(settings.db.ENGINE_DEPENDENCY_KEY)
-    async with AsyncSession(engine) as db_session:
-        query = select(User).where(User.id == user_id)
-        result = await db_session.execute(query)
-        return result.scalars().unique().one_or_none()
+    return await identity_cache.get(get_read_engine(connection.app.state), coerced_user_id)
 
 
-session_auth = SessionAuth[User, ClientSideSessionBackend](
+session_auth = SessionAuth[AuthUser, ClientSideSessionBackend](
     retrieve_user_handler=retrieve_user_handler,  # type: ignore
     session_backend_config=CookieBackendConfig(secret=settings.app.SECRET_KEY),
     exclude=[
@@ -124,6 +186,8 @@ class AppDirCLIPlugin(CLIPluginProtocol):
             app_dir: str | None = kwargs.pop("app_dir", None)
             if app_dir:
                 os.environ["LITESTAR_APP_DIR"] = app_dir
+            # Worker processes started by --wc read it to coordinate, see app.domain.workers
+            os.environ["WEB_CONCURRENCY"] = str(kwargs.get("wc") or 1)
             return original_callback(*args, **kwargs)
 
         run_command.callback = wrapped_callback
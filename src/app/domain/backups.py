@@ -0,0 +1,218 @@
+"""
+Online backups of the database, taken periodically while the application serves requests.
+A SQLite backup copies the database a number of pages at a time in a worker thread, sleeping
+between steps so writers are not starved, and checks the integrity of the copy. A PostgreSQL
+backup is a pg_dump archive of a consistent snapshot, checked by listing it with pg_restore.
+Either is kept as a timestamped generation, and only the most recent generations are retained.
+"""
+
+import asyncio
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from contextlib import closing
+from dataclasses import asdict, dataclass
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Any
+
+from sqlalchemy import URL, make_url
+
+from app.config.base import BackupSettings, get_settings
+from app.domain.workers import coordinator
+
+settings = get_settings()
+
+
+class BackupCancelledError(Exception):
+    """Raised in the worker thread to abort a backup the application is shutting down during"""
+
+
+@dataclass
+class BackupStatus:
+    """Outcome of the last backup, and when the last successful one was taken"""
+
+    running: bool = False
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    """ Error of the last backup, None if it succeeded """
+    error: str | None = None
+    last_success_at: datetime | None = None
+    last_success_path: str | None = None
+    last_success_bytes: int | None = None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in asdict(self).items()
+        }
+
+
+def get_sqlite_path(database_url: str) -> Path | None:
+    """Path of the file a SQLite database URL opens, None for other databases."""
+    url = make_url(database_url)
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return None
+    return Path(url.database).resolve()  # relative to the working directory, as the driver does
+
+
+def get_postgresql_url(database_url: str) -> URL | None:
+    """URL libpq tools connect to a PostgreSQL database URL with, None for other databases."""
+    url = make_url(database_url)
+    if url.get_backend_name() != "postgresql":
+        return None
+    return url.set(drivername="postgresql")
+
+
+class BackupScheduler:
+    """Takes a backup of a SQLite or PostgreSQL database every interval, in a worker thread."""
+
+    def __init__(self, settings: BackupSettings, database_url: str) -> None:
+        self.enabled = settings.ENABLED
+        self.database = get_sqlite_path(database_url)
+        self.postgresql_url = get_postgresql_url(database_url)
+        self.backup_dir = Path(settings.DIR).resolve()
+        self.interval = settings.INTERVAL_SECONDS
+        self.retain = max(1, settings.RETAIN)
+        self.pages_per_step = settings.PAGES_PER_STEP
+        self.step_sleep = settings.STEP_SLEEP_MS / 1000
+        self.pg_dump = settings.PG_DUMP
+        self.pg_restore = settings.PG_RESTORE
+        self.status = BackupStatus()
+
+        self._task: asyncio.Task[None] | None = None
+        self._stop = threading.Event()
+
+    async def start(self) -> None:
+        if not self.enabled or (self.database is None and self.postgresql_url is None):
+            return
+        self._stop.clear()
+        self._task = asyncio.create_task(self._backup_periodically())
+
+    async def backup(self) -> BackupStatus:
+        """Take a backup now, unless one is already running. Failures are kept in the status."""
+        if self.database is None and self.postgresql_url is None:
+            raise ValueError("Only SQLite and PostgreSQL databases can be backed up")
+        if self.status.running:
+            return self.status
+
+        self.status.running, self.status.started_at = True, datetime.now(UTC)
+        try:
+            if self.database is not None:
+                destination = await asyncio.to_thread(self._backup, self.database)
+            elif self.postgresql_url is not None:
+                destination = await asyncio.to_thread(self._dump, self.postgresql_url)
+        except Exception as e:
+            self.status.error = str(e) or type(e).__name__
+        else:
+            self.status.error = None
+            self.status.last_success_at = self.status.started_at
+            self.status.last_success_path = str(destination)
+            self.status.last_success_bytes = destination.stat().st_size
+        finally:
+            self.status.running, self.status.finished_at = False, datetime.now(UTC)
+        return self.status
+
+    async def shutdown(self) -> None:
+        self._stop.set()  # aborts a backup in progress at its next step
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _backup_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            if not coordinator.is_leader():
+                continue  # another worker process takes the backups
+            status = await self.backup()
+            if status.error is not None:
+                print(f"Database backup failed: {status.error}")
+
+    def _backup(self, database: Path) -> Path:
+        destination = self._get_destination(database.stem, ".db")
+        temp_destination = destination.with_suffix(".tmp")
+        try:
+            with (
+                closing(
+                    sqlite3.connect(f"{database.as_uri()}?mode=ro", uri=True, isolation_level=None)
+                ) as source,
+                closing(sqlite3.connect(temp_destination)) as target,
+            ):
+                if source.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+                    # Copy from a snapshot: without it every commit made between two steps
+                    # restarts the copy, with it writers carry on as the snapshot is read
+                    source.execute("BEGIN")
+                    source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+                source.backup(target, pages=self.pages_per_step, progress=self._step)
+                # The copy inherits WAL mode, a generation is a single self-contained file
+                target.execute("PRAGMA journal_mode = DELETE")
+
+                result = target.execute("PRAGMA integrity_check").fetchall()
+                if result != [("ok",)]:
+                    raise ValueError(f"Backup failed its integrity check: {result[0][0]}")
+            temp_destination.replace(destination)  # atomic, a generation is never partial
+        except BaseException:
+            temp_destination.unlink(missing_ok=True)
+            raise
+
+        self._rotate(database.stem, ".db")
+        return destination
+
+    def _dump(self, url: URL) -> Path:
+        destination = self._get_destination(url.database or "postgres", ".dump")
+        temp_destination = destination.with_suffix(".tmp")
+        # The password is passed in the environment, arguments are visible to other users
+        env = {**os.environ, "PGPASSWORD": url.password} if url.password else None
+        dbname = url.set(password=None).render_as_string(hide_password=False)
+        try:
+            self._run([self.pg_dump, "--format=custom", f"--file={temp_destination}", dbname], env)
+            # Lists the archive's table of contents, which fails on a truncated or corrupt dump
+            self._run([self.pg_restore, "--list", str(temp_destination)], env)
+            temp_destination.replace(destination)
+        except BaseException:
+            temp_destination.unlink(missing_ok=True)
+            raise
+
+        self._rotate(url.database or "postgres", ".dump")
+        return destination
+
+    def _run(self, command: list[str], env: dict[str, str] | None) -> None:
+        """Run a client tool to completion, terminating it if the application shuts down."""
+        with subprocess.Popen(
+            command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        ) as process:
+            while True:
+                try:
+                    _, stderr = process.communicate(timeout=0.5)
+                    break
+                except subprocess.TimeoutExpired:
+                    if self._stop.is_set():
+                        process.terminate()
+                        process.wait()
+                        raise BackupCancelledError("Backup cancelled by shutdown") from None
+        if process.returncode != 0:
+            raise ValueError(f"{Path(command[0]).name} failed: {stderr.strip()}")
+
+    def _get_destination(self, name: str, suffix: str) -> Path:
+        self.backup_dir.mkdir(parents=True, exist_ok=True)
+        for leftover in self.backup_dir.glob(f"{name}-*.tmp"):  # from an aborted backup
+            leftover.unlink(missing_ok=True)
+        timestamp = datetime.now(UTC).strftime("%Y%m%dT%H%M%S%fZ")
+        return self.backup_dir / f"{name}-{timestamp}{suffix}"
+
+    def _rotate(self, name: str, suffix: str) -> None:
+        generations = sorted(self.backup_dir.glob(f"{name}-*{suffix}"))
+        for generation in generations[: -self.retain]:
+            generation.unlink(missing_ok=True)
+
+    def _step(self, status: int, remaining: int, total: int) -> None:
+        """Called by sqlite3 between steps of a backup, in the worker thread."""
+        if self._stop.is_set():
+            raise BackupCancelledError("Backup cancelled by shutdown")
+        time.sleep(self.step_sleep)  # releases the database to writers
+
+
+backup_scheduler = BackupScheduler(settings.backup, settings.db.URL)
@@ -0,0 +1,51 @@
+"""Maintenance commands, registered under `litestar tasks` by `TaskCLIPlugin`."""
+
+from uuid import UUID
+
+import anyio
+import click
+from litestar.cli._utils import console
+from litestar.plugins import CLIPluginProtocol
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config.plugin_config import alchemy_config
+from app.domain.services import TaskService
+
+
+@click.group(name="tasks", help="Manage annotation tasks.")
+def task_group() -> None:
+    pass
+
+
+@task_group.command(
+    name="repair-progress",
+    help="Recompute the progress counters of tasks from their annotations.",
+)
+@click.option(
+    "--task-id",
+    "task_ids",
+    type=click.UUID,
+    multiple=True,
+    help="Task to repair, may be repeated. Defaults to every task.",
+)
+def repair_progress(task_ids: tuple[UUID, ...]) -> None:
+    async def repair() -> int:
+        engine = alchemy_config.get_engine()
+        try:
+            async with (
+                AsyncSession(engine) as db_session,
+                TaskService.new(session=db_session) as tasks_service,
+            ):
+                repaired = await tasks_service.repair_progress(list(task_ids) or None)
+                await db_session.commit()
+        finally:
+            await engine.dispose()
+        return repaired
+
+    repaired = anyio.run(repair)
+    console.print(f"[green]Recomputed the progress counters of {repaired} task(s)[/]")
+
+
+class TaskCLIPlugin(CLIPluginProtocol):
+    def on_cli_init(self, cli: click.Group) -> None:
+        cli.add_command(task_group)
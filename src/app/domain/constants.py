@@ -2,6 +2,53 @@ IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff", ".webp", "
 
 RE_WIN_BACKSLASH = r"(?<!\\)(\\{1}(?:\\{2})*)(?!\\)"
 
+DICOM_EXTENSIONS = [".dcm", ".dicom"]
+
+# Window (center, width) presets in Hounsfield units for displaying DICOM images. "default" uses
+# the window stored in the file itself, or the full pixel range when it has none.
+DICOM_WINDOW_PRESETS: dict[str, tuple[float, float] | None] = {
+    "default": None,
+    "soft_tissue": (40, 400),
+    "lung": (-600, 1500),
+    "bone": (400, 1800),
+    "brain": (40, 80),
+    "liver": (60, 160),
+}
+
+# Seconds after which an annotator waiting on annotations leased to others asks again
+LEASED_RETRY_AFTER_SECONDS = 5
+
+# Upper bound on the number of annotations the label page may claim and prefetch ahead
+MAX_ANNOTATION_WINDOW = 16
+
+# Upper bound on the number of annotations a bulk label request may list by id. They are updated
+# in chunks of ids kept below SQLite's historical limit of 999 bound parameters per statement.
+MAX_BULK_ANNOTATIONS = 10_000
+BULK_LABEL_CHUNK_SIZE = 900
+
+# An image edited in place keeps its annotation's URLs, so browsers must revalidate every image.
+# Their ETag is the rendition key, which covers the source's mtime: reuse costs a 304.
+REVALIDATE_IMAGE_CACHE_CONTROL = "private, no-cache"
+
+# Background jobs, see app.domain.jobs. A job is queued until a worker picks it up and ends up
+# either done or failed.
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+JOB_INGEST_TASK = "ingest_task"
+JOB_EXPORT_TASK = "export_task"
+JOB_RESCAN_TASK = "rescan_task"
+# Kinds of job users may submit themselves, ingestion is only started by task creation
+SUBMITTABLE_JOB_KINDS = [JOB_EXPORT_TASK, JOB_RESCAN_TASK]
+
+# Relationship load profiles, see app.domain.loading
+LOAD_PROFILE_SUMMARY = "summary"
+LOAD_PROFILE_LABELING = "labeling"
+LOAD_PROFILE_EXPORT = "export"
+LOAD_PROFILE_ADMIN = "admin"
+
 DEFAULT_KEYBINDS_IN_ORDER = [
     "A",
     "S",
@@ -1,29 +1,211 @@
-import json
 import os
-from collections.abc import AsyncGenerator, Sequence
+from collections.abc import Awaitable, Callable, Sequence
+from contextlib import suppress
+from datetime import UTC, datetime, timedelta
 from pathlib import Path
 from typing import Annotated, Any
 from uuid import UUID
 
 from litestar import Controller, MediaType, Request, delete, get, patch, post
+from litestar.background_tasks import BackgroundTask
+from litestar.datastructures import ETag
 from litestar.di import Provide
 from litestar.enums import RequestEncodingType
-from litestar.exceptions import NotFoundException, PermissionDeniedException
-from litestar.params import Body
+from litestar.exceptions import (
+    HTTPException,
+    NotFoundException,
+    PermissionDeniedException,
+    ValidationException,
+)
+from litestar.params import Body, Parameter
 from litestar.response import File, Redirect, Response, Stream, Template
-from litestar.status_codes import HTTP_200_OK, HTTP_201_CREATED
+from litestar.status_codes import (
+    HTTP_200_OK,
+    HTTP_201_CREATED,
+    HTTP_202_ACCEPTED,
+    HTTP_204_NO_CONTENT,
+    HTTP_304_NOT_MODIFIED,
+    HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+)
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
+from app.config import get_settings
+from app.config.plugin_config import get_read_engine
 from app.domain import constants, urls
+from app.domain.backups import backup_scheduler
 from app.domain.constants import KEYBOARD_LAYOUT
 from app.domain.dependencies import (
     provide_annotations_service,
+    provide_jobs_service,
     provide_label_keybinds_service,
+    provide_task_files_service,
     provide_tasks_service,
     provide_users_service,
 )
-from app.domain.models import AnnotationUpdateData, TaskData, TaskUpdateData, UserData
-from app.domain.schema import Annotation, LabelKeybind, Task, User
-from app.domain.services import AnnotationService, LabelKeybindService, TaskService, UserService
+from app.domain.exports import (
+    EXPORT_COMPRESSIONS,
+    EXPORT_FORMATS,
+    ExportCursor,
+    get_export_cursor,
+    get_export_filename,
+    get_export_media_type,
+    stream_export,
+)
+from app.domain.identity import AuthUser, invalidate_user_identity
+from app.domain.jobs import job_runner
+from app.domain.journal import LabelWrite, label_journal
+from app.domain.metrics import METRICS_MEDIA_TYPE, metrics
+from app.domain.models import (
+    AnnotationBulkUpdateData,
+    AnnotationUpdateData,
+    JobData,
+    TaskData,
+    TaskUpdateData,
+    UserData,
+)
+from app.domain.renditions import (
+    ImageTooLargeError,
+    Rendition,
+    UndecodableImageError,
+    rendition_cache,
+)
+from app.domain.schema import Annotation, Job, LabelKeybind, Task, User
+from app.domain.services import (
+    AnnotationService,
+    JobService,
+    LabelKeybindService,
+    TaskFileService,
+    TaskService,
+    UserService,
+)
+from app.domain.tiles import Pyramid
+
+settings = get_settings()
+
+ANNOTATION_LEASE = timedelta(seconds=settings.app.ANNOTATION_LEASE_SECONDS)
+EXPORT_CURSOR_HEADER = "X-Export-Cursor"
+
+
+def validate_window(window: str) -> None:
+    if window not in constants.DICOM_WINDOW_PRESETS:
+        raise ValidationException(
+            f"Unknown window preset, expected one of {list(constants.DICOM_WINDOW_PRESETS)}"
+        )
+
+
+def validate_export_format(export_format: str, compress: str | None) -> None:
+    if export_format not in EXPORT_FORMATS:
+        raise ValidationException(f"Unknown export format, expected one of {list(EXPORT_FORMATS)}")
+    if compress is not None and compress not in EXPORT_COMPRESSIONS:
+        raise ValidationException(
+            f"Unknown compression, expected one of {sorted(EXPORT_COMPRESSIONS)}"
+        )
+
+
+def etag_matches(if_none_match: str | None, etag: ETag) -> bool:
+    """Weak comparison of an ETag against an If-None-Match header, as RFC 9110 specifies."""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag.to_header() in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+
+async def serve_cached_image(
+    request: Request[Any, Any, Any],
+    key: str,
+    load: Callable[[], Awaitable[Rendition]],
+    headers: dict[str, str],
+) -> File | Response[None]:
+    """
+    Serve an image with `key` as its strong ETag. When the client already holds it a 304 is
+    returned without calling `load`, so the image is neither rendered nor opened.
+    """
+    etag = ETag(value=key)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(
+            content=None,
+            status_code=HTTP_304_NOT_MODIFIED,
+            headers={**headers, "etag": etag.to_header()},
+        )
+
+    image = await load()
+    return File(path=image.path, media_type=image.media_type, etag=etag, headers=headers)
+
+
+async def serve_rendition(  # noqa: PLR0913 (too many arguments)
+    request: Request[Any, Any, Any],
+    source: Path,
+    variant: str,
+    cache_control: str,
+    *,
+    window: str = "default",
+    annotation_id: int | None = None,
+) -> File | Response[None]:
+    """
+    Serve the rendition of an image, with an ETag derived from the file's identity. An image that
+    cannot be decoded is answered with a 415, which still names its annotation so the label page
+    can move past it.
+    """
+    key = rendition_cache.get_key(source, variant, window)
+    headers = {"cache-control": cache_control}
+    if annotation_id is not None:
+        # the same file may be annotated in several tasks, cached headers must not mix them up
+        key = f"{key}-{annotation_id}"
+        headers["X-Metadata-AnnotationID"] = str(annotation_id)
+
+    async def load() -> Rendition:
+        try:
+            return await rendition_cache.get(source, variant, window)
+        except UndecodableImageError as e:
+            raise HTTPException(
+                detail="Image cannot be decoded",
+                status_code=HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                headers=headers,
+            ) from e
+
+    return await serve_cached_image(request, key, load, headers)
+
+
+async def get_pyramid(source: Path) -> Pyramid:
+    """
+    Get the Deep Zoom pyramid layout of an image. An image too large to tile is answered with a
+    415, and the label page keeps showing its display rendition.
+    """
+    try:
+        return await rendition_cache.get_pyramid(source)
+    except ImageTooLargeError as e:
+        raise HTTPException(
+            detail="Image is too large to tile", status_code=HTTP_415_UNSUPPORTED_MEDIA_TYPE
+        ) from e
+
+
+def serialize_job(job: Job) -> dict[str, Any]:
+    return {
+        "id": str(job.id),
+        "kind": job.kind,
+        "status": job.status,
+        "task_id": str(job.task_id) if job.task_id is not None else None,
+        "progress": job.progress,
+        "error": job.error,
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at is not None else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at is not None else None,
+        "url": f"{urls.GET_JOB}?job_id={job.id}",
+        "result_url": f"{urls.GET_JOB_RESULT}?job_id={job.id}"
+        if job.status == constants.JOB_DONE and job.result is not None
+        else None,
+    }
+
+
+async def refresh_task_catalogs(engine: AsyncEngine, task_ids: Sequence[UUID]) -> None:
+    """Rescan the root folders of tasks that changed since their last scan, off the hot path."""
+    async with (
+        AsyncSession(engine) as db_session,
+        TaskFileService.new(session=db_session) as task_files_service,
+    ):
+        await task_files_service.refresh_catalogs(task_ids)
+        await db_session.commit()
 
 
 class PageController(Controller):
@@ -32,6 +214,8 @@ class PageController(Controller):
     dependencies = {
         "users_service": Provide(provide_users_service),
         "tasks_service": Provide(provide_tasks_service),
+        "annotations_service": Provide(provide_annotations_service),
+        "task_files_service": Provide(provide_task_files_service),
     }
 
     @get(
@@ -67,76 +251,49 @@ class PageController(Controller):
         path=urls.TASK_PANEL_PAGE,
         operation_id="getTaskPanelPage",
         name="frontend:panel_page",
+        load_profile=constants.LOAD_PROFILE_SUMMARY,
+        uses_writer=True,  # catalogs tasks never scanned
         status_code=HTTP_200_OK,
     )
     async def panel_page(
         self,
         tasks_service: TaskService,
-        request: Request[User, Any, Any],
+        task_files_service: TaskFileService,
+        request: Request[AuthUser, Any, Any],
     ) -> Template:
         """Serve task management page."""
 
-        user = request.user
-        user_id = user.id
-        # user_id = request.session.get("user_id")
-        # user = await users_service.get(user_id)  # exception here means that authentication failed
-        user_tasks: list[Task] = user.assigned_tasks
+        user_id = request.user.id
 
         # Populate assigned tasks list
-        task_info_as_dicts: list[dict[str, Any]] = []
-        for task in user_tasks:
-            task_annotations = task.annotations
-            selected_filepaths = [Path(a.filepath).resolve() for a in task_annotations]
-            files_to_annotate = [
-                {
-                    "path": str(f),
-                    "is_selected": Path(f).resolve() in selected_filepaths,
-                }
-                for f in list(Path(task.root_folder).iterdir())
-                if f.suffix in constants.IMAGE_EXTENSIONS
-            ]
-            creator_name = task.creator.username if task.creator is not None else "Unknown"
-            task_info_as_dicts.append(
-                {
-                    "labeled_count": len([a for a in task_annotations if a.labeled]),
-                    "total_count": len(task_annotations),
-                    "creator_name": creator_name,
-                    "total": len(task_annotations),
-                    "completed": len([a for a in task_annotations if a.labeled]),
-                    "files": files_to_annotate,
-                    **task.to_dict(),
-                }
-            )
+        user_tasks = await tasks_service.get_task_summaries(user_id, assigned=True)
+        user_task_ids = [t["id"] for t in user_tasks]
+        # Only tasks that were never catalogued are scanned here, changes to the others are picked
+        # up in the background after this response and show on the next load
+        await task_files_service.refresh_catalogs(user_task_ids, unscanned_only=True)
+        files_by_task = await task_files_service.get_files_by_task(user_task_ids)
+        task_info_as_dicts: list[dict[str, Any]] = [
+            {
+                "total": task["total_count"],
+                "completed": task["labeled_count"],
+                "files": files_by_task[task["id"]],
+                **task,
+            }
+            for task in user_tasks
+        ]
 
         # Populate user's label keybinds for each assigned task
-        label_keybinds_by_task: list[list[dict[str, str]]] = []
-        for task in user_tasks:
-            label_keybinds: list[LabelKeybind] = task.label_keybinds
-            label_keybinds_by_task.append(
-                [
-                    {"label": lk.label, "keybind": lk.keybind, "id": str(lk.id)}
-                    for lk in label_keybinds
-                    if lk.user_id == user_id
-                ]
-            )
+        label_keybinds_by_task_id = await tasks_service.get_label_keybinds_by_task(
+            user_id, user_task_ids
+        )
+        label_keybinds_by_task = [label_keybinds_by_task_id[tid] for tid in user_task_ids]
 
         # Populate global tasks list
-        all_tasks: Sequence[Task] = await tasks_service.get_all_tasks()
-        user_assigned_task_ids = [t.id for t in user.assigned_tasks]
-        avail_tasks = [t for t in all_tasks if t.id not in user_assigned_task_ids]
-        global_task_info_as_dicts: list[dict[str, str | int]] = []
-        for task in avail_tasks:
-            creator_name = task.creator.username if task.creator is not None else "Unknown"
-            global_task_info_as_dicts.append(
-                {
-                    "labeled_count": len([a for a in task.annotations if a.labeled]),
-                    "total_count": len(task.annotations),
-                    "creator_name": creator_name,
-                    "total": len(task.annotations),
-                    "completed": len([a for a in task.annotations if a.labeled]),
-                    **task.to_dict(),
-                }
-            )
+        avail_tasks = await tasks_service.get_task_summaries(user_id, assigned=False)
+        global_task_info_as_dicts: list[dict[str, Any]] = [
+            {"total": task["total_count"], "completed": task["labeled_count"], **task}
+            for task in avail_tasks
+        ]
 
         return Template(
             template_name="panel/panel.html.jinja2",
@@ -147,18 +304,25 @@ class PageController(Controller):
                 "existing_task_route": urls.ASSIGN_TASK,
                 "task_label_keybinds": label_keybinds_by_task,
             },
+            background=BackgroundTask(
+                refresh_task_catalogs,
+                request.app.state.get(settings.db.ENGINE_DEPENDENCY_KEY),
+                user_task_ids,
+            ),
         )
 
     @get(
         path=urls.LABEL_PAGE,
         operation_id="getLabelPage",
         name="frontend:label_page",
+        load_profile=constants.LOAD_PROFILE_SUMMARY,
         status_code=HTTP_200_OK,
     )
     async def label_page(
         self,
-        task_id: str,
+        task_id: UUID,
         tasks_service: TaskService,
+        request: Request[AuthUser, Any, Any],
     ) -> Template:
         """Serve label page."""
 
@@ -169,19 +333,19 @@ class PageController(Controller):
                 index = -1
             return index
 
-        # TODO: add check to see if task id is within user_id?
-        task = await tasks_service.get_one(id=task_id)
-        lks = task.label_keybinds
-        annotations = task.annotations
-        labeled = len([a for a in annotations if a.labeled])
-        total = len(annotations)
+        user_id = request.user.id
+        task = await tasks_service.get_task_summary(user_id, task_id)
+        lks = (await tasks_service.get_label_keybinds_by_task(user_id, [task_id]))[task_id]
+        labeled = task["labeled_count"]
+        total = task["total_count"]
 
-        label_keybinds = [{"label": lk.label, "keybind": lk.keybind} for lk in lks]
+        label_keybinds = [{"label": lk["label"], "keybind": lk["keybind"]} for lk in lks]
         label_keybinds.sort(key=lambda x: sort_by_keyboard_layout(x["keybind"]))
         context = {
+            "task_id": task_id,
             "labeled": labeled,
             "total": total,
-            "progress_percent": round((labeled / total) * 100, 2),
+            "progress_percent": round((labeled / total) * 100, 2) if total > 0 else 0,
             "label_keybinds": label_keybinds,
         }
 
@@ -191,14 +355,27 @@ class PageController(Controller):
         path=urls.TASK_THUMBNAIL,
         operation_id="getTaskThumbnail",
         name="frontend:task_thumbnail",
+        query_budget=4,
+        load_profile=constants.LOAD_PROFILE_SUMMARY,
+        serves_images=True,
         status_code=HTTP_200_OK,
     )
-    async def get_task_thumbnail(self, task_id: str, tasks_service: TaskService) -> File:
-        task = await tasks_service.get_one(id=task_id)
-        annotations = task.annotations
-        path_to_first_image = annotations[0].filepath
-
-        return File(path=Path(path_to_first_image).resolve(), media_type="image/png")
+    async def get_task_thumbnail(
+        self,
+        task_id: str,
+        annotations_service: AnnotationService,
+        request: Request[AuthUser, Any, Any],
+    ) -> File | Response[None] | NotFoundException:
+        path_to_first_image = await annotations_service.get_first_filepath(UUID(task_id))
+        if path_to_first_image is None:
+            raise NotFoundException("Task has no images!")
+
+        return await serve_rendition(
+            request,
+            Path(path_to_first_image).resolve(),
+            "thumbnail",
+            constants.REVALIDATE_IMAGE_CACHE_CONTROL,
+        )
 
 
 class UserController(Controller):
@@ -214,7 +391,9 @@ class UserController(Controller):
         path=urls.CHECK_USERNAME,
         operation_id="checkUsername",
         name="user:check_username",
+        query_budget=3,
         exclude_from_auth=True,
+        load_profile=constants.LOAD_PROFILE_SUMMARY,
         summary="Check if username is available",
         status_code=HTTP_200_OK,
     )
@@ -229,7 +408,9 @@ class UserController(Controller):
         path=urls.CREATE_USER,
         operation_id="createUser",
         name="user:create",
+        query_budget=4,
         exclude_from_auth=True,
+        load_profile=constants.LOAD_PROFILE_SUMMARY,
         summary="Create new user",
         status_code=HTTP_201_CREATED,
     )
@@ -237,7 +418,7 @@ class UserController(Controller):
         self,
         users_service: UserService,
         data: Annotated[UserData, Body(media_type=RequestEncodingType.JSON)],
-        request: Request[User, Any, Any],
+        request: Request[AuthUser, Any, Any],
     ) -> Response[dict[str, str]]:
         """Create a new user."""
         user = await users_service.create(
@@ -262,7 +443,9 @@ class UserController(Controller):
         path=urls.LOGIN_USER,
         operation_id="loginUser",
         name="user:login",
+        query_budget=4,
         exclude_from_auth=True,
+        load_profile=constants.LOAD_PROFILE_SUMMARY,
         summary="Login user",
         status_code=HTTP_200_OK,
     )
@@ -289,6 +472,7 @@ class TaskController(Controller):
         "tasks_service": Provide(provide_tasks_service),
         "annotations_service": Provide(provide_annotations_service),
         "label_keybinds_service": Provide(provide_label_keybinds_service),
+        "jobs_service": Provide(provide_jobs_service),
     }
 
     @post(
@@ -296,18 +480,23 @@ class TaskController(Controller):
         operation_id="createTask",
         name="task:create",
         exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_ADMIN,
+        after_response=invalidate_user_identity,
         summary="Create new task",
         status_code=HTTP_201_CREATED,
     )
     async def create(  # noqa: PLR0913 (too many arguments)
         self,
         tasks_service: TaskService,
-        annotations_service: AnnotationService,
         label_keybinds_service: LabelKeybindService,
+        jobs_service: JobService,
         data: Annotated[TaskData, Body(media_type=RequestEncodingType.JSON)],
-        request: Request[User, Any, Any],
+        request: Request[AuthUser, Any, Any],
     ) -> Response[dict[str, str]]:
-        """Create a new task."""
+        """
+        Create a new task. Its annotations are created from the root folder by a background job,
+        which the client polls for progress.
+        """
         creator_user_id = request.user.id
         new_task_id = (
             await tasks_service.create(
@@ -334,45 +523,46 @@ class TaskController(Controller):
             auto_commit=True,
             auto_expunge=False,
         )
-        root_folder = Path(data.root)
-        files_to_annotate = [
-            fl.resolve().as_posix()
-            for fl in root_folder.iterdir()  # cannot use new_task.root_folder since not in ORM call
-            if fl.suffix in constants.IMAGE_EXTENSIONS
-        ]
-        new_annotations = await annotations_service.create_many(
-            data=[
-                Annotation(
-                    label=None,
-                    labeled=False,
-                    labeled_by=None,
-                    filepath=fl,
+        job_id = (
+            await jobs_service.create(
+                data=Job(
+                    kind=constants.JOB_INGEST_TASK,
+                    status=constants.JOB_QUEUED,
+                    user_id=creator_user_id,
                     task_id=new_task_id,
-                )
-                for fl in files_to_annotate
-            ],
-            auto_commit=True,
-            auto_expunge=False,
-        )
+                ),
+                auto_commit=True,
+                auto_expunge=True,
+            )
+        ).id
 
         task_obj = await tasks_service.get_one(id=new_task_id)
 
         # Assign task to creator
         task_obj.contributors.append(task_obj.creator)  # can't use creator_user: already in session
 
-        # Assign annotations to task
-        task_obj.annotations.extend(new_annotations)
-
         # label keybinds backpopulates to user so no need to assign
         return Response(
-            content={"message": "Task successfully created"}, status_code=HTTP_201_CREATED
+            content={
+                "message": "Task successfully created",
+                "job_id": str(job_id),
+                "job_url": f"{urls.GET_JOB}?job_id={job_id}",
+            },
+            status_code=HTTP_201_CREATED,
+            # queued once the response is sent, when the task is committed
+            background=BackgroundTask(
+                job_runner.submit, request.app.state.get(settings.db.ENGINE_DEPENDENCY_KEY), job_id
+            ),
         )
 
     @post(
         path=urls.ASSIGN_TASK,
         operation_id="assignTask",
         name="task:assign_task",
+        query_budget=14,
         exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_ADMIN,
+        after_response=invalidate_user_identity,
         summary="Assign task to current user",
         status_code=HTTP_200_OK,
     )
@@ -380,9 +570,11 @@ class TaskController(Controller):
         self,
         users_service: UserService,
         tasks_service: TaskService,
+        *,
+        annotations_service: AnnotationService,
         label_keybinds_service: LabelKeybindService,
         data: dict[str, list[str]],
-        request: Request[User, Any, Any],
+        request: Request[AuthUser, Any, Any],
     ) -> Response[dict[str, str]]:
         """Assign task to current user."""
 
@@ -391,7 +583,7 @@ class TaskController(Controller):
         tasks = await tasks_service.get_many_by_id(data["tasks_to_add_ids"])
 
         tasks_to_update: list[Task] = []
-        new_lks: list[Sequence[LabelKeybind]] = []
+        lks_to_create: list[LabelKeybind] = []
         for task in tasks:
             # Skip creation of default keybinds for task if task already contains
             # any label keybinds previously assigned to user
@@ -400,7 +592,6 @@ class TaskController(Controller):
             # Get the unique set of labels for this task across all previous users
             label_set = list(set([lk.label.lower() for lk in task.label_keybinds]))
 
-            lks_to_create: list[LabelKeybind] = []
             for i, label in enumerate(label_set):
                 lks_to_create.append(
                     LabelKeybind(
@@ -410,36 +601,44 @@ class TaskController(Controller):
                         task_id=task.id,
                     )
                 )
-
-            # The readability of the code below is worth the performance hit (to me) of using
-            # create_many multiple times inside the for loop rather than collecting all of the
-            # LabelKeybind objects to create and then creating them all at once.
-            new_lks.append(
-                await label_keybinds_service.create_many(
-                    data=lks_to_create, auto_commit=True, auto_expunge=True
-                )
-            )
             tasks_to_update.append(task)
 
-        for task, lk in zip(tasks_to_update, new_lks, strict=False):
-            task.label_keybinds.extend(lk)
+        # The keybinds of every task are created at once, a create_many per task is an N+1
+        new_lks: Sequence[LabelKeybind] = []
+        if len(lks_to_create) > 0:
+            new_lks = await label_keybinds_service.create_many(
+                data=lks_to_create, auto_commit=True, auto_expunge=True
+            )
+        for task in tasks_to_update:
+            task.label_keybinds.extend(lk for lk in new_lks if lk.task_id == task.id)
 
         user.assigned_tasks.extend(tasks)
-        return Response(content={"message": "Task successfully assigned"}, status_code=HTTP_200_OK)
+        prewarm_paths = await annotations_service.get_prewarm_paths(
+            [task.id for task in tasks], settings.rendition.PREWARM_COUNT
+        )
+        return Response(
+            content={"message": "Task successfully assigned"},
+            status_code=HTTP_200_OK,
+            background=BackgroundTask(rendition_cache.prewarm, prewarm_paths),
+        )
 
     @delete(
         path=urls.UNASSIGN_TASK,
         operation_id="unassignTask",
         name="task:unassign_task",
+        query_budget=8,
         exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_ADMIN,
+        after_response=invalidate_user_identity,
         summary="Unassign current user from selected task",
         status_code=HTTP_200_OK,
     )
     async def unassign_task(
         self,
         users_service: UserService,
+        annotations_service: AnnotationService,
         task_id: str,
-        request: Request[User, Any, Any],
+        request: Request[AuthUser, Any, Any],
     ) -> Response[dict[str, str]] | NotFoundException:
         """Delete a specified task from current user."""
         # TODO: figure out why middleware throws an exception if you run just getting request.user
@@ -452,6 +651,7 @@ class TaskController(Controller):
             msg = "Task not found in user's task list"
             raise NotFoundException(msg) from exc
 
+        await annotations_service.release_claims(UUID(task_id), user_id)
         return Response(content={"message": "Task successfully deleted"}, status_code=HTTP_200_OK)
 
     @patch(
@@ -459,13 +659,15 @@ class TaskController(Controller):
         operation_id="updateTask",
         name="task:update_task",
         exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_ADMIN,
+        after_response=invalidate_user_identity,
         summary="Update task with new keybinds and annotations",
         status_code=HTTP_200_OK,
     )
     async def update_task(  # noqa: PLR0913 (too many arguments 7 > 5)
         self,
         tasks_service: TaskService,
-        request: Request[User, Any, Any],
+        request: Request[AuthUser, Any, Any],
         data: Annotated[TaskUpdateData, Body(media_type=RequestEncodingType.JSON)],
         task_id: UUID,
     ) -> Response[dict[str, str | int]]:
@@ -507,48 +709,139 @@ class TaskController(Controller):
         operation_id="exportTask",
         name="task:export_annotations",
         exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_EXPORT,
         summary="Export annotations for task",
-        media_type=MediaType.TEXT,
+        description=(
+            "Formats are json (an indented array), jsonl and csv, optionally gzipped. The "
+            f"{EXPORT_CURSOR_HEADER} response header is a cursor to pass as `since` to a later "
+            "export, which then only has the annotations labeled, relabeled or unlabeled in "
+            "between. Unlabeled annotations come with a null label."
+        ),
         status_code=HTTP_200_OK,
     )
-    async def export_annotations(
-        self, users_service: UserService, tasks_service: TaskService, task_id: str
+    async def export_annotations(  # noqa: PLR0913 (too many arguments)
+        self,
+        tasks_service: TaskService,
+        task_id: UUID,
+        request: Request[AuthUser, Any, Any],
+        *,
+        export_format: Annotated[str, Parameter(query="format")] = "json",
+        compress: str | None = None,
+        since: str | None = None,
     ) -> Stream:
-        task = await tasks_service.get_one(id=task_id)
-        title = task.title
-        annotations = task.annotations
-        labeled_annotations = [a for a in annotations if a.labeled]
-        labeled_annotations = sorted(labeled_annotations, key=lambda a: a.id)
-        labeled_annotations = [
-            {
-                "task_title": title,
-                "task_id": a.task_id,
-                "annotation_id": a.id,
-                "labeled_by": (await users_service.get_one(id=a.labeled_by)).username
-                if a.labeled_by
-                else "Unknown",
-                "created_at": a.created_at,
-                "updated_at": a.updated_at,
-                "filepath": a.filepath,
-                "label": a.label,
-            }
-            for a in labeled_annotations
-        ]
+        validate_export_format(export_format, compress)
+        since_cursor = ExportCursor.decode(since) if since is not None else None
+        title = await tasks_service.get_title(task_id)
+        cursors = [since_cursor, await get_export_cursor(tasks_service.repository.session, task_id)]
+        next_cursor = max((c for c in cursors if c is not None), default=None)
+
+        engine = get_read_engine(request.app.state)
+        filename = get_export_filename(title, export_format, compress)
+        headers = {"Content-Disposition": f"attachment; filename={filename}"}
+        if next_cursor is not None:
+            headers[EXPORT_CURSOR_HEADER] = next_cursor.encode()
+        return Stream(
+            stream_export(
+                engine,
+                task_id,
+                title,
+                name=export_format,
+                compress=compress,
+                since=since_cursor,
+                until=next_cursor,
+            ),
+            media_type=get_export_media_type(export_format, compress),
+            headers=headers,
+        )
 
-        async def iter_content() -> AsyncGenerator[str, None]:
-            yield "[\n"
-            for i, annotation in enumerate(labeled_annotations):
-                jsonified = json.dumps(annotation, indent=4, default=lambda x: str(x))
-                # Add a comma to the end if it's not the last item
-                jsonified += "," if i < len(labeled_annotations) - 1 else ""
-                # Split the JSON string into lines and prepend each line with four spaces
-                jsonified = "\n".join("    " + line for line in jsonified.split("\n"))
-                yield jsonified + "\n"
-            yield "]\n"
 
-        return Stream(
-            iter_content(),
-            headers={"Content-Disposition": f"attachment; filename={title}_annotations.json"},
+class JobController(Controller):
+    """Controller for submitting and polling background jobs."""
+
+    dependencies = {
+        "tasks_service": Provide(provide_tasks_service),
+        "jobs_service": Provide(provide_jobs_service),
+    }
+
+    @post(
+        path=urls.SUBMIT_JOB,
+        operation_id="submitJob",
+        name="job:submit",
+        query_budget=5,
+        exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_SUMMARY,
+        summary="Submit a background job",
+        status_code=HTTP_202_ACCEPTED,
+    )
+    async def submit(
+        self,
+        tasks_service: TaskService,
+        jobs_service: JobService,
+        data: Annotated[JobData, Body(media_type=RequestEncodingType.JSON)],
+        request: Request[AuthUser, Any, Any],
+    ) -> Response[dict[str, Any]]:
+        """Queue a job on a task assigned to the current user."""
+        user_id = request.user.id
+        await tasks_service.get_task_summary(user_id, data.task_id)  # raises if not assigned
+
+        job = await jobs_service.create(
+            data=Job(
+                kind=data.kind, status=constants.JOB_QUEUED, user_id=user_id, task_id=data.task_id
+            ),
+            auto_commit=True,
+            auto_refresh=True,
+        )
+        return Response(
+            content=serialize_job(job),
+            status_code=HTTP_202_ACCEPTED,
+            background=BackgroundTask(
+                job_runner.submit, request.app.state.get(settings.db.ENGINE_DEPENDENCY_KEY), job.id
+            ),
+        )
+
+    @get(
+        path=urls.GET_JOB,
+        operation_id="getJob",
+        name="job:get",
+        query_budget=3,
+        exclude_from_auth=False,
+        summary="Get the status of a background job",
+        status_code=HTTP_200_OK,
+    )
+    async def get_job(
+        self, jobs_service: JobService, job_id: UUID, request: Request[AuthUser, Any, Any]
+    ) -> Response[dict[str, Any]]:
+        job = await jobs_service.get_user_job(job_id, request.user.id)
+        return Response(content=serialize_job(job), headers={"Cache-Control": "no-store"})
+
+    @get(
+        path=urls.GET_JOB_RESULT,
+        operation_id="getJobResult",
+        name="job:get_result",
+        exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_EXPORT,
+        summary="Download the output of a finished background job",
+        status_code=HTTP_200_OK,
+    )
+    async def get_job_result(
+        self,
+        tasks_service: TaskService,
+        jobs_service: JobService,
+        job_id: UUID,
+        request: Request[AuthUser, Any, Any],
+    ) -> File:
+        job = await jobs_service.get_user_job(job_id, request.user.id)
+        if job.status != constants.JOB_DONE or job.result is None:
+            raise NotFoundException("Job has no result!")
+
+        title = "task"
+        if job.task_id is not None:
+            with suppress(NotFoundException):
+                title = await tasks_service.get_title(job.task_id)
+        return File(
+            path=job.result,
+            filename=get_export_filename(title),
+            content_disposition_type="attachment",
         )
 
 
@@ -566,58 +859,203 @@ class AnnotationController(Controller):
         path=urls.GET_NEXT_ANNOTATION,
         operation_id="getNextAnnotation",
         name="annotation:get_next",
+        query_budget=6,
         exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_LABELING,
+        uses_writer=True,  # claims the annotation
+        serves_images=True,
         summary="Get next annotation to label",
         status_code=HTTP_200_OK,
     )
-    async def get_next_annotation(self, task_id: str, tasks_service: TaskService) -> File:
-        task = await tasks_service.get_one(id=task_id)
-        unlabeled_annotations = [a for a in task.annotations if not a.labeled]
+    async def get_next_annotation(
+        self,
+        task_id: str,
+        annotations_service: AnnotationService,
+        request: Request[AuthUser, Any, Any],
+        window: str = "default",
+    ) -> File | Response[None]:
+        validate_window(window)
+        coerced_task_id = UUID(task_id)
+        # Annotations whose label is still in the write-behind journal are labeled already
+        pending_ids = label_journal.pending_ids(coerced_task_id)
+        next_annotation = await annotations_service.claim_next(
+            coerced_task_id, request.user.id, ANNOTATION_LEASE, exclude_ids=pending_ids
+        )
+        # Release SQLite's write lock before rendering, which may take a while for large images
+        await annotations_service.repository.session.commit()
+
+        if next_annotation is None and (
+            await annotations_service.get_next_unlabeled(coerced_task_id, exclude_ids=pending_ids)
+            is not None
+        ):
+            # Every remaining annotation is leased to another contributor, an annotation is never
+            # handed to two of them: the client asks again once a lease may have been released
+            return Response(
+                content=None,
+                status_code=HTTP_204_NO_CONTENT,
+                headers={
+                    "Retry-After": str(constants.LEASED_RETRY_AFTER_SECONDS),
+                    "cache-control": "no-store",
+                },
+            )
 
-        if len(unlabeled_annotations) == 0:
+        if next_annotation is None:
             return File(
                 path=Path("front/assets/images/task-completed.png").resolve(),
                 media_type="image/png",
-                headers={"X-Metadata-AnnotationID": "-999"},
+                headers={
+                    "X-Metadata-AnnotationID": "-999",
+                    "cache-control": constants.REVALIDATE_IMAGE_CACHE_CONTROL,
+                },
             )
 
-        next_annotation = unlabeled_annotations[0]
-        return File(
-            path=Path(next_annotation.filepath).resolve(),
-            media_type="image/png",
-            headers={"X-Metadata-AnnotationID": str(next_annotation.id)},
+        # Which annotation comes next changes between calls, so the image must be revalidated
+        return await serve_rendition(
+            request,
+            Path(next_annotation.filepath).resolve(),
+            "display",
+            constants.REVALIDATE_IMAGE_CACHE_CONTROL,
+            window=window,
+            annotation_id=next_annotation.id,
         )
 
+    @get(
+        path=urls.GET_ANNOTATION_WINDOW,
+        operation_id="getAnnotationWindow",
+        name="annotation:get_window",
+        query_budget=6,
+        exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_LABELING,
+        uses_writer=True,  # claims the annotations
+        summary="Claim the next annotations to label so their images can be prefetched",
+        status_code=HTTP_200_OK,
+    )
+    async def get_annotation_window(
+        self,
+        task_id: str,
+        annotations_service: AnnotationService,
+        request: Request[AuthUser, Any, Any],
+        count: int = 4,
+    ) -> list[dict[str, str | int]]:
+        size = max(1, min(count, constants.MAX_ANNOTATION_WINDOW))
+        coerced_task_id = UUID(task_id)
+        annotations = await annotations_service.claim_window(
+            coerced_task_id,
+            request.user.id,
+            ANNOTATION_LEASE,
+            size,
+            exclude_ids=label_journal.pending_ids(coerced_task_id),
+        )
+
+        return [{"annotation_id": a.id, "filename": Path(a.filepath).name} for a in annotations]
+
     @get(
         path=urls.GET_ANY_ANNOTATION,
         operation_id="getAnnotation",
         name="annotation:get",
+        query_budget=4,
         exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_LABELING,
+        serves_images=True,
         summary="Get any annotation, specified by ID",
         status_code=HTTP_200_OK,
     )
-    async def get_annotation(
-        self, tasks_service: TaskService, task_id: str, annotation_id: str
-    ) -> File:
-        int_annotation_id = int(annotation_id)
-        task = await tasks_service.get_one(id=task_id)
-        next_annotations: list[Annotation] = [
-            a for a in task.annotations if a.id == int_annotation_id
-        ]
-        if len(next_annotations) == 0:
+    async def get_annotation(  # noqa: PLR0913 (too many arguments)
+        self,
+        annotations_service: AnnotationService,
+        task_id: str,
+        annotation_id: str,
+        request: Request[AuthUser, Any, Any],
+        window: str = "default",
+    ) -> File | Response[None]:
+        validate_window(window)
+        next_annotation = await annotations_service.get_task_annotation(
+            UUID(task_id), int(annotation_id)
+        )
+        if next_annotation is None:
             raise PermissionDeniedException("Annotation does not belong to task!")
-        next_annotation = next_annotations[0]
-        return File(
-            path=Path(next_annotation.filepath).resolve(),
-            media_type="image/png",
-            headers={"X-Metadata-AnnotationID": str(next_annotation.id)},
+        return await serve_rendition(
+            request,
+            Path(next_annotation.filepath).resolve(),
+            "display",
+            constants.REVALIDATE_IMAGE_CACHE_CONTROL,
+            window=window,
+            annotation_id=next_annotation.id,
+        )
+
+    @get(
+        path=urls.GET_ANNOTATION_DZI,
+        operation_id="getAnnotationDzi",
+        name="annotation:get_dzi",
+        query_budget=4,
+        exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_LABELING,
+        summary="Get the Deep Zoom descriptor of an annotation's image",
+        status_code=HTTP_200_OK,
+        media_type=MediaType.XML,
+    )
+    async def get_annotation_dzi(
+        self, annotations_service: AnnotationService, task_id: str, annotation_id: str
+    ) -> Response[str]:
+        annotation = await annotations_service.get_task_annotation(
+            UUID(task_id), int(annotation_id)
+        )
+        if annotation is None:
+            raise PermissionDeniedException("Annotation does not belong to task!")
+        pyramid = await get_pyramid(Path(annotation.filepath).resolve())
+
+        return Response(
+            content=pyramid.to_dzi(),
+            media_type=MediaType.XML,
+            headers={"cache-control": constants.REVALIDATE_IMAGE_CACHE_CONTROL},
+        )
+
+    @get(
+        path=urls.GET_ANNOTATION_TILE,
+        operation_id="getAnnotationTile",
+        name="annotation:get_tile",
+        query_budget=4,
+        exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_LABELING,
+        serves_images=True,
+        summary="Get a Deep Zoom tile of an annotation's image",
+        status_code=HTTP_200_OK,
+    )
+    async def get_annotation_tile(  # noqa: PLR0913 (too many arguments)
+        self,
+        annotations_service: AnnotationService,
+        task_id: str,
+        annotation_id: str,
+        *,
+        level: int,
+        col: int,
+        row: int,
+        request: Request[AuthUser, Any, Any],
+    ) -> File | Response[None]:
+        annotation = await annotations_service.get_task_annotation(
+            UUID(task_id), int(annotation_id)
+        )
+        if annotation is None:
+            raise PermissionDeniedException("Annotation does not belong to task!")
+        source = Path(annotation.filepath).resolve()
+        pyramid = await get_pyramid(source)
+        if not pyramid.has_tile(level, col, row):
+            raise NotFoundException("Tile does not exist!")
+
+        return await serve_cached_image(
+            request,
+            rendition_cache.get_tile_key(source, level, col, row),
+            lambda: rendition_cache.get_tile(source, pyramid, level, col, row),
+            {"cache-control": constants.REVALIDATE_IMAGE_CACHE_CONTROL},
         )
 
     @patch(
         path=urls.UPDATE_ANNOTATION,
         operation_id="updateAnnotation",
         name="annotation:update",
+        query_budget=7,
         exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_LABELING,
         summary="Update annotation with label from keybind",
         status_code=HTTP_200_OK,
         media_type="application/json",
@@ -629,28 +1067,108 @@ class AnnotationController(Controller):
         data: Annotated[AnnotationUpdateData, Body(media_type=RequestEncodingType.JSON)],
         task_id: str,
         annotation_id: str,
-        request: Request[User, Any, Any],
+        *,
+        request: Request[AuthUser, Any, Any],
     ) -> dict[str, str | int | float]:
         coerced_annotation_id = int(annotation_id)
         coerced_task_id = UUID(task_id)
 
-        user_tasks = request.user.assigned_tasks
-        task = await tasks_service.get_one(id=coerced_task_id)
-        if task.id not in [t.id for t in user_tasks]:
+        if coerced_task_id not in request.user.assigned_task_ids:
             raise PermissionDeniedException("Task does not belong to user!")
 
-        if coerced_annotation_id > 0:  # negative value is sent as response for all annos complete
+        if coerced_annotation_id > 0 and label_journal.enabled:
+            await annotations_service.get_one(id=coerced_annotation_id)  # 404 for unknown ids
+            write = LabelWrite(
+                annotation_id=coerced_annotation_id,
+                task_id=coerced_task_id,
+                user_id=request.user.id,
+                label=data.label or None,
+                at=datetime.now(UTC),
+            )
+            await label_journal.record(
+                request.app.state.get(settings.db.ENGINE_DEPENDENCY_KEY), write
+            )
+        elif coerced_annotation_id > 0:  # negative value is sent as response for all annos complete
             annotation = await annotations_service.get_one(id=coerced_annotation_id)
             annotation.label = data.label
             annotation.labeled = bool(data.label)  # if label is empty string or None, it is False
             annotation.labeled_by = request.user.id
+            if annotation.labeled:
+                annotation.claimed_by = None
+                annotation.lease_expires_at = None
+            else:  # an undone label goes back to the annotator who undid it
+                annotation.claimed_by = request.user.id
+                annotation.lease_expires_at = datetime.now(UTC) + ANNOTATION_LEASE
+
+        if not label_journal.enabled:  # otherwise leases are renewed when the journal is flushed
+            await annotations_service.renew_leases(
+                coerced_task_id, request.user.id, ANNOTATION_LEASE
+            )
 
-        task_annotations = task.annotations
-        t1 = len([t for t in task_annotations if t.labeled])
-        progress = round(((t1) / (len(task_annotations))) * 100, 2)
+        # Counters are updated by the annotation's UPDATE, flushed before they are read
+        t1, total, user_labeled = await tasks_service.get_progress(coerced_task_id, request.user.id)
+        labeled_delta, user_delta = await label_journal.get_progress_delta(
+            annotations_service.repository.session, coerced_task_id, request.user.id
+        )
+        t1, user_labeled = t1 + labeled_delta, user_labeled + user_delta
+        progress = round(t1 / total * 100, 2) if total > 0 else 0
         progress = 100 if progress > 100 else progress  # noqa: PLR2004 (replace 100 with const var)
 
-        return {"total": len(task_annotations), "labeled": t1, "progress": progress}
+        return {
+            "total": total,
+            "labeled": t1,
+            "labeled_by_user": user_labeled,
+            "progress": progress,
+        }
+
+    @patch(
+        path=urls.BULK_UPDATE_ANNOTATIONS,
+        operation_id="bulkUpdateAnnotations",
+        name="annotation:bulk_update",
+        query_budget=5,
+        exclude_from_auth=False,
+        load_profile=constants.LOAD_PROFILE_LABELING,
+        summary="Apply one label to many annotations of a task",
+        description=(
+            "Annotations are selected by `annotation_ids`, or by `filter` on whether they are "
+            "labeled and on their current label. An empty label undoes their labels. Ids of "
+            "annotations of other tasks are ignored."
+        ),
+        status_code=HTTP_200_OK,
+        media_type="application/json",
+    )
+    async def bulk_update(
+        self,
+        tasks_service: TaskService,
+        annotations_service: AnnotationService,
+        data: Annotated[AnnotationBulkUpdateData, Body(media_type=RequestEncodingType.JSON)],
+        task_id: UUID,
+        request: Request[AuthUser, Any, Any],
+    ) -> dict[str, int | float]:
+        if task_id not in request.user.assigned_task_ids:
+            raise PermissionDeniedException("Task does not belong to user!")
+
+        # Journaled labels are written first, or they would overwrite this update when flushed
+        await label_journal.flush()
+
+        filters = data.filter.model_dump() if data.filter is not None else {}
+        updated = await annotations_service.bulk_label(
+            task_id,
+            user_id=request.user.id,
+            label=data.label,
+            annotation_ids=data.annotation_ids,
+            labeled=filters.get("labeled"),
+            current_label=filters.get("label"),
+        )
+
+        labeled, total, user_labeled = await tasks_service.get_progress(task_id, request.user.id)
+        return {
+            "updated": updated,
+            "total": total,
+            "labeled": labeled,
+            "labeled_by_user": user_labeled,
+            "progress": round(labeled / total * 100, 2) if total > 0 else 0,
+        }
 
 
 class SystemController(Controller):
@@ -706,3 +1224,30 @@ class SystemController(Controller):
     )
     async def check_health(self) -> str:
         return "we are live!"
+
+    @get(
+        path=urls.GET_BACKUP_STATUS,
+        operation_id="getBackupStatus",
+        name="system:get_backup_status",
+        exclude_from_auth=False,
+        summary="Get the outcome of the last database backup",
+        status_code=HTTP_200_OK,
+    )
+    async def get_backup_status(self) -> dict[str, Any]:
+        return {
+            "enabled": backup_scheduler.enabled and backup_scheduler.database is not None,
+            "interval_seconds": backup_scheduler.interval,
+            **backup_scheduler.status.to_dict(),
+        }
+
+    @get(
+        path=urls.GET_METRICS,
+        media_type=METRICS_MEDIA_TYPE,
+        operation_id="getMetrics",
+        name="system:get_metrics",
+        exclude_from_auth=True,  # scraped by Prometheus, which has no session
+        summary="Get request metrics in the Prometheus text format",
+        status_code=HTTP_200_OK,
+    )
+    async def get_metrics(self) -> str:
+        return metrics.render()
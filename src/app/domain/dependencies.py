@@ -1,62 +1,67 @@
 # if TYPE_CHECKING:
 from collections.abc import AsyncGenerator
+from typing import Any
 
+from litestar import Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload, selectinload
 
+from app.domain.loading import get_load_options
 from app.domain.schema import Annotation, LabelKeybind, Task, User
-from app.domain.services import AnnotationService, LabelKeybindService, TaskService, UserService
+from app.domain.services import (
+    AnnotationService,
+    JobService,
+    LabelKeybindService,
+    TaskFileService,
+    TaskService,
+    UserService,
+)
 
 
-async def provide_users_service(db_session: AsyncSession) -> AsyncGenerator[UserService, None]:
+async def provide_users_service(
+    db_session: AsyncSession, request: Request[Any, Any, Any]
+) -> AsyncGenerator[UserService, None]:
     """Construct repository and service objects for the request."""
-    async with UserService.new(
-        session=db_session,
-        load=[
-            selectinload(User.created_tasks).options(selectinload(Task.creator)),
-            selectinload(User.assigned_tasks),
-            selectinload(User.label_keybinds),
-        ],
-    ) as service:
+    async with UserService.new(session=db_session, load=get_load_options(request, User)) as service:
         yield service
 
 
-async def provide_tasks_service(db_session: AsyncSession) -> AsyncGenerator[TaskService, None]:
+async def provide_tasks_service(
+    db_session: AsyncSession, request: Request[Any, Any, Any]
+) -> AsyncGenerator[TaskService, None]:
     """Construct repository and service objects for the request."""
-    async with TaskService.new(
-        session=db_session,
-        load=[
-            joinedload(Task.creator),
-            selectinload(Task.contributors),
-            selectinload(Task.annotations),
-            selectinload(Task.label_keybinds),
-        ],
-    ) as service:
+    async with TaskService.new(session=db_session, load=get_load_options(request, Task)) as service:
         yield service
 
 
 async def provide_label_keybinds_service(
-    db_session: AsyncSession,
+    db_session: AsyncSession, request: Request[Any, Any, Any]
 ) -> AsyncGenerator[LabelKeybindService, None]:
     """Construct repository and service objects for the request."""
     async with LabelKeybindService.new(
-        session=db_session,
-        load=[
-            joinedload(LabelKeybind.user),
-            joinedload(LabelKeybind.task),
-        ],
+        session=db_session, load=get_load_options(request, LabelKeybind)
     ) as service:
         yield service
 
 
 async def provide_annotations_service(
-    db_session: AsyncSession,
+    db_session: AsyncSession, request: Request[Any, Any, Any]
 ) -> AsyncGenerator[AnnotationService, None]:
     """Construct repository and service objects for the request."""
     async with AnnotationService.new(
-        session=db_session,
-        load=[
-            joinedload(Annotation.associated_task),
-        ],
+        session=db_session, load=get_load_options(request, Annotation)
     ) as service:
         yield service
+
+
+async def provide_task_files_service(
+    db_session: AsyncSession,
+) -> AsyncGenerator[TaskFileService, None]:
+    """Construct repository and service objects for the request."""
+    async with TaskFileService.new(session=db_session) as service:
+        yield service
+
+
+async def provide_jobs_service(db_session: AsyncSession) -> AsyncGenerator[JobService, None]:
+    """Construct repository and service objects for the request."""
+    async with JobService.new(session=db_session) as service:
+        yield service
@@ -0,0 +1,46 @@
+"""
+Decoding of DICOM files into 8-bit images browsers can display, applying a window/level.
+"""
+
+import numpy as np
+from PIL import Image
+from pydicom import dcmread
+from pydicom.pixels import apply_modality_lut, apply_voi_lut
+
+from app.domain.constants import DICOM_WINDOW_PRESETS
+
+
+def apply_window(pixels: np.ndarray, center: float, width: float) -> np.ndarray:
+    """Linearly map the [center - width / 2, center + width / 2] range onto 0-255."""
+    lower = center - width / 2
+    scaled = (pixels.astype(np.float64) - lower) / max(width, 1) * 255
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def read_dicom_image(path: str, window: str = "default") -> Image.Image:
+    """
+    Read the first frame of a DICOM file as an 8-bit image. Grayscale pixel data is converted to
+    modality units (e.g. Hounsfield units for CT) and windowed with the named preset from
+    `DICOM_WINDOW_PRESETS`, color pixel data is returned as RGB unchanged.
+    """
+    dataset = dcmread(path)
+    pixels = dataset.pixel_array
+    if int(dataset.get("NumberOfFrames", 1)) > 1:
+        pixels = pixels[0]
+
+    if dataset.get("SamplesPerPixel", 1) > 1:
+        return Image.fromarray(pixels.astype(np.uint8))
+
+    preset = DICOM_WINDOW_PRESETS[window]
+    if preset is not None:
+        windowed = apply_window(apply_modality_lut(pixels, dataset), *preset)
+    else:
+        if "WindowCenter" in dataset or "VOILUTSequence" in dataset:
+            pixels = apply_voi_lut(apply_modality_lut(pixels, dataset), dataset)
+        # Stretch the full range, as VOI output and raw pixel values have no fixed range
+        minimum, maximum = float(pixels.min()), float(pixels.max())
+        windowed = apply_window(pixels, (minimum + maximum) / 2, maximum - minimum)
+
+    if dataset.get("PhotometricInterpretation") == "MONOCHROME1":
+        windowed = 255 - windowed  # MONOCHROME1 stores inverted intensities
+    return Image.fromarray(windowed)
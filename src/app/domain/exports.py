@@ -0,0 +1,306 @@
+"""
+Annotation exports, shared by the streaming export endpoint and the export background job.
+Labeled annotations are read with a single query joined to the users that labeled them and
+fetched from a server-side cursor in batches, each batch encoded and sent before the next is
+read, so memory use does not grow with the size of the task.
+
+Records are encoded by one of the `EXPORT_FORMATS`: the indented JSON array the export has
+always produced, or compact JSON Lines and CSV for machine consumption, optionally gzipped.
+
+Exports can be incremental: every export comes with an `ExportCursor`, and an export since a
+cursor only has the annotations labeled, relabeled or unlabeled after it, read from the
+(task_id, updated_at, id) index so its cost follows the number of changes, not the task size.
+An annotation unlabeled since the cursor is a tombstone, a record with a null label.
+"""
+
+import asyncio
+import csv
+import io
+import json
+import zlib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections.abc import AsyncIterable, AsyncIterator, Callable
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from json.encoder import encode_basestring_ascii  # type: ignore[attr-defined]
+from typing import Any
+from uuid import UUID
+
+import msgspec
+from litestar.exceptions import ValidationException
+from sqlalchemy import ColumnElement, Select, case, func, or_, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.config.base import get_settings
+from app.domain.schema import Annotation, User
+
+settings = get_settings()
+
+EXPORT_COLUMNS = (
+    "task_title",
+    "task_id",
+    "annotation_id",
+    "labeled_by",
+    "created_at",
+    "updated_at",
+    "filepath",
+    "label",
+)
+# Added to the longest lock wait of a label write, for the commit that follows it
+DELTA_SETTLE_MARGIN = timedelta(seconds=1)
+# Fastest zlib level, exports are repetitive text that compresses well even at this level
+GZIP_LEVEL = 1
+
+RecordBatches = AsyncIterable[list[dict[str, Any]]]
+ExportEncoder = Callable[[RecordBatches], AsyncIterator[bytes]]
+
+
+@dataclass(frozen=True)
+class ExportFormat:
+    extension: str
+    media_type: str
+    """ Encodes batches of export records, yielding a chunk of the export per batch """
+    encode: ExportEncoder
+
+
+EXPORT_FORMATS: dict[str, ExportFormat] = {}
+EXPORT_COMPRESSIONS = {"gzip"}
+
+
+def export_format(
+    name: str, extension: str, media_type: str
+) -> Callable[[ExportEncoder], ExportEncoder]:
+    """Register an encoder as the export format `name`."""
+
+    def decorator(encode: ExportEncoder) -> ExportEncoder:
+        EXPORT_FORMATS[name] = ExportFormat(extension, media_type, encode)
+        return encode
+
+    return decorator
+
+
+@dataclass(frozen=True, order=True)
+class ExportCursor:
+    """Position in the (updated_at, id) order of the annotations of a task."""
+
+    updated_at: datetime
+    id: int
+
+    def encode(self) -> str:
+        return urlsafe_b64encode(f"{self.updated_at.isoformat()}|{self.id}".encode()).decode()
+
+    @classmethod
+    def decode(cls, cursor: str) -> "ExportCursor":
+        try:
+            updated_at, id_ = urlsafe_b64decode(cursor.encode()).decode().split("|")
+            decoded = cls(datetime.fromisoformat(updated_at), int(id_))
+        except ValueError:
+            decoded = None
+        if decoded is None or decoded.updated_at.tzinfo is None:
+            raise ValidationException("Invalid export cursor")
+        return decoded
+
+
+def get_delta_settle_time(dialect_name: str) -> timedelta:
+    """
+    How long after its updated_at a label write may still be uncommitted. updated_at is stamped
+    when the write is flushed, which may then wait on a lock for up to the database's lock timeout
+    before it commits or fails. Changes more recent than this are left to the next delta export,
+    so that a transaction committing after a later one does not end up behind a cursor that was
+    already handed out.
+    """
+    if dialect_name == "postgresql":
+        lock_timeout_ms = settings.db.PG_LOCK_TIMEOUT_MS
+    else:
+        lock_timeout_ms = settings.db.SQLITE_BUSY_TIMEOUT_MS
+    return timedelta(milliseconds=lock_timeout_ms) + DELTA_SETTLE_MARGIN
+
+
+def is_exported_change() -> ColumnElement[bool]:
+    """Annotations a delta export has a record for: labeled ones, and unlabeled tombstones."""
+    return or_(Annotation.labeled.is_(True), Annotation.labeled_by.is_not(None))
+
+
+async def get_export_cursor(db_session: AsyncSession, task_id: UUID) -> ExportCursor | None:
+    """
+    Cursor after the most recently changed annotation of a task a delta export would have, among
+    those that have settled (see `get_delta_settle_time`). None if there is no such annotation.
+    """
+    settle_time = get_delta_settle_time(db_session.get_bind().dialect.name)
+    stmt = (
+        select(Annotation.updated_at, Annotation.id)
+        .where(
+            Annotation.task_id == task_id,
+            is_exported_change(),
+            Annotation.updated_at <= datetime.now(UTC) - settle_time,
+        )
+        .order_by(Annotation.updated_at.desc(), Annotation.id.desc())
+        .limit(1)
+    )
+    row = (await db_session.execute(stmt)).one_or_none()
+    return ExportCursor(row.updated_at, row.id) if row is not None else None
+
+
+def get_labeled_annotations_query(
+    task_id: UUID, since: ExportCursor | None = None, until: ExportCursor | None = None
+) -> Select[Any]:
+    """
+    Export columns of the labeled annotations of a task. Labelers are joined in rather than
+    looked up one by one. A full export is in id order, served by the (task_id, labeled, id)
+    index. A delta export, of the annotations changed after `since` up to `until`, is in
+    (updated_at, id) order and served by the (task_id, updated_at, id) index. It also has the
+    annotations unlabeled in between, with a null label, so consumers can drop their labels.
+    """
+    stmt = (
+        select(
+            Annotation.id.label("annotation_id"),
+            func.coalesce(User.username, "Unknown").label("labeled_by"),
+            Annotation.created_at,
+            Annotation.updated_at,
+            Annotation.filepath,
+            case((Annotation.labeled.is_(True), Annotation.label)).label("label"),
+        )
+        .outerjoin(User, User.id == Annotation.labeled_by)
+        .where(Annotation.task_id == task_id)
+    )
+    if since is None:
+        return stmt.where(Annotation.labeled.is_(True)).order_by(Annotation.id)
+
+    until = until or since
+    position = tuple_(Annotation.updated_at, Annotation.id)
+    return stmt.where(
+        is_exported_change(),
+        position > (since.updated_at, since.id),
+        position <= (until.updated_at, until.id),
+    ).order_by(Annotation.updated_at, Annotation.id)
+
+
+async def iter_labeled_annotations(
+    db_session: AsyncSession,
+    task_id: UUID,
+    title: str,
+    since: ExportCursor | None = None,
+    until: ExportCursor | None = None,
+) -> AsyncIterator[list[dict[str, Any]]]:
+    """Yield the labeled annotations of a task as export records, in batches."""
+    stmt = get_labeled_annotations_query(task_id, since, until).execution_options(
+        yield_per=settings.app.EXPORT_BATCH_SIZE
+    )
+    result = await db_session.stream(stmt)
+    async for rows in result.partitions():
+        # the task is the same for every row, so it is not selected and decoded per row
+        yield [dict(zip(EXPORT_COLUMNS, (title, task_id, *row), strict=True)) for row in rows]
+
+
+def encode_value(value: Any) -> str:
+    """Encode a record value as `json.dumps(value, default=str)` does."""
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    if value is None:
+        return "null"
+    if type(value) is int:
+        return str(value)
+    if isinstance(value, UUID | datetime):
+        return encode_basestring_ascii(str(value))
+    return json.dumps(value, default=str)
+
+
+def encode_record(record: dict[str, Any]) -> str:
+    """
+    Encode a flat export record as an array item of the export, indented like
+    `json.dumps(record, indent=4)` with every line prefixed by four spaces. Laid out by hand, as
+    the json module falls back to its much slower pure Python encoder when indenting.
+    """
+    items = ",\n".join(
+        f"        {encode_basestring_ascii(key)}: {encode_value(value)}"
+        for key, value in record.items()
+    )
+    return f"    {{\n{items}\n    }}"
+
+
+async def iter_json_export(batches: RecordBatches) -> AsyncIterator[str]:
+    """Serialize batches of export records as an indented JSON array, one chunk per batch."""
+    separator = "[\n"
+    async for records in batches:
+        chunk = []
+        for record in records:
+            chunk.append(separator + encode_record(record))
+            separator = ",\n"
+        yield "".join(chunk)
+    yield "[\n]\n" if separator == "[\n" else "\n]\n"
+
+
+@export_format("json", "json", "application/json")
+async def encode_json(batches: RecordBatches) -> AsyncIterator[bytes]:
+    async for chunk in iter_json_export(batches):
+        yield chunk.encode("ascii")  # non-ASCII characters are escaped
+
+
+_jsonl_encoder = msgspec.json.Encoder()
+
+
+@export_format("jsonl", "jsonl", "application/jsonl")
+async def encode_jsonl(batches: RecordBatches) -> AsyncIterator[bytes]:
+    """One compact JSON object per line, timestamps in RFC 3339."""
+    async for records in batches:
+        yield _jsonl_encoder.encode_lines(records)
+
+
+@export_format("csv", "csv", "text/csv")
+async def encode_csv(batches: RecordBatches) -> AsyncIterator[bytes]:
+    """
+    A header row of the column names, then one row per record, empty cells for nulls. Values are
+    converted to strings by msgspec, so timestamps are in RFC 3339 as in the JSON Lines export.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async for records in batches:
+        writer.writerows(record.values() for record in msgspec.to_builtins(records))
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell() > 0:  # header of an empty export
+        yield buffer.getvalue().encode("utf-8")
+
+
+async def gzip_chunks(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """Compress a stream of chunks into a gzip file, off the event loop."""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip framing
+    async for chunk in chunks:
+        compressed = await asyncio.to_thread(compressor.compress, chunk)
+        if len(compressed) > 0:
+            yield compressed
+    yield compressor.flush()
+
+
+async def stream_export(  # noqa: PLR0913 (too many arguments)
+    engine: AsyncEngine,
+    task_id: UUID,
+    title: str,
+    *,
+    name: str,
+    compress: str | None = None,
+    since: ExportCursor | None = None,
+    until: ExportCursor | None = None,
+) -> AsyncIterator[bytes]:
+    """
+    Export of a task in the format `name` for a streaming response. The request's session is
+    closed once the response starts, so the export is read through a session of its own.
+    """
+    async with AsyncSession(engine) as db_session:
+        batches = iter_labeled_annotations(db_session, task_id, title, since, until)
+        chunks = EXPORT_FORMATS[name].encode(batches)
+        if compress == "gzip":
+            chunks = gzip_chunks(chunks)
+        async for chunk in chunks:
+            yield chunk
+
+
+def get_export_media_type(name: str = "json", compress: str | None = None) -> str:
+    return "application/gzip" if compress == "gzip" else EXPORT_FORMATS[name].media_type
+
+
+def get_export_filename(title: str, name: str = "json", compress: str | None = None) -> str:
+    filename = f"{title}_annotations.{EXPORT_FORMATS[name].extension}"
+    return f"{filename}.gz" if compress == "gzip" else filename
@@ -0,0 +1,105 @@
+"""
+Cache of the identity of authenticated users, consulted on every authenticated request in place
+of loading the user each time. Entries are a lightweight projection of the user, expire after a
+TTL and are evicted least recently used first once the cache is full. Handlers that change what
+a user's identity holds, such as the tasks assigned to them, invalidate it explicitly.
+
+With several worker processes each has its own cache, an invalidation in one bumps a shared
+generation counter and the others drop their entries on their next lookup.
+"""
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+from uuid import UUID
+
+from litestar import Request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.config.base import AppSettings, get_settings
+from app.domain.schema import User, user_tasks
+from app.domain.workers import SharedCounter, coordinator
+
+
+@dataclass(frozen=True)
+class AuthUser:
+    """The authenticated user of a request, `request.user`."""
+
+    id: UUID
+    username: str
+    assigned_task_ids: frozenset[UUID]
+
+
+async def load_auth_user(engine: AsyncEngine, user_id: UUID) -> AuthUser | None:
+    async with AsyncSession(engine) as db_session:
+        stmt = select(User.id, User.username).where(User.id == user_id)
+        row = (await db_session.execute(stmt)).one_or_none()
+        if row is None:
+            return None
+        stmt = select(user_tasks.c.task_id).where(user_tasks.c.user_id == user_id)
+        task_ids = (await db_session.execute(stmt)).scalars()
+        return AuthUser(row.id, row.username, frozenset(task_ids))
+
+
+class IdentityCache:
+    """TTL and size bounded LRU cache of `AuthUser`s by user id."""
+
+    def __init__(self, settings: AppSettings, shared: SharedCounter | None = None) -> None:
+        self.max_size = settings.USER_CACHE_SIZE
+        self.ttl = settings.USER_CACHE_TTL_SECONDS
+
+        self._entries: OrderedDict[UUID, tuple[float, AuthUser]] = (
+            OrderedDict()
+        )  # least recently used first
+        # Bumped by every invalidation, so a load that raced with one is not cached
+        self._generation = 0
+        # Invalidations made by other worker processes, None with a single process
+        self._shared = shared
+        self._shared_generation = shared.value if shared is not None else 0
+
+    async def get(self, engine: AsyncEngine, user_id: UUID) -> AuthUser | None:
+        if self._shared is not None and self._shared.value != self._shared_generation:
+            self._shared_generation = self._shared.value
+            self._entries.clear()
+            self._generation += 1
+
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+        generation = self._generation
+        user = await load_auth_user(engine, user_id)
+        if user is None:
+            self._entries.pop(user_id, None)
+        elif generation == self._generation:
+            self._entries[user_id] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id: UUID) -> None:
+        self._entries.pop(user_id, None)
+        self._generation += 1
+        if self._shared is not None:
+            self._shared.increment()
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._generation += 1
+        if self._shared is not None:
+            self._shared.increment()
+
+
+identity_cache = IdentityCache(get_settings().app, coordinator.get_counter("identity"))
+
+
+async def invalidate_user_identity(request: Request[AuthUser, Any, Any]) -> None:
+    """
+    `after_response` hook of handlers that change the identity of the current user. It runs
+    once the request's transaction is committed, so the next request reloads the new state.
+    """
+    identity_cache.invalidate(request.user.id)
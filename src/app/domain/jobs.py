@@ -0,0 +1,277 @@
+"""
+In-process runner for long operations (task ingestion, exports, catalog rescans), so they run
+outside of the request that started them. Jobs are persisted in the jobs table, which clients
+poll for status and progress, and are executed by a bounded pool of asyncio workers, each job in
+its own database session.
+
+With several worker processes, jobs are run by the leader worker only (see app.domain.workers).
+Every worker polls the jobs table, so the one that leads picks up jobs submitted through the
+others, and jobs of a leader that exited are taken over by the next one.
+"""
+
+import asyncio
+import contextvars
+from collections.abc import AsyncIterator, Awaitable, Callable, Coroutine
+from pathlib import Path
+from typing import Any, cast
+from uuid import UUID
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.config.base import JobSettings, get_settings
+from app.domain import constants
+from app.domain.exports import iter_json_export, iter_labeled_annotations
+from app.domain.renditions import rendition_cache
+from app.domain.schema import Job, Task
+from app.domain.services import (
+    AnnotationService,
+    JobService,
+    TaskFileService,
+    TaskService,
+)
+from app.domain.workers import coordinator
+
+settings = get_settings()
+
+ProgressCallback = Callable[[int], Awaitable[None]]
+""" Runs a job, returning the location of its result if it has one """
+JobHandler = Callable[[AsyncSession, Job, ProgressCallback], Awaitable[str | None]]
+
+
+class JobRunner:
+    """Queue of persisted jobs worked through by a fixed number of asyncio workers."""
+
+    def __init__(self, settings: JobSettings) -> None:
+        self.workers = settings.WORKERS
+        self.result_dir = Path(settings.RESULT_DIR).resolve()
+        self.poll_interval = settings.POLL_INTERVAL_SECONDS
+        self.handlers: dict[str, JobHandler] = {}
+        """ Kinds of job that only read, run on the read engine when there is one """
+        self.read_only_kinds: set[str] = set()
+        self.read_engine: AsyncEngine | None = None
+
+        self._queue: asyncio.Queue[tuple[AsyncEngine, UUID]] | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._workers: list[asyncio.Task[None]] = []
+        self._background: set[asyncio.Task[Any]] = set()
+        self._queued_ids: set[UUID] = set()
+        self._leading = not coordinator.multi_process
+
+    def register(self, kind: str, read_only: bool = False) -> Callable[[JobHandler], JobHandler]:
+        """Register the handler running jobs of a kind."""
+
+        def decorator(handler: JobHandler) -> JobHandler:
+            self.handlers[kind] = handler
+            if read_only:
+                self.read_only_kinds.add(kind)
+            return handler
+
+        return decorator
+
+    async def submit(self, engine: AsyncEngine, job_id: UUID) -> None:
+        """Queue a job that was committed to the database with the queued status."""
+        if not self._leading:
+            return  # picked up by the leader when it next polls
+        self._queued_ids.add(job_id)
+        self._get_queue().put_nowait((engine, job_id))
+
+    async def resume(self, engine: AsyncEngine, read_engine: AsyncEngine | None = None) -> None:
+        """
+        Pick up after a restart: jobs the previous process was running are failed, as their
+        partial work cannot be resumed, and jobs that never started are queued again. With several
+        worker processes this is done by whichever becomes the leader.
+        """
+        self.read_engine = read_engine
+        if coordinator.multi_process:
+            self.spawn(self._poll_periodically(engine))
+            return
+        await self._resume(engine)
+
+    def spawn(self, coroutine: Coroutine[Any, Any, Any]) -> None:
+        """Run follow-up work of a job, such as prewarming renditions, without delaying it."""
+        task = asyncio.ensure_future(coroutine)
+        self._background.add(task)  # the event loop only keeps weak references to tasks
+        task.add_done_callback(self._background.discard)
+
+    async def shutdown(self) -> None:
+        tasks = [*self._workers, *self._background]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queue, self._loop, self._workers = None, None, []
+        self._queued_ids.clear()
+
+    def _get_queue(self) -> asyncio.Queue[tuple[AsyncEngine, UUID]]:
+        loop = asyncio.get_running_loop()
+        if self._queue is None or self._loop is not loop:
+            # Workers are bound to the event loop they were started on. They run in a context of
+            # their own, not that of the request submitting the first job, whose metrics and query
+            # budget their statements would otherwise count towards.
+            self._queue, self._loop = asyncio.Queue(), loop
+            self._workers = [
+                asyncio.create_task(self._work(self._queue), context=contextvars.Context())
+                for _ in range(self.workers)
+            ]
+        return self._queue
+
+    async def _resume(self, engine: AsyncEngine) -> None:
+        async with (
+            AsyncSession(engine) as db_session,
+            JobService.new(session=db_session) as jobs_service,
+        ):
+            await jobs_service.fail_running("Interrupted by a server restart")
+            queued_ids = await jobs_service.get_queued_ids()
+            await db_session.commit()
+
+        for job_id in queued_ids:
+            await self.submit(engine, job_id)
+
+    async def _poll_periodically(self, engine: AsyncEngine) -> None:
+        while True:
+            try:
+                await self._poll(engine)
+            except Exception as e:  # e.g. the database is locked, retried on the next interval
+                print(f"Polling for jobs failed: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _poll(self, engine: AsyncEngine) -> None:
+        if not coordinator.is_leader():
+            return
+        if not self._leading:  # the previous leader exited, as its lock was released
+            self._leading = True
+            try:
+                await self._resume(engine)
+            except Exception:
+                self._leading = False  # resumed again on the next poll
+                raise
+            return
+
+        async with (
+            AsyncSession(self.read_engine or engine) as db_session,
+            JobService.new(session=db_session) as jobs_service,
+        ):
+            queued_ids = await jobs_service.get_queued_ids()
+        for job_id in queued_ids:
+            if job_id not in self._queued_ids:  # submitted through another worker
+                await self.submit(engine, job_id)
+
+    async def _work(self, queue: asyncio.Queue[tuple[AsyncEngine, UUID]]) -> None:
+        while True:
+            engine, job_id = await queue.get()
+            try:
+                await self._run(engine, job_id)
+            except Exception as e:  # e.g. the database went away, keep the worker alive
+                print(f"Job {job_id} failed: {e}")
+            finally:
+                self._queued_ids.discard(job_id)
+                queue.task_done()
+            # The driver can swallow a cancellation landing mid-statement; stop anyway on shutdown
+            if (task := asyncio.current_task()) is not None and task.cancelling():
+                raise asyncio.CancelledError
+
+    async def _run(self, engine: AsyncEngine, job_id: UUID) -> None:
+        async with (
+            AsyncSession(engine, expire_on_commit=False) as db_session,
+            JobService.new(session=db_session) as jobs_service,
+        ):
+            job = await jobs_service.start(job_id)
+            await db_session.commit()
+            if job is None:
+                return
+
+            async def progress(count: int) -> None:
+                await jobs_service.set_progress(job_id, count)
+                await db_session.commit()
+
+            try:
+                if job.kind in self.read_only_kinds and self.read_engine is not None:
+                    # Long reads such as exports keep off the connection writes go through
+                    async with AsyncSession(self.read_engine) as read_session:
+                        result = await self.handlers[job.kind](read_session, job, progress)
+                else:
+                    result = await self.handlers[job.kind](db_session, job, progress)
+            except Exception as e:  # failures are reported through the job, not raised
+                await db_session.rollback()
+                await jobs_service.fail(job_id, str(e) or type(e).__name__)
+            else:
+                await jobs_service.finish(job_id, result)
+            await db_session.commit()
+
+
+job_runner = JobRunner(settings.job)
+
+
+async def get_root_folder(db_session: AsyncSession, task_id: UUID) -> str:
+    """
+    Read the root folder of a task, ending the transaction so that listing the folder does not
+    keep the write lock held by several workers.
+    """
+    stmt = select(Task.root_folder).where(Task.id == task_id)
+    root_folder = (await db_session.execute(stmt)).scalar_one()
+    await db_session.commit()
+    return root_folder
+
+
+@job_runner.register(constants.JOB_INGEST_TASK)
+async def ingest_task(db_session: AsyncSession, job: Job, progress: ProgressCallback) -> None:
+    """Catalog a new task's root folder and create its annotations."""
+    task_id = cast(UUID, job.task_id)
+    root_folder = await get_root_folder(db_session, task_id)
+    async with TaskService.new(session=db_session) as tasks_service:
+        await tasks_service.ingest_root_folder(
+            task_id, root_folder, settings.app.INGEST_BATCH_SIZE, on_progress=progress
+        )
+
+    async with AnnotationService.new(session=db_session) as annotations_service:
+        prewarm_paths = await annotations_service.get_prewarm_paths(
+            [task_id], settings.rendition.PREWARM_COUNT
+        )
+    job_runner.spawn(rendition_cache.prewarm(prewarm_paths))
+
+
+@job_runner.register(constants.JOB_RESCAN_TASK)
+async def rescan_task(db_session: AsyncSession, job: Job, progress: ProgressCallback) -> None:
+    """
+    Resync a task's catalog with its root folder. The folder is listed even if its mtime did not
+    change, which also picks up files rewritten in place.
+    """
+    task_id = cast(UUID, job.task_id)
+    root_folder = await get_root_folder(db_session, task_id)
+    async with TaskFileService.new(session=db_session) as task_files_service:
+        await task_files_service.refresh_catalog(task_id, root_folder)
+    await db_session.commit()
+
+
+@job_runner.register(constants.JOB_EXPORT_TASK, read_only=True)
+async def export_task(db_session: AsyncSession, job: Job, progress: ProgressCallback) -> str:
+    """
+    Write the labeled annotations of a task to a JSON file, returning its path. Progress, the
+    number of annotations exported, is only reported at the end: committing it would close the
+    cursor the annotations are streamed from.
+    """
+    task_id = cast(UUID, job.task_id)
+    async with TaskService.new(session=db_session) as tasks_service:
+        title = await tasks_service.get_title(task_id)
+
+    exported = 0
+
+    async def count(
+        batches: AsyncIterator[list[dict[str, Any]]],
+    ) -> AsyncIterator[list[dict[str, Any]]]:
+        nonlocal exported
+        async for records in batches:
+            exported += len(records)
+            yield records
+
+    destination = job_runner.result_dir / f"{job.id}.json"
+    temp_destination = destination.with_suffix(".tmp")
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    with temp_destination.open("w", encoding="utf-8") as f:
+        async for chunk in iter_json_export(
+            count(iter_labeled_annotations(db_session, task_id, title))
+        ):
+            await asyncio.to_thread(f.write, chunk)
+    temp_destination.replace(destination)  # atomic, downloads never see a partial file
+    await progress(exported)
+    return str(destination)
@@ -0,0 +1,262 @@
+"""
+Write-behind journal of label updates, enabled by `LABEL_WRITE_BEHIND`. A label update is appended
+to a local journal, synced to disk, and acknowledged without touching the database. A background
+flusher coalesces the journaled updates, the last one per annotation wins, and writes them in a
+single transaction every `LABEL_FLUSH_INTERVAL_MS`, so fast annotators share one SQLite write per
+interval instead of queueing for the writer lock on every keypress. Updates a crash left in the
+journal are replayed on startup.
+
+Until an update is flushed the database lags behind it: annotations with a pending update are not
+handed out to label again, and progress reported to annotators accounts for pending updates.
+"""
+
+import asyncio
+import contextvars
+import json
+import os
+from collections.abc import Iterable
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from typing import IO
+from uuid import UUID
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.config.base import JournalSettings, get_settings
+from app.domain.schema import Annotation
+from app.domain.services import AnnotationService
+
+settings = get_settings()
+
+
+@dataclass(frozen=True)
+class LabelWrite:
+    """A label update of an annotation, an empty label undoes it"""
+
+    annotation_id: int
+    task_id: UUID
+    user_id: UUID
+    label: str | None
+    at: datetime
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "annotation_id": self.annotation_id,
+                "task_id": str(self.task_id),
+                "user_id": str(self.user_id),
+                "label": self.label,
+                "at": self.at.isoformat(),
+            }
+        )
+
+    @classmethod
+    def from_json(cls, line: str) -> "LabelWrite":
+        data = json.loads(line)
+        return cls(
+            annotation_id=int(data["annotation_id"]),
+            task_id=UUID(data["task_id"]),
+            user_id=UUID(data["user_id"]),
+            label=data["label"] or None,
+            at=datetime.fromisoformat(data["at"]),
+        )
+
+
+class LabelJournal:
+    """Label updates journaled to disk and pending a batched write to the database."""
+
+    def __init__(self, settings: JournalSettings, lease_duration: timedelta) -> None:
+        self.enabled = settings.WRITE_BEHIND
+        self.path = Path(settings.PATH).resolve()
+        self.interval = settings.FLUSH_INTERVAL_MS / 1000
+        self.lease_duration = lease_duration
+
+        self._pending: dict[int, LabelWrite] = {}
+        self._file: IO[str] | None = None
+        self._engine: AsyncEngine | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._flusher: asyncio.Task[None] | None = None
+
+    async def record(self, engine: AsyncEngine, write: LabelWrite) -> None:
+        """Journal a label update, returning once it is on disk."""
+        self._start(engine)
+        async with self._lock:
+            await asyncio.to_thread(self._append, write)
+            self._pending[write.annotation_id] = write
+
+    def pending_ids(self, task_id: UUID) -> set[int]:
+        """Ids of the annotations of a task with a label update not yet written to the database."""
+        return {w.annotation_id for w in self._pending.values() if w.task_id == task_id}
+
+    async def get_progress_delta(
+        self, db_session: AsyncSession, task_id: UUID, user_id: UUID
+    ) -> tuple[int, int]:
+        """
+        Change that the pending updates of a task will make to its labeled count, and to the
+        number of annotations it has labeled by a user, once they are written to the database.
+        """
+        writes = [w for w in self._pending.values() if w.task_id == task_id]
+        if len(writes) == 0:
+            return 0, 0
+
+        stmt = select(Annotation.id, Annotation.labeled, Annotation.labeled_by).where(
+            Annotation.id.in_([w.annotation_id for w in writes])
+        )
+        current = {row.id: row for row in await db_session.execute(stmt)}
+        labeled_delta = user_delta = 0
+        for write in writes:
+            row = current.get(write.annotation_id)
+            if row is None:  # deleted since, the update will be a no-op
+                continue
+            is_labeled = write.label is not None
+            labeled_delta += int(is_labeled) - int(row.labeled)
+            user_delta += int(is_labeled and write.user_id == user_id) - int(
+                row.labeled and row.labeled_by == user_id
+            )
+        return labeled_delta, user_delta
+
+    async def flush(self) -> int:
+        """
+        Write every pending update to the database in one transaction, then drop them from the
+        journal. Updates journaled while writing stay pending. Returns the number written.
+        """
+        async with self._flush_lock:
+            if self._engine is None or len(self._pending) == 0:
+                return 0
+            writes = list(self._pending.values())
+            await self._write(self._engine, writes)
+
+            async with self._lock:
+                for write in writes:
+                    if self._pending.get(write.annotation_id) is write:
+                        del self._pending[write.annotation_id]
+                await asyncio.to_thread(self._compact, list(self._pending.values()))
+        return len(writes)
+
+    async def replay(self, engine: AsyncEngine) -> int:
+        """
+        Write the updates left in the journal by the last process to the database, whether or not
+        write-behind is still enabled. Returns the number written.
+        """
+        if not self.path.exists():
+            return 0
+        writes = await asyncio.to_thread(self._read)
+        if len(writes) == 0:
+            return 0
+        self._start(engine)
+        async with self._lock:
+            for write in writes:
+                self._pending[write.annotation_id] = write
+        return await self.flush()
+
+    async def shutdown(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        try:
+            await self.flush()
+        except Exception as e:  # the updates stay journaled and are replayed on startup
+            print(f"Flushing the label journal failed: {e}")
+        if self._file is not None:
+            self._file.close()
+        self._file, self._loop, self._flusher = None, None, None
+
+    def _start(self, engine: AsyncEngine) -> None:
+        self._engine = engine
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # The flusher and locks are bound to the event loop they were started on. The flusher
+            # runs in a context of its own, not that of the request that started it (see jobs).
+            self._loop, self._lock, self._flush_lock = loop, asyncio.Lock(), asyncio.Lock()
+            self._flusher = asyncio.create_task(
+                self._flush_periodically(), context=contextvars.Context()
+            )
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:  # e.g. the database is locked, retried on the next interval
+                print(f"Flushing the label journal failed: {e}")
+
+    async def _write(self, engine: AsyncEngine, writes: list[LabelWrite]) -> None:
+        # A single executemany, bulk writes bypass the ORM events that keep updated_at current
+        stmt = (
+            update(Annotation.__table__)  # type: ignore[arg-type]
+            .where(
+                Annotation.id == bindparam("b_annotation_id"),
+                Annotation.task_id == bindparam("b_task_id"),
+            )
+            .values(
+                label=bindparam("b_label"),
+                labeled=bindparam("b_labeled"),
+                labeled_by=bindparam("b_user_id"),
+                claimed_by=bindparam("b_claimed_by"),
+                lease_expires_at=bindparam("b_lease_expires_at"),
+                # When written rather than when journaled, delta exports rely on updated_at
+                # trailing its commit by no more than a lock wait
+                updated_at=datetime.now(UTC),
+            )
+        )
+        params = [
+            {
+                "b_annotation_id": w.annotation_id,
+                "b_task_id": w.task_id,
+                "b_label": w.label,
+                "b_labeled": w.label is not None,
+                "b_user_id": w.user_id,
+                # an undone label goes back to the annotator who undid it
+                "b_claimed_by": None if w.label is not None else w.user_id,
+                "b_lease_expires_at": None if w.label is not None else w.at + self.lease_duration,
+            }
+            for w in writes
+        ]
+        async with (
+            AsyncSession(engine) as db_session,
+            AnnotationService.new(session=db_session) as annotations_service,
+        ):
+            await db_session.execute(stmt, params)
+            # Label updates are annotator activity, which keeps their other claims alive
+            for task_id, user_id in {(w.task_id, w.user_id) for w in writes}:
+                await annotations_service.renew_leases(task_id, user_id, self.lease_duration)
+            await db_session.commit()
+
+    def _append(self, write: LabelWrite) -> None:
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.path.open("a", encoding="utf-8")
+        self._file.write(write.to_json() + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _compact(self, writes: Iterable[LabelWrite]) -> None:
+        """Rewrite the journal with only the updates still pending."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        temp_path = self.path.with_suffix(".tmp")
+        with temp_path.open("w", encoding="utf-8") as f:
+            f.writelines(w.to_json() + "\n" for w in writes)
+            f.flush()
+            os.fsync(f.fileno())
+        temp_path.replace(self.path)  # atomic, a crash leaves either journal whole
+
+    def _read(self) -> list[LabelWrite]:
+        writes = []
+        with self.path.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    writes.append(LabelWrite.from_json(line))
+                except (ValueError, KeyError):  # e.g. a line cut short by a crash while appending
+                    continue
+        return writes
+
+
+label_journal = LabelJournal(
+    settings.journal, timedelta(seconds=settings.app.ANNOTATION_LEASE_SECONDS)
+)
@@ -0,0 +1,65 @@
+"""
+Relationship load profiles. Relationships in the schema raise rather than load when accessed, so
+a request only loads the columns and relationships its endpoint's profile asks for, and a
+relationship used without being loaded fails loudly instead of issuing queries behind the scenes.
+
+Route handlers given a service declare their profile as the `load_profile` option, which Litestar
+keeps in the handler's `opt`, e.g. `@get(..., load_profile=constants.LOAD_PROFILE_LABELING)`.
+"""
+
+from typing import Any
+
+from advanced_alchemy.repository import LoadSpec
+from litestar import Request
+from litestar.exceptions import ImproperlyConfiguredException
+from sqlalchemy.orm import joinedload, load_only, selectinload
+
+from app.domain import constants
+from app.domain.schema import Annotation, Task, User
+
+LOAD_PROFILE_OPT = "load_profile"
+
+# Loader options per profile and model, models missing from a profile load no relationships
+LOAD_PROFILES: dict[str, dict[type[Any], list[LoadSpec]]] = {
+    # Pages, sign up and login, their task listings are aggregated by column queries
+    constants.LOAD_PROFILE_SUMMARY: {
+        User: [load_only(User.id, User.username, User.password, raiseload=True)],
+    },
+    # The labeling loop, hit for every image: task membership and image paths only. updated_at
+    # is read by the audit listener when a label is saved.
+    constants.LOAD_PROFILE_LABELING: {
+        Task: [load_only(Task.id, raiseload=True)],
+        Annotation: [
+            load_only(
+                Annotation.id,
+                Annotation.task_id,
+                Annotation.filepath,
+                Annotation.updated_at,
+                raiseload=True,
+            )
+        ],
+    },
+    constants.LOAD_PROFILE_EXPORT: {
+        Task: [load_only(Task.id, Task.title, raiseload=True)],
+    },
+    # Task management, which edits assignments and keybinds through the relationships
+    constants.LOAD_PROFILE_ADMIN: {
+        User: [selectinload(User.assigned_tasks)],
+        Task: [
+            joinedload(Task.creator),
+            selectinload(Task.contributors),
+            selectinload(Task.label_keybinds),
+        ],
+    },
+}
+
+
+def get_load_options(request: Request[Any, Any, Any], model: type[Any]) -> list[LoadSpec]:
+    """Get the loader options for a model in the load profile declared by a request's handler."""
+    profile = request.route_handler.opt.get(LOAD_PROFILE_OPT)
+    if profile not in LOAD_PROFILES:
+        raise ImproperlyConfiguredException(
+            f"{request.route_handler.handler_name} must declare a {LOAD_PROFILE_OPT}, "
+            f"one of {list(LOAD_PROFILES)}"
+        )
+    return LOAD_PROFILES[profile].get(model, [])
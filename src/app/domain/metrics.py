@@ -0,0 +1,264 @@
+"""
+Request metrics, exposed in the Prometheus text format at `urls.GET_METRICS`: latency histograms
+and request counts by route, requests in flight, statements executed and time spent in the
+database per request, and image bytes served per task.
+
+Recording stays off the costly path of a request: the middleware does a few dictionary updates
+and a bisect per request, and database statements are attributed to the request executing them
+through a context variable, which SQLAlchemy carries into the greenlets it runs statements in.
+Metrics are kept per process, so with several worker processes each scrape sees one of them.
+"""
+
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Iterator, Sequence
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any
+from urllib.parse import parse_qs
+
+from litestar.enums import ScopeType
+from litestar.handlers import BaseRouteHandler
+from litestar.middleware.base import MiddlewareProtocol
+from litestar.status_codes import HTTP_200_OK, HTTP_500_INTERNAL_SERVER_ERROR
+from litestar.types import ASGIApp, Message, Receive, Scope, Send
+from sqlalchemy import Connection, Engine, event
+
+from app.domain.queries import QUERY_BUDGET_OPT, query_monitor
+
+""" Route handler option of handlers serving images, whose bytes are counted by task """
+IMAGE_OPT = "serves_images"
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+@dataclass
+class RequestStats:
+    """Database work of the request being served"""
+
+    route: str = ""
+    """ Most statements the request may execute, from its handler's `QUERY_BUDGET_OPT` """
+    budget: int | None = None
+    statements: int = 0
+    db_seconds: float = 0
+    """ Executions by statement, a statement run once per row of a query is an N+1 """
+    executions: Counter[str] = field(default_factory=Counter)
+
+
+current_request: ContextVar[RequestStats | None] = ContextVar("current_request", default=None)
+
+
+class Histogram:
+    """Counts of observations at most each bucket's upper bound, with their sum."""
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum: float = 0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, labels: str) -> Iterator[str]:
+        cumulative = 0
+        for bound, count in zip([*self.buckets, "+Inf"], self.counts, strict=True):
+            cumulative += count
+            yield f'_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f"_sum{{{labels}}} {self.sum}"
+        yield f"_count{{{labels}}} {self.count}"
+
+
+class Metrics:
+    """Metrics of the requests served by this process."""
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.requests: defaultdict[tuple[str, str, int], int] = defaultdict(int)
+        self.durations: dict[tuple[str, str], Histogram] = {}
+        self.statements: dict[tuple[str, str], Histogram] = {}
+        self.db_seconds: defaultdict[tuple[str, str], float] = defaultdict(float)
+        self.image_bytes: defaultdict[str, int] = defaultdict(int)
+        self.repeated_statements: defaultdict[tuple[str, str], int] = defaultdict(int)
+
+    def record(
+        self, method: str, route: str, status: int, duration: float, stats: RequestStats
+    ) -> None:
+        key = (method, route)
+        self.requests[method, route, status] += 1
+        if key not in self.durations:
+            self.durations[key] = Histogram(LATENCY_BUCKETS)
+            self.statements[key] = Histogram(STATEMENT_BUCKETS)
+        self.durations[key].observe(duration)
+        self.statements[key].observe(stats.statements)
+        self.db_seconds[key] += stats.db_seconds
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = [
+            *render_metric(
+                "app_requests_in_flight",
+                "gauge",
+                "Requests being served",
+                [("", self.in_flight)],
+            ),
+            *render_metric(
+                "app_requests_total",
+                "counter",
+                "Requests served, by route and status",
+                (
+                    (format_labels(method=m, route=r, status=s), count)
+                    for (m, r, s), count in self.requests.items()
+                ),
+            ),
+            *render_histograms(
+                "app_request_duration_seconds",
+                "Time to serve a request, by route",
+                self.durations,
+            ),
+            *render_histograms(
+                "app_request_db_statements",
+                "Database statements executed by a request, by route",
+                self.statements,
+            ),
+            *render_metric(
+                "app_request_db_seconds_total",
+                "counter",
+                "Time requests spent executing database statements, by route",
+                (
+                    (format_labels(method=m, route=r), seconds)
+                    for (m, r), seconds in self.db_seconds.items()
+                ),
+            ),
+            *render_metric(
+                "app_repeated_statements_total",
+                "counter",
+                "Statements a request executed more than QUERY_REPEAT_THRESHOLD times, by route",
+                (
+                    (format_labels(method=m, route=r), count)
+                    for (m, r), count in self.repeated_statements.items()
+                ),
+            ),
+            *render_metric(
+                "app_image_bytes_total",
+                "counter",
+                "Bytes of images served, by task",
+                (
+                    (format_labels(task_id=task_id), size)
+                    for task_id, size in self.image_bytes.items()
+                ),
+            ),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(**labels: Any) -> str:
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return ",".join(f'{name}="{value}"' for name, value in escaped)
+
+
+def render_metric(
+    name: str, kind: str, help_text: str, samples: Iterable[tuple[str, float]]
+) -> Iterator[str]:
+    """Lines of a metric, from its samples as (labels, value)."""
+    yield f"# HELP {name} {help_text}"
+    yield f"# TYPE {name} {kind}"
+    for labels, value in samples:
+        yield f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+
+
+def render_histograms(
+    name: str, help_text: str, histograms: dict[tuple[str, str], Histogram]
+) -> Iterator[str]:
+    yield f"# HELP {name} {help_text}"
+    yield f"# TYPE {name} histogram"
+    for (method, route), histogram in histograms.items():
+        for sample in histogram.samples(format_labels(method=method, route=route)):
+            yield f"{name}{sample}"
+
+
+metrics = Metrics()
+
+
+def get_route(route_handler: BaseRouteHandler) -> str:
+    """Path template of a route handler, a bounded label unlike the request's path."""
+    return min(route_handler.paths)
+
+
+def get_content_length(message: Message) -> int:
+    for name, value in message.get("headers", ()):
+        if name.lower() == b"content-length":
+            return int(value)
+    return 0
+
+
+class MetricsMiddleware(MiddlewareProtocol):
+    """Records the metrics of every HTTP request, and checks the statements it executed."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != ScopeType.HTTP:
+            await self.app(scope, receive, send)
+            return
+
+        route_handler = scope["route_handler"]
+        route = get_route(route_handler)
+        serves_images = route_handler.opt.get(IMAGE_OPT, False)
+        status, image_bytes = HTTP_500_INTERNAL_SERVER_ERROR, 0
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status, image_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if serves_images and status == HTTP_200_OK:
+                    image_bytes = get_content_length(message)
+            await send(message)
+
+        stats = RequestStats(route, route_handler.opt.get(QUERY_BUDGET_OPT))
+        token = current_request.set(stats)
+        metrics.in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            metrics.in_flight -= 1
+            current_request.reset(token)
+            metrics.record(scope["method"], route, status, duration, stats)
+            if image_bytes > 0:
+                task_id = parse_qs(scope["query_string"].decode("latin-1")).get("task_id")
+                if task_id is not None:
+                    metrics.image_bytes[task_id[0]] += image_bytes
+            # Also reported when the request failed, as it does once over budget in strict mode
+            repeated = query_monitor.find_repeated(route, stats.executions)
+            if repeated:
+                metrics.repeated_statements[scope["method"], route] += len(repeated)
+            query_monitor.check_budget(route, stats.budget, stats.statements, repeated)
+
+
+# Listens to every engine, including those jobs and tests create, outside of requests it is a no-op
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn: Connection, *args: Any) -> None:
+    if current_request.get() is not None:
+        # A connection executes one statement at a time, one that failed is overwritten
+        conn.info["statement_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement(conn: Connection, cursor: Any, statement: str, *args: Any) -> None:
+    stats = current_request.get()
+    start = conn.info.pop("statement_start", None)
+    if stats is not None and start is not None:
+        stats.statements += 1
+        stats.db_seconds += time.perf_counter() - start
+        stats.executions[statement] += 1
+        query_monitor.check_statement(stats.route, stats.budget, stats.statements)
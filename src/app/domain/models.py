@@ -1,6 +1,7 @@
 import os
 import re
-from typing import Annotated, NotRequired, Self, TypedDict
+from datetime import datetime
+from typing import Annotated, Literal, NotRequired, Self, TypedDict
 from urllib.parse import unquote
 from uuid import UUID
 
@@ -126,6 +127,20 @@ class TaskData(TaskBaseData):
     root: ValidURIEncodedDirectoryPath
 
 
+class TaskSummary(TypedDict):
+    """Aggregated, annotation-free view of a task used to render the task panel."""
+
+    id: UUID
+    title: str
+    root_folder: str
+    creator_id: UUID
+    created_at: datetime
+    updated_at: datetime
+    creator_name: str
+    labeled_count: int
+    total_count: int
+
+
 class TaskUpdateData(TaskBaseData):
     files: list[ValidPath] = Field(..., description="Files to be added to task")
 
@@ -137,6 +152,32 @@ class TaskUpdateData(TaskBaseData):
         return self
 
 
+# JOB
+class JobData(BaseModel):
+    kind: Literal["export_task", "rescan_task"] = Field(..., description="Kind of job to run")
+    task_id: UUID
+
+
 # ANNOTATION
 class AnnotationUpdateData(BaseModel):
     label: ValidUpdateLabel
+
+
+class AnnotationFilter(BaseModel):
+    labeled: bool | None = Field(None, description="Only labeled, or only unlabeled, annotations")
+    label: str | None = Field(None, description="Only annotations currently given this label")
+
+
+class AnnotationBulkUpdateData(BaseModel):
+    label: ValidUpdateLabel
+    annotation_ids: list[int] | None = Field(
+        None, max_length=constants.MAX_BULK_ANNOTATIONS, description="Annotations to update"
+    )
+    filter: AnnotationFilter | None = Field(None, description="Annotations to update, by filter")
+
+    @model_validator(mode="after")
+    def validate_selection(self) -> Self:
+        if (self.annotation_ids is None) == (self.filter is None):
+            raise ValueError("Select annotations either by annotation_ids or by filter.")
+
+        return self
@@ -0,0 +1,71 @@
+"""
+Checks of the SQL statements a request executes, which app.domain.metrics counts. A route handler
+declares the most statements a request may execute with the `query_budget` option, and a request
+over its budget is reported. So is a statement executed more than `QUERY_REPEAT_THRESHOLD` times
+in one request, the signature of an N+1 pattern: statements are parameterized, so the executions
+of a query issued per row share their text. In strict mode, which the tests enable, the statement
+that takes a request over its budget raises, failing the request, so that regressions fail the
+suite rather than reach production.
+"""
+
+import logging
+from collections import Counter
+
+from app.config.base import AppSettings, get_settings
+
+logger = logging.getLogger(__name__)
+
+""" Route handler option of the most statements a request may execute """
+QUERY_BUDGET_OPT = "query_budget"
+REPORTED_STATEMENT_LENGTH = 200
+
+
+class QueryBudgetExceededError(Exception):
+    """Raised in strict mode by the statement taking a request over its budget"""
+
+
+class QueryMonitor:
+    """Reports requests executing more statements than they should."""
+
+    def __init__(self, settings: AppSettings) -> None:
+        self.repeat_threshold = settings.QUERY_REPEAT_THRESHOLD
+        self.strict = settings.QUERY_BUDGET_STRICT
+
+    def find_repeated(self, route: str, statements: Counter[str]) -> list[tuple[str, int]]:
+        """Report the statements a request executed over the repeat threshold, and return them."""
+        if statements.total() <= self.repeat_threshold:
+            return []
+        repeated = [(s, n) for s, n in statements.most_common() if n > self.repeat_threshold]
+        for statement, count in repeated:
+            logger.warning(
+                "Likely N+1 in %s, executed %d times: %s", route, count, shorten(statement)
+            )
+        return repeated
+
+    def check_statement(self, route: str, budget: int | None, count: int) -> None:
+        """In strict mode, raise from the statement of a request that goes over its budget."""
+        if self.strict and budget is not None and count == budget + 1:
+            raise QueryBudgetExceededError(
+                f"{route} executed {count} statements, over its budget of {budget}"
+            )
+
+    def check_budget(
+        self, route: str, budget: int | None, count: int, repeated: list[tuple[str, int]]
+    ) -> None:
+        """Report a request that executed more statements than its budget, once it is served."""
+        if budget is None or count <= budget:
+            return
+        message = f"{route} executed {count} statements, over its budget of {budget}"
+        if repeated:
+            message += f", {repeated[0][1]} times {shorten(repeated[0][0])}"
+        logger.warning(message)
+
+
+def shorten(statement: str) -> str:
+    statement = " ".join(statement.split())
+    if len(statement) > REPORTED_STATEMENT_LENGTH:
+        return statement[:REPORTED_STATEMENT_LENGTH] + "..."
+    return statement
+
+
+query_monitor = QueryMonitor(get_settings().app)
@@ -0,0 +1,367 @@
+"""
+On-disk cache of downscaled image renditions (task thumbnails and display-size images).
+Renditions are generated once in a worker process pool and served in place of full resolution
+originals. The cache is keyed by source path, mtime, size and variant, so an edited image gets a
+new rendition, and is bounded by a byte budget with least recently used eviction.
+"""
+
+import asyncio
+import hashlib
+import mimetypes
+import multiprocessing
+import os
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, TypeVar
+
+from PIL import Image, UnidentifiedImageError
+from pydicom.errors import InvalidDicomError
+
+from app.config.base import RenditionSettings, get_settings
+from app.domain.constants import DICOM_EXTENSIONS
+from app.domain.dicom import read_dicom_image
+from app.domain.tiles import (
+    LEVEL_SUFFIX,
+    TILE_FORMAT,
+    TILE_MEDIA_TYPE,
+    Pyramid,
+    build_level,
+    build_top_level,
+    read_image_size,
+    render_tile,
+)
+
+T = TypeVar("T")
+
+RENDITION_SUFFIX = ".webp"
+RENDITION_MEDIA_TYPE = "image/webp"
+# Empty marker recording that the original should be served as is for a variant
+ORIGINAL_MARKER_SUFFIX = ".orig"
+# Empty marker recording that a DICOM file could not be decoded for a variant
+UNDECODABLE_MARKER_SUFFIX = ".fail"
+# Formats browsers render natively, served without re-encoding when already small enough
+BROWSER_FORMATS = {"PNG", "JPEG", "GIF", "WEBP", "BMP"}
+
+
+class UndecodableImageError(Exception):
+    """Raised for an image that can neither be rendered nor served as is, e.g. a broken DICOM."""
+
+
+class ImageTooLargeError(Exception):
+    """Raised for an image past the size pyramids can be built for, see MAX_PYRAMID_PIXELS."""
+
+
+@dataclass(frozen=True)
+class Rendition:
+    path: Path
+    media_type: str
+    """ Cache key of the rendition, a strong validator of its content """
+    key: str
+
+
+def guess_media_type(path: Path) -> str:
+    return mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+
+
+def is_dicom(path: Path) -> bool:
+    return path.suffix.lower() in DICOM_EXTENSIONS
+
+
+def render_image(
+    source: str, destination: str, max_size: int, quality: int, window: str = "default"
+) -> bool:
+    """
+    Downscale an image to fit inside a max_size square and encode it as WebP. Runs in a worker
+    process. Returns False without writing anything when the original is already small enough
+    and in a browser-friendly format, in which case the original should be served instead.
+
+    DICOM files are always rendered, windowed with the given preset, and encoded losslessly so
+    no compression artefacts are added on top of the windowing.
+    """
+    dicom = is_dicom(Path(source))
+    with read_dicom_image(source, window) if dicom else Image.open(source) as image:
+        if not dicom and max(image.size) <= max_size and image.format in BROWSER_FORMATS:
+            return False
+
+        image.thumbnail((max_size, max_size))
+        rendition = image
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            rendition = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+        temp_destination = f"{destination}.{os.getpid()}.tmp"
+        rendition.save(temp_destination, format="WEBP", quality=quality, lossless=dicom)
+
+    os.replace(temp_destination, destination)  # atomic, readers never see a partial file
+    return True
+
+
+class RenditionCache:
+    """LRU, byte-bounded cache of image renditions stored under a cache directory."""
+
+    def __init__(self, settings: RenditionSettings) -> None:
+        self.cache_dir = Path(settings.CACHE_DIR).resolve()
+        self.max_bytes = settings.MAX_BYTES
+        self.workers = settings.WORKERS
+        self.quality = settings.QUALITY
+        self.variants = {"thumbnail": settings.THUMBNAIL_SIZE, "display": settings.DISPLAY_SIZE}
+        self.tile_size = settings.TILE_SIZE
+        self.tile_overlap = settings.TILE_OVERLAP
+        self.max_pyramid_pixels = settings.MAX_PYRAMID_PIXELS
+
+        self._entries: OrderedDict[Path, int] | None = None  # cached file -> bytes, oldest first
+        self._total_bytes = 0
+        self._pending: dict[Path, asyncio.Future[Any]] = {}
+        self._pool: ProcessPoolExecutor | None = None
+
+    def get_key(self, source: Path, variant: str, window: str = "default") -> str:
+        """
+        Key identifying the rendition of an image, derived from the file's identity (path, mtime
+        and size) without reading it. `window` is the `DICOM_WINDOW_PRESETS` preset applied to
+        DICOM files and is ignored for other images.
+        """
+        if not is_dicom(source):
+            window = "default"
+        stat = source.stat()
+        identity = f"{source}\0{stat.st_mtime_ns}\0{stat.st_size}\0{variant}\0{window}"
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    async def get(self, source: Path, variant: str, window: str = "default") -> Rendition:
+        """
+        Get the rendition of an image for a variant, generating it on first request. Raises
+        UndecodableImageError for DICOM files that cannot be decoded, which browsers could not
+        display either.
+        """
+        key = self.get_key(source, variant, window)
+        rendition_path = self.cache_dir / key[:2] / f"{key}{RENDITION_SUFFIX}"
+        marker_path = rendition_path.with_suffix(ORIGINAL_MARKER_SUFFIX)
+
+        if self._touch(rendition_path):
+            return Rendition(rendition_path, RENDITION_MEDIA_TYPE, key)
+        if self._touch(marker_path):
+            return Rendition(source, guess_media_type(source), key)
+        if self._touch(rendition_path.with_suffix(UNDECODABLE_MARKER_SUFFIX)):
+            raise UndecodableImageError(f"{source} cannot be decoded")
+
+        rendered = await self._once(
+            rendition_path,
+            lambda: self._render(
+                source, rendition_path, marker_path, self.variants[variant], window
+            ),
+        )
+        if rendered:
+            return Rendition(rendition_path, RENDITION_MEDIA_TYPE, key)
+        return Rendition(source, guess_media_type(source), key)
+
+    async def get_pyramid(self, source: Path) -> Pyramid:
+        """
+        Get the Deep Zoom pyramid layout of an image, read from its header. Raises
+        ImageTooLargeError for images past MAX_PYRAMID_PIXELS, which are decoded whole to build
+        their pyramid.
+        """
+        width, height = await asyncio.to_thread(read_image_size, source)
+        if width * height > self.max_pyramid_pixels:
+            raise ImageTooLargeError(f"{source} is too large to tile ({width}x{height})")
+        return Pyramid(width, height, self.tile_size, self.tile_overlap)
+
+    async def get_tile(
+        self, source: Path, pyramid: Pyramid, level: int, col: int, row: int
+    ) -> Rendition:
+        """
+        Get a Deep Zoom tile of an image. Pyramid levels are built lazily, the first tile of a
+        level builds it and every level above it that is not cached yet. The full resolution
+        level is cut into tiles all at once, as it is never stored uncompressed.
+        """
+        key = self.get_key(source, "tiles")
+        tiles_dir = self.cache_dir / key[:2] / f"{key}_files"  # the layout DZI viewers expect
+        tile_path = tiles_dir / str(level) / f"{col}_{row}.{TILE_FORMAT}"
+
+        if level == pyramid.max_level and not self._touch(tile_path):
+            await self._build_top_level(source, tiles_dir, pyramid)
+        elif not self._touch(tile_path):
+            level_path = await self._get_level(source, tiles_dir, pyramid, level)
+            await self._once(
+                tile_path,
+                lambda: self._build(
+                    tile_path,
+                    render_tile,
+                    str(level_path),
+                    str(tile_path),
+                    (col, row),
+                    pyramid,
+                    self.quality,
+                ),
+            )
+        return Rendition(tile_path, TILE_MEDIA_TYPE, self.get_tile_key(source, level, col, row))
+
+    def get_tile_key(self, source: Path, level: int, col: int, row: int) -> str:
+        return f"{self.get_key(source, 'tiles')}-{level}-{col}-{row}"
+
+    async def prewarm(self, renditions: Iterable[tuple[Path, str]]) -> None:
+        """Generate renditions ahead of their first request, e.g. as a background task."""
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def warm(source: Path, variant: str) -> None:
+            async with semaphore:
+                try:
+                    await self.get(source, variant)
+                except OSError:
+                    pass  # source removed since it was queued, nothing to warm
+                except UndecodableImageError:
+                    pass  # the failure is cached like a rendition
+
+        await asyncio.gather(*(warm(source, variant) for source, variant in renditions))
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    async def _once(self, path: Path, factory: Callable[[], Awaitable[T]]) -> T:
+        """Concurrent requests for the same cached file share a single build of it."""
+        future = self._pending.get(path)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._pending[path] = future
+            future.add_done_callback(lambda _: self._pending.pop(path, None))
+        return await asyncio.shield(future)
+
+    async def _get_level(self, source: Path, tiles_dir: Path, pyramid: Pyramid, level: int) -> Path:
+        level_path = tiles_dir / f"{level}{LEVEL_SUFFIX}"
+        if self._touch(level_path):
+            return level_path
+
+        if level == pyramid.max_level - 1:
+            await self._build_top_level(source, tiles_dir, pyramid)
+        else:
+            higher_level_path = await self._get_level(source, tiles_dir, pyramid, level + 1)
+            await self._once(
+                level_path,
+                lambda: self._build(
+                    level_path, build_level, str(higher_level_path), str(level_path)
+                ),
+            )
+        return level_path
+
+    async def _build_top_level(self, source: Path, tiles_dir: Path, pyramid: Pyramid) -> None:
+        """Cut the full resolution tiles and build the level below them, in one pass."""
+
+        async def build() -> None:
+            loop = asyncio.get_running_loop()
+            written = await loop.run_in_executor(
+                self._get_pool(),
+                build_top_level,
+                str(source),
+                str(tiles_dir),
+                pyramid,
+                self.quality,
+            )
+            for path, size in written:
+                self._add(Path(path), size)
+
+        await self._once(tiles_dir / str(pyramid.max_level), build)
+
+    async def _build(self, destination: Path, function: Callable[..., None], *args: Any) -> None:
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._get_pool(), function, *args)
+        self._add(destination, destination.stat().st_size)
+
+    async def _render(  # noqa: PLR0913 (too many arguments)
+        self, source: Path, rendition_path: Path, marker_path: Path, max_size: int, window: str
+    ) -> bool:
+        rendition_path.parent.mkdir(parents=True, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        try:
+            rendered = await loop.run_in_executor(
+                self._get_pool(),
+                render_image,
+                str(source),
+                str(rendition_path),
+                max_size,
+                self.quality,
+                window,
+            )
+        except (
+            UnidentifiedImageError,
+            Image.DecompressionBombError,
+            OSError,
+            InvalidDicomError,
+            NotImplementedError,  # no pixel data handler installed for the DICOM transfer syntax
+            RuntimeError,
+        ) as e:
+            if not is_dicom(source):
+                return False  # not decodable, serve the original without caching
+            # A file edited in place gets a new key, so the failure is only recorded for this one
+            failure_path = rendition_path.with_suffix(UNDECODABLE_MARKER_SUFFIX)
+            failure_path.touch()
+            self._add(failure_path, 0)
+            raise UndecodableImageError(f"{source} cannot be decoded") from e
+
+        if rendered:
+            self._add(rendition_path, rendition_path.stat().st_size)
+        else:
+            marker_path.touch()
+            self._add(marker_path, 0)
+        return rendered
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn rather than fork: forking the threaded server process is unsafe and
+            # spawn is the only start method on Windows anyway
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def _get_entries(self) -> OrderedDict[Path, int]:
+        """Index of cached files, rebuilt from the cache directory on first use."""
+        if self._entries is None:
+            found: list[tuple[float, Path, int]] = []
+            suffixes = (
+                RENDITION_SUFFIX,
+                ORIGINAL_MARKER_SUFFIX,
+                UNDECODABLE_MARKER_SUFFIX,
+                LEVEL_SUFFIX,
+                f".{TILE_FORMAT}",
+            )
+            for path in self.cache_dir.rglob("*"):
+                if path.suffix in suffixes:
+                    stat = path.stat()
+                    found.append((stat.st_mtime, path, stat.st_size))
+            found.sort()
+            self._entries = OrderedDict((path, size) for _, path, size in found)
+            self._total_bytes = sum(self._entries.values())
+        return self._entries
+
+    def _touch(self, path: Path) -> bool:
+        """Mark a cached file as most recently used. Returns False if it is not cached."""
+        entries = self._get_entries()
+        try:
+            os.utime(path)  # persists recency across restarts
+        except FileNotFoundError:
+            if path in entries:  # evicted by another worker process
+                self._total_bytes -= entries.pop(path)
+            return False
+        if path not in entries:  # cached by another worker process since the index was built
+            self._add(path, path.stat().st_size)
+        entries.move_to_end(path)
+        return True
+
+    def _add(self, path: Path, size: int) -> None:
+        entries = self._get_entries()
+        if path in entries:
+            self._total_bytes -= entries[path]
+        entries[path] = size
+        entries.move_to_end(path)
+        self._total_bytes += size
+
+        while self._total_bytes > self.max_bytes and len(entries) > 1:
+            evicted, evicted_size = entries.popitem(last=False)
+            evicted.unlink(missing_ok=True)
+            self._total_bytes -= evicted_size
+
+
+rendition_cache = RenditionCache(get_settings().rendition)
@@ -1,6 +1,6 @@
 from advanced_alchemy.repository import SQLAlchemyAsyncRepository
 
-from app.domain.schema import Annotation, LabelKeybind, Task, User
+from app.domain.schema import Annotation, Job, LabelKeybind, Task, TaskFile, User
 
 
 class UserRepository(SQLAlchemyAsyncRepository[User]):
@@ -21,6 +21,18 @@ class LabelKeybindRepository(SQLAlchemyAsyncRepository[LabelKeybind]):
     model_type = LabelKeybind
 
 
+class TaskFileRepository(SQLAlchemyAsyncRepository[TaskFile]):
+    """TaskFile SQLAlchemy Repository."""
+
+    model_type = TaskFile
+
+
+class JobRepository(SQLAlchemyAsyncRepository[Job]):
+    """Job SQLAlchemy Repository."""
+
+    model_type = Job
+
+
 class AnnotationRepository(SQLAlchemyAsyncRepository[Annotation]):
     """Annotation SQLAlchemy Repository."""
 
@@ -1,14 +1,33 @@
+from datetime import datetime
 from uuid import UUID
 
 from advanced_alchemy.base import BigIntAuditBase, UUIDAuditBase
-from sqlalchemy import CHAR, Boolean, Column, Float, ForeignKey, String, Table
+from advanced_alchemy.types import DateTimeUTC
+from sqlalchemy import (
+    CHAR,
+    BigInteger,
+    Boolean,
+    Column,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Table,
+    UniqueConstraint,
+    event,
+)
 from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.schema import DDL
 
 # Written in this weird way to satisfy mypy
 user_id_column: Column[UUID] = Column("user_id", ForeignKey("users.id"), primary_key=True)
 task_id_column: Column[UUID] = Column("task_id", ForeignKey("tasks.id"), primary_key=True)
 user_tasks = Table("user_tasks", UUIDAuditBase.metadata, user_id_column, task_id_column)
 
+# Relationships are never loaded implicitly, accessing one that was not loaded raises. Endpoints
+# load them through their load profile, see app.domain.loading.
+
 
 class User(UUIDAuditBase):
     __tablename__ = "users"
@@ -17,12 +36,18 @@ class User(UUIDAuditBase):
     password: Mapped[str] = mapped_column(String, nullable=False)
     annotation_rate: Mapped[float] = mapped_column(Float, default=0.0, nullable=False)
 
-    created_tasks = relationship("Task", back_populates="creator", lazy="selectin")
+    created_tasks = relationship("Task", back_populates="creator", lazy="raise")
     assigned_tasks = relationship(
-        "Task", secondary=user_tasks, back_populates="contributors", lazy="selectin"
+        "Task", secondary=user_tasks, back_populates="contributors", lazy="raise"
     )
+    # In the order the keybinds were created, which databases other than SQLite do not return
+    # rows in unless asked to
     label_keybinds = relationship(
-        "LabelKeybind", back_populates="user", lazy="selectin", cascade="all, delete-orphan"
+        "LabelKeybind",
+        back_populates="user",
+        lazy="raise",
+        cascade="all, delete-orphan",
+        order_by="LabelKeybind.created_at",
     )
 
 
@@ -32,35 +57,223 @@ class Task(UUIDAuditBase):
     title: Mapped[str] = mapped_column(String, nullable=False)
     root_folder: Mapped[str] = mapped_column(String, nullable=False)
     creator_id: Mapped[UUID] = mapped_column(ForeignKey("users.id", ondelete="SET NULL"))
+    # mtime of root_folder when task_files was last synced with it, None if never scanned
+    root_folder_mtime_ns: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    # Progress counters, maintained by the annotations triggers below in the same transaction as
+    # the annotations change. `litestar tasks repair-progress` recomputes them.
+    labeled_count: Mapped[int] = mapped_column(
+        Integer, default=0, server_default="0", nullable=False
+    )
+    total_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
 
-    creator = relationship("User", back_populates="created_tasks", lazy="joined")
+    creator = relationship("User", back_populates="created_tasks", lazy="raise")
     contributors = relationship(
         "User",
         secondary=user_tasks,
         back_populates="assigned_tasks",
-        lazy="selectin",
+        lazy="raise",
     )
     annotations = relationship(
         "Annotation",
         back_populates="associated_task",
-        lazy="selectin",
+        lazy="raise",
         cascade="all, delete-orphan",
     )
     label_keybinds = relationship(
-        "LabelKeybind", back_populates="task", lazy="selectin", cascade="all, delete-orphan"
+        "LabelKeybind",
+        back_populates="task",
+        lazy="raise",
+        cascade="all, delete-orphan",
+        order_by="LabelKeybind.created_at",
     )
 
 
 class Annotation(BigIntAuditBase):
     __tablename__ = "annotations"
-    __table_args__ = {"comment": "Record of annotation and label"}
+    __table_args__ = (
+        # Serves "next unlabeled annotation of a task" lookups as an index range scan
+        Index("ix_annotations_task_id_labeled_id", "task_id", "labeled", "id"),
+        # Serves matching a task's catalogued files against its annotations
+        Index("ix_annotations_task_id_filepath", "task_id", "filepath"),
+        # Serves delta exports of the annotations changed since a cursor
+        Index("ix_annotations_task_id_updated_at_id", "task_id", "updated_at", "id"),
+        {"comment": "Record of annotation and label"},
+    )
     label: Mapped[str | None] = mapped_column(String, nullable=True)
     labeled: Mapped[bool] = mapped_column(Boolean, nullable=False)
     labeled_by: Mapped[UUID | None] = mapped_column(ForeignKey("users.id"), nullable=True)
     filepath: Mapped[str] = mapped_column(String, nullable=False)
     task_id: Mapped[UUID] = mapped_column(ForeignKey("tasks.id"), nullable=False)
+    # Work queue lease: an unlabeled annotation is handed to one annotator at a time until the
+    # lease expires, after which any contributor may claim it again
+    claimed_by: Mapped[UUID | None] = mapped_column(ForeignKey("users.id"), nullable=True)
+    lease_expires_at: Mapped[datetime | None] = mapped_column(DateTimeUTC, nullable=True)
+
+    associated_task = relationship("Task", back_populates="annotations", lazy="raise")
+
+
+# Number of annotations of a task each user labeled, maintained like the task counters
+task_user_progress = Table(
+    "task_user_progress",
+    UUIDAuditBase.metadata,
+    Column("task_id", ForeignKey("tasks.id", ondelete="CASCADE"), primary_key=True),
+    Column("user_id", ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+    Column("labeled_count", Integer, nullable=False, default=0),
+)
 
-    associated_task = relationship("Task", back_populates="annotations", lazy="joined")
+# SQLite triggers keeping the progress counters in step with every write to annotations, whether
+# through the ORM or bulk statements. An annotation is counted out of its old task and labeler
+# and into its new ones; labeled is stored as 0 or 1.
+_COUNT_ANNOTATION_IN = """
+    UPDATE tasks SET total_count = total_count + 1, labeled_count = labeled_count + NEW.labeled
+    WHERE id = NEW.task_id;
+    INSERT INTO task_user_progress (task_id, user_id, labeled_count)
+    SELECT NEW.task_id, NEW.labeled_by, 1 WHERE NEW.labeled AND NEW.labeled_by IS NOT NULL
+    ON CONFLICT (task_id, user_id) DO UPDATE SET labeled_count = labeled_count + 1;
+"""
+_COUNT_ANNOTATION_OUT = """
+    UPDATE tasks SET total_count = total_count - 1, labeled_count = labeled_count - OLD.labeled
+    WHERE id = OLD.task_id;
+    UPDATE task_user_progress SET labeled_count = labeled_count - 1
+    WHERE OLD.labeled AND task_id = OLD.task_id AND user_id = OLD.labeled_by;
+"""
+# By trigger name. The migrations that created them hold copies of their DDL
+ANNOTATION_PROGRESS_TRIGGERS = {
+    "annotations_progress_insert": f"""
+    CREATE TRIGGER annotations_progress_insert AFTER INSERT ON annotations
+    BEGIN {_COUNT_ANNOTATION_IN} END
+    """,
+    "annotations_progress_delete": f"""
+    CREATE TRIGGER annotations_progress_delete AFTER DELETE ON annotations
+    BEGIN {_COUNT_ANNOTATION_OUT} END
+    """,
+    "annotations_progress_update": f"""
+    CREATE TRIGGER annotations_progress_update AFTER UPDATE OF labeled, labeled_by, task_id
+    ON annotations
+    WHEN OLD.labeled IS NOT NEW.labeled
+        OR OLD.labeled_by IS NOT NEW.labeled_by
+        OR OLD.task_id IS NOT NEW.task_id
+    BEGIN {_COUNT_ANNOTATION_OUT} {_COUNT_ANNOTATION_IN} END
+    """,
+}
+for trigger in ANNOTATION_PROGRESS_TRIGGERS.values():
+    event.listen(Annotation.__table__, "after_create", DDL(trigger).execute_if(dialect="sqlite"))
+
+# PostgreSQL triggers fire once per statement and count the rows it changed from its transition
+# tables, so a bulk insert or update adjusts each counter once rather than once per row. Rows
+# counted out carry a sign of -1. A task being deleted has no progress left to keep.
+_COUNT_ANNOTATION_CHANGES = """
+    CREATE OR REPLACE FUNCTION {name}() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        WITH changes AS ({changes}),
+        task_deltas AS (
+            SELECT task_id, sum(sign) AS total, sum(sign * labeled::int) AS labeled
+            FROM changes GROUP BY task_id
+        ),
+        updated_tasks AS (
+            UPDATE tasks SET
+                total_count = total_count + task_deltas.total,
+                labeled_count = labeled_count + task_deltas.labeled
+            FROM task_deltas WHERE tasks.id = task_deltas.task_id
+        )
+        INSERT INTO task_user_progress (task_id, user_id, labeled_count)
+        SELECT changes.task_id, changes.labeled_by, sum(changes.sign)
+        FROM changes JOIN tasks ON tasks.id = changes.task_id
+        WHERE changes.labeled AND changes.labeled_by IS NOT NULL
+        GROUP BY changes.task_id, changes.labeled_by
+        ON CONFLICT (task_id, user_id) DO UPDATE
+        SET labeled_count = task_user_progress.labeled_count + EXCLUDED.labeled_count;
+        RETURN NULL;
+    END $$
+"""
+_UPDATED_ANNOTATIONS = """
+    FROM old_annotations old_row
+    JOIN new_annotations new_row ON new_row.id = old_row.id
+    WHERE old_row.labeled IS DISTINCT FROM new_row.labeled
+        OR old_row.labeled_by IS DISTINCT FROM new_row.labeled_by
+        OR old_row.task_id IS DISTINCT FROM new_row.task_id
+"""
+# By trigger name, its function and then the trigger, each function being named after its trigger.
+# The migration that created them holds a copy of their DDL
+ANNOTATION_PROGRESS_TRIGGERS_POSTGRESQL = {
+    "annotations_progress_insert": (
+        _COUNT_ANNOTATION_CHANGES.format(
+            name="annotations_progress_insert",
+            changes="SELECT task_id, labeled_by, labeled, 1 AS sign FROM new_annotations",
+        ),
+        """
+        CREATE TRIGGER annotations_progress_insert AFTER INSERT ON annotations
+        REFERENCING NEW TABLE AS new_annotations
+        FOR EACH STATEMENT EXECUTE FUNCTION annotations_progress_insert()
+        """,
+    ),
+    "annotations_progress_delete": (
+        _COUNT_ANNOTATION_CHANGES.format(
+            name="annotations_progress_delete",
+            changes="SELECT task_id, labeled_by, labeled, -1 AS sign FROM old_annotations",
+        ),
+        """
+        CREATE TRIGGER annotations_progress_delete AFTER DELETE ON annotations
+        REFERENCING OLD TABLE AS old_annotations
+        FOR EACH STATEMENT EXECUTE FUNCTION annotations_progress_delete()
+        """,
+    ),
+    "annotations_progress_update": (
+        _COUNT_ANNOTATION_CHANGES.format(
+            name="annotations_progress_update",
+            changes=f"""
+                SELECT old_row.task_id, old_row.labeled_by, old_row.labeled, -1 AS sign
+                {_UPDATED_ANNOTATIONS}
+                UNION ALL
+                SELECT new_row.task_id, new_row.labeled_by, new_row.labeled, 1 AS sign
+                {_UPDATED_ANNOTATIONS}
+            """,
+        ),
+        # Transition tables rule out an UPDATE OF column list, unchanged rows are filtered out
+        """
+        CREATE TRIGGER annotations_progress_update AFTER UPDATE ON annotations
+        REFERENCING OLD TABLE AS old_annotations NEW TABLE AS new_annotations
+        FOR EACH STATEMENT EXECUTE FUNCTION annotations_progress_update()
+        """,
+    ),
+}
+for function, trigger in ANNOTATION_PROGRESS_TRIGGERS_POSTGRESQL.values():
+    for ddl in (function, trigger):
+        event.listen(
+            Annotation.__table__, "after_create", DDL(ddl).execute_if(dialect="postgresql")
+        )
+
+
+class TaskFile(BigIntAuditBase):
+    __tablename__ = "task_files"
+    __table_args__ = (
+        UniqueConstraint("task_id", "path"),
+        {"comment": "Catalog of the image files in each task's root folder"},
+    )
+    task_id: Mapped[UUID] = mapped_column(ForeignKey("tasks.id", ondelete="CASCADE"))
+    path: Mapped[str] = mapped_column(String, nullable=False)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    mtime_ns: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    extension: Mapped[str] = mapped_column(String, nullable=False)
+
+
+class Job(UUIDAuditBase):
+    __tablename__ = "jobs"
+    __table_args__ = {"comment": "Long running operations executed by the background job runner"}
+    kind: Mapped[str] = mapped_column(String, nullable=False)
+    status: Mapped[str] = mapped_column(String, nullable=False)
+    user_id: Mapped[UUID | None] = mapped_column(
+        ForeignKey("users.id", ondelete="SET NULL"), nullable=True
+    )
+    task_id: Mapped[UUID | None] = mapped_column(
+        ForeignKey("tasks.id", ondelete="SET NULL"), nullable=True
+    )
+    progress: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    # Location of the job's output, e.g. the file an export was written to
+    result: Mapped[str | None] = mapped_column(String, nullable=True)
+    error: Mapped[str | None] = mapped_column(String, nullable=True)
+    started_at: Mapped[datetime | None] = mapped_column(DateTimeUTC, nullable=True)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTimeUTC, nullable=True)
 
 
 class LabelKeybind(UUIDAuditBase):
@@ -71,5 +284,5 @@ class LabelKeybind(UUIDAuditBase):
     user_id: Mapped[UUID] = mapped_column(ForeignKey("users.id"))
     task_id: Mapped[UUID] = mapped_column(ForeignKey("tasks.id"))
 
-    user = relationship("User", back_populates="label_keybinds", lazy="joined")
-    task = relationship("Task", back_populates="label_keybinds", lazy="joined")
+    user = relationship("User", back_populates="label_keybinds", lazy="raise")
+    task = relationship("Task", back_populates="label_keybinds", lazy="raise")
@@ -1,19 +1,111 @@
-from collections.abc import Sequence
-from typing import Any
+import asyncio
+import os
+from collections.abc import Awaitable, Callable, Collection, Iterator, Sequence
+from datetime import UTC, datetime, timedelta
+from itertools import batched
+from pathlib import Path
+from typing import Any, cast
 from uuid import UUID
 
 from advanced_alchemy.service import SQLAlchemyAsyncRepositoryService
-from litestar.exceptions import NotAuthorizedException
+from advanced_alchemy.types import DateTimeUTC
+from litestar.exceptions import (
+    NotAuthorizedException,
+    NotFoundException,
+    PermissionDeniedException,
+)
 from litestar.status_codes import HTTP_401_UNAUTHORIZED
-from sqlalchemy import select
+from sqlalchemy import (
+    BigInteger,
+    Integer,
+    String,
+    and_,
+    column,
+    delete,
+    exists,
+    func,
+    insert,
+    literal,
+    or_,
+    select,
+    table,
+    text,
+    union_all,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, async_scoped_session
+from sqlalchemy.orm import selectinload
 
+from app.domain import constants
+from app.domain.models import TaskSummary
 from app.domain.repositories import (
     AnnotationRepository,
+    JobRepository,
     LabelKeybindRepository,
+    TaskFileRepository,
     TaskRepository,
     UserRepository,
 )
-from app.domain.schema import Annotation, LabelKeybind, Task, User
+from app.domain.schema import (
+    Annotation,
+    Job,
+    LabelKeybind,
+    Task,
+    TaskFile,
+    User,
+    task_user_progress,
+    user_tasks,
+)
+
+# Each task is two terms of the compound select, within SQLite's limit of 500
+PREWARM_TASKS_PER_QUERY = 200
+
+
+def iter_image_folder(root: Path) -> Iterator[tuple[str, int, int, str]]:
+    """
+    Lazily list the image files directly inside a resolved folder as (path, size, mtime_ns,
+    extension). Paths are resolved like annotation filepaths; only symlinks need resolving.
+    """
+    prefix = root.as_posix().rstrip("/")
+    with os.scandir(root) as entries:
+        for entry in entries:
+            extension = os.path.splitext(entry.name)[1]
+            if extension in constants.IMAGE_EXTENSIONS and entry.is_file():
+                stat = entry.stat()
+                if entry.is_symlink():
+                    path = Path(entry.path).resolve().as_posix()
+                else:
+                    path = f"{prefix}/{entry.name}"
+                yield path, stat.st_size, stat.st_mtime_ns, extension
+
+
+def scan_image_folder(root: Path) -> dict[str, tuple[int, int, str]]:
+    """List the image files directly inside a folder, as path -> (size, mtime_ns, extension)."""
+    return {path: (size, mtime_ns, ext) for path, size, mtime_ns, ext in iter_image_folder(root)}
+
+
+def is_postgresql(session: AsyncSession | async_scoped_session[AsyncSession]) -> bool:
+    return session.get_bind().dialect.name == "postgresql"
+
+
+def upsert(
+    session: AsyncSession | async_scoped_session[AsyncSession], target: Any
+) -> postgresql.Insert | sqlite.Insert:
+    """INSERT supporting the ON CONFLICT clauses of the database a session is bound to."""
+    if is_postgresql(session):
+        return postgresql.insert(target)
+    return sqlite.insert(target)
+
+
+# Temporary table catalog rows are copied into on PostgreSQL, dropped when the batch commits
+task_files_copy = table(
+    "task_files_copy",
+    column("path", String),
+    column("size", BigInteger),
+    column("mtime_ns", BigInteger),
+    column("extension", String),
+)
 
 
 class UserService(SQLAlchemyAsyncRepositoryService[User]):
@@ -65,19 +157,282 @@ class TaskService(SQLAlchemyAsyncRepositoryService[Task]):
 
     async def get_all_tasks(self) -> Sequence[Task]:
         """Get all tasks."""
-        stmt = select(Task).order_by(Task.created_at).distinct()
+        stmt = self.repository.statement.order_by(Task.created_at)
         results = await self.repository.session.execute(stmt)
         return results.scalars().unique().all()
 
     async def get_many_by_id(self, identifiers: Sequence[str | int]) -> Sequence[Task]:
-        stmt = select(Task).where(Task.id.in_(identifiers))
+        stmt = self.repository.statement.where(Task.id.in_(identifiers))
         results = await self.repository.session.execute(stmt)
-        res = results.scalars().all()
+        res = results.scalars().unique().all()
         if len(res) > 0:
             return res
 
         return []
 
+    async def get_task_summaries(
+        self, user_id: UUID, assigned: bool = True, task_id: UUID | None = None
+    ) -> list[TaskSummary]:
+        """
+        Get progress summaries for the tasks assigned (or not assigned) to a user. Labeled and
+        total counts are read from the tasks' progress counters, no annotation row is read.
+        """
+        user_task_ids = select(user_tasks.c.task_id).where(user_tasks.c.user_id == user_id)
+        stmt = (
+            select(
+                Task.id,
+                Task.title,
+                Task.root_folder,
+                Task.creator_id,
+                Task.created_at,
+                Task.updated_at,
+                func.coalesce(User.username, "Unknown").label("creator_name"),
+                Task.labeled_count,
+                Task.total_count,
+            )
+            .outerjoin(User, User.id == Task.creator_id)
+            .where(Task.id.in_(user_task_ids) if assigned else Task.id.not_in(user_task_ids))
+            .order_by(Task.created_at)
+        )
+        if task_id is not None:
+            stmt = stmt.where(Task.id == task_id)
+
+        results = await self.repository.session.execute(stmt)
+        return [cast(TaskSummary, row._asdict()) for row in results]
+
+    async def get_title(self, task_id: UUID) -> str:
+        """Get the title of a task without loading its annotations."""
+        title = await self.repository.session.scalar(select(Task.title).where(Task.id == task_id))
+        if title is None:
+            raise NotFoundException("Task does not exist!")
+        return title
+
+    async def get_progress(self, task_id: UUID, user_id: UUID) -> tuple[int, int, int]:
+        """
+        Read the progress counters of a task, as (labeled, total, labeled by the user). A single
+        primary key lookup whatever the size of the task.
+        """
+        stmt = (
+            select(
+                Task.labeled_count,
+                Task.total_count,
+                func.coalesce(task_user_progress.c.labeled_count, 0),
+            )
+            .outerjoin(
+                task_user_progress,
+                and_(
+                    task_user_progress.c.task_id == Task.id,
+                    task_user_progress.c.user_id == user_id,
+                ),
+            )
+            .where(Task.id == task_id)
+        )
+        row = (await self.repository.session.execute(stmt)).one_or_none()
+        if row is None:
+            raise NotFoundException("Task does not exist!")
+        labeled, total, user_labeled = row
+        return labeled, total, user_labeled
+
+    async def repair_progress(self, task_ids: Sequence[UUID] | None = None) -> int:
+        """
+        Recompute the progress counters of tasks, all of them by default, from their annotations.
+        Returns the number of tasks whose counters were recomputed.
+        """
+        session = self.repository.session
+        task_annotations = select(func.count(Annotation.id)).where(Annotation.task_id == Task.id)
+        stmt = (
+            update(Task)
+            .values(
+                total_count=task_annotations.scalar_subquery(),
+                labeled_count=task_annotations.where(
+                    Annotation.labeled.is_(True)
+                ).scalar_subquery(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        user_counts = (
+            select(Annotation.task_id, Annotation.labeled_by, func.count(Annotation.id))
+            .where(Annotation.labeled.is_(True), Annotation.labeled_by.is_not(None))
+            .group_by(Annotation.task_id, Annotation.labeled_by)
+        )
+        clear_user_counts = delete(task_user_progress)
+        if task_ids is not None:
+            stmt = stmt.where(Task.id.in_(task_ids))
+            user_counts = user_counts.where(Annotation.task_id.in_(task_ids))
+            clear_user_counts = clear_user_counts.where(task_user_progress.c.task_id.in_(task_ids))
+
+        repaired = (await session.execute(stmt)).rowcount
+        await session.execute(clear_user_counts)
+        await session.execute(
+            insert(task_user_progress).from_select(
+                ["task_id", "user_id", "labeled_count"], user_counts
+            )
+        )
+        return repaired
+
+    async def get_task_summary(self, user_id: UUID, task_id: UUID) -> TaskSummary:
+        """Get the progress summary of a single task assigned to a user."""
+        summaries = await self.get_task_summaries(user_id, assigned=True, task_id=task_id)
+        if len(summaries) == 0:
+            raise PermissionDeniedException("Task does not belong to user!")
+
+        return summaries[0]
+
+    async def ingest_root_folder(
+        self,
+        task_id: UUID,
+        root_folder: str,
+        batch_size: int,
+        on_progress: Callable[[int], Awaitable[None]] | None = None,
+    ) -> int:
+        """
+        Populate a new task from its root folder, cataloguing every image file and creating an
+        unlabeled annotation for it. The folder is streamed in batches of `batch_size` files,
+        each inserted with executemany, or COPY on PostgreSQL, and committed in its own
+        transaction, so memory use does not grow with the folder size. `on_progress` is
+        called with the running count of ingested files after every batch. Returns the number
+        of files ingested.
+
+        The folder's mtime is only recorded once every file is ingested: until then the task is
+        never scanned, so if ingestion fails the next rescan catalogs the rest of the folder.
+        """
+        session = self.repository.session
+        root = Path(root_folder).resolve()
+        # Taken before listing, so files added meanwhile are caught by the next rescan
+        folder_mtime_ns = root.stat().st_mtime_ns
+        files = iter_image_folder(root)
+        batches = batched(files, batch_size)
+
+        ingested = 0
+        try:
+            while batch := await asyncio.to_thread(next, batches, None):
+                now = datetime.now(UTC)
+                if is_postgresql(session):
+                    catalogued = await self._copy_task_files(task_id, batch, now)
+                else:
+                    result = await session.execute(
+                        # a rescan may have catalogued files added since ingestion started
+                        upsert(session, TaskFile.__table__)
+                        .on_conflict_do_nothing()
+                        .returning(TaskFile.__table__.c.path),
+                        [
+                            {
+                                "task_id": task_id,
+                                "path": path,
+                                "size": size,
+                                "mtime_ns": mtime_ns,
+                                "extension": ext,
+                            }
+                            for path, size, mtime_ns, ext in batch
+                        ],
+                    )
+                    catalogued = list(result.scalars())
+                if catalogued:
+                    await session.execute(
+                        insert(Annotation.__table__),
+                        [
+                            {
+                                "task_id": task_id,
+                                "filepath": path,
+                                "labeled": False,
+                                "created_at": now,
+                                "updated_at": now,
+                            }
+                            for path in catalogued
+                        ],
+                    )
+                await session.commit()
+                ingested += len(batch)
+                if on_progress is not None:
+                    await on_progress(ingested)
+        finally:
+            files.close()  # release the directory handle if ingestion stopped early
+
+        # Files a rescan catalogued while the task was being ingested have no annotation yet
+        now = datetime.now(UTC)
+        await session.execute(
+            insert(Annotation.__table__).from_select(
+                ["task_id", "filepath", "labeled", "created_at", "updated_at"],
+                select(
+                    TaskFile.task_id,
+                    TaskFile.path,
+                    literal(False),
+                    literal(now, DateTimeUTC),
+                    literal(now, DateTimeUTC),
+                ).where(
+                    TaskFile.task_id == task_id,
+                    ~exists().where(
+                        Annotation.task_id == TaskFile.task_id,
+                        Annotation.filepath == TaskFile.path,
+                    ),
+                ),
+            )
+        )
+        await session.execute(
+            update(Task)
+            .where(Task.id == task_id)
+            .values(root_folder_mtime_ns=folder_mtime_ns)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        return ingested
+
+    async def _copy_task_files(
+        self, task_id: UUID, files: Sequence[tuple[str, int, int, str]], now: datetime
+    ) -> list[str]:
+        """
+        Catalog files of a task on PostgreSQL. COPY cannot skip conflicting rows, so the files are
+        copied into a temporary table and inserted from it. Returns the paths catalogued.
+        """
+        session = self.repository.session
+        await session.execute(
+            text(
+                "CREATE TEMPORARY TABLE task_files_copy "
+                "(path text, size bigint, mtime_ns bigint, extension text) ON COMMIT DROP"
+            )
+        )
+        connection = await (await session.connection()).get_raw_connection()
+        await connection.driver_connection.copy_records_to_table(  # type: ignore[union-attr]
+            "task_files_copy", records=files, columns=["path", "size", "mtime_ns", "extension"]
+        )
+        result = await session.execute(
+            # a rescan may have catalogued files added since ingestion started
+            upsert(session, TaskFile.__table__)
+            .from_select(
+                ["task_id", "path", "size", "mtime_ns", "extension", "created_at", "updated_at"],
+                select(
+                    literal(task_id, TaskFile.__table__.c.task_id.type),
+                    task_files_copy.c.path,
+                    task_files_copy.c.size,
+                    task_files_copy.c.mtime_ns,
+                    task_files_copy.c.extension,
+                    literal(now, DateTimeUTC),
+                    literal(now, DateTimeUTC),
+                ),
+            )
+            .on_conflict_do_nothing()
+            .returning(TaskFile.__table__.c.path)
+        )
+        return list(result.scalars())
+
+    async def get_label_keybinds_by_task(
+        self, user_id: UUID, task_ids: Sequence[UUID]
+    ) -> dict[UUID, list[dict[str, str]]]:
+        """Get a user's label keybinds for each of the given tasks."""
+        stmt = (
+            select(LabelKeybind.task_id, LabelKeybind.id, LabelKeybind.label, LabelKeybind.keybind)
+            .where(LabelKeybind.user_id == user_id, LabelKeybind.task_id.in_(task_ids))
+            .order_by(LabelKeybind.created_at)
+        )
+        results = await self.repository.session.execute(stmt)
+
+        label_keybinds: dict[UUID, list[dict[str, str]]] = {tid: [] for tid in task_ids}
+        for row in results:
+            label_keybinds[row.task_id].append(
+                {"label": row.label, "keybind": row.keybind, "id": str(row.id)}
+            )
+        return label_keybinds
+
     async def update_task(
         self,
         task_id: UUID,
@@ -86,8 +441,12 @@ class TaskService(SQLAlchemyAsyncRepositoryService[Task]):
         annotations: list[Annotation],
     ) -> Task:
         """Update a task with new label keybinds and annotations."""
+        # Annotations are only ever loaded here, to be selectively replaced
+        stmt = select(Task).options(
+            selectinload(Task.label_keybinds), selectinload(Task.annotations)
+        )
         async with self.repository.session.begin():
-            task = await self.get_one(id=task_id)
+            task = await self.get_one(id=task_id, statement=stmt)
             await self._update_task_label_keybinds(user_id, task, label_keybinds)
             await self._update_task_annotations(task, annotations)
 
@@ -131,6 +490,104 @@ class TaskService(SQLAlchemyAsyncRepositoryService[Task]):
         return task
 
 
+class TaskFileService(SQLAlchemyAsyncRepositoryService[TaskFile]):
+    """Handles database operations for the catalog of image files in task root folders."""
+
+    repository_type = TaskFileRepository
+
+    def __init__(self, **repo_kwargs: Any) -> None:
+        self.repository: TaskFileRepository = self.repository_type(**repo_kwargs)  # type: ignore
+        self.model_type = self.repository.model_type
+
+    async def refresh_catalog(
+        self, task_id: UUID, root_folder: str, catalog_mtime_ns: int | None = None
+    ) -> bool:
+        """
+        Sync the catalog of a task with its root folder. Adding, removing or renaming a file
+        changes the folder's mtime, so when it matches the mtime recorded at the last scan the
+        folder is not listed at all. Returns whether the folder was rescanned.
+        """
+        root = Path(root_folder).resolve()
+        try:
+            folder_mtime_ns = root.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False  # folder moved or unmounted, keep the catalog as it was last seen
+        if folder_mtime_ns == catalog_mtime_ns:
+            return False
+
+        session = self.repository.session
+        scanned = await asyncio.to_thread(scan_image_folder, root)
+        stmt = select(TaskFile.id, TaskFile.path, TaskFile.size, TaskFile.mtime_ns).where(
+            TaskFile.task_id == task_id
+        )
+        catalogued = {row.path: row for row in await session.execute(stmt)}
+
+        removed_ids = [row.id for path, row in catalogued.items() if path not in scanned]
+        added = [
+            {"task_id": task_id, "path": path, "size": size, "mtime_ns": mtime_ns, "extension": ext}
+            for path, (size, mtime_ns, ext) in scanned.items()
+            if path not in catalogued
+        ]
+        changed = [
+            {"id": row.id, "size": scanned[path][0], "mtime_ns": scanned[path][1]}
+            for path, row in catalogued.items()
+            if path in scanned and (row.size, row.mtime_ns) != scanned[path][:2]
+        ]
+        if len(removed_ids) > 0:
+            await session.execute(delete(TaskFile).where(TaskFile.id.in_(removed_ids)))
+        if len(added) > 0:
+            # a concurrent refresh of the same folder may have catalogued the file already
+            await session.execute(upsert(session, TaskFile).on_conflict_do_nothing(), added)
+        if len(changed) > 0:
+            await session.execute(update(TaskFile), changed)
+        await session.execute(
+            update(Task)
+            .where(Task.id == task_id)
+            .values(root_folder_mtime_ns=folder_mtime_ns)
+            .execution_options(synchronize_session=False)
+        )
+        return True
+
+    async def refresh_catalogs(
+        self, task_ids: Sequence[UUID], unscanned_only: bool = False
+    ) -> None:
+        """Sync the catalogs of several tasks, see `refresh_catalog`."""
+        stmt = select(Task.id, Task.root_folder, Task.root_folder_mtime_ns).where(
+            Task.id.in_(task_ids)
+        )
+        if unscanned_only:
+            stmt = stmt.where(Task.root_folder_mtime_ns.is_(None))
+        for row in (await self.repository.session.execute(stmt)).all():
+            await self.refresh_catalog(row.id, row.root_folder, row.root_folder_mtime_ns)
+
+    async def get_paths(self, task_id: UUID) -> list[str]:
+        """Get the catalogued filepaths of a task, in path order."""
+        stmt = select(TaskFile.path).where(TaskFile.task_id == task_id).order_by(TaskFile.path)
+        return list((await self.repository.session.execute(stmt)).scalars().all())
+
+    async def get_files_by_task(self, task_ids: Sequence[UUID]) -> dict[UUID, list[dict[str, Any]]]:
+        """
+        Get the catalogued files of each of the given tasks in path order, flagging those that
+        are selected for annotation.
+        """
+        stmt = (
+            select(TaskFile.task_id, TaskFile.path, Annotation.id.is_not(None).label("is_selected"))
+            .outerjoin(
+                Annotation,
+                and_(Annotation.task_id == TaskFile.task_id, Annotation.filepath == TaskFile.path),
+            )
+            .where(TaskFile.task_id.in_(task_ids))
+            .distinct()
+            .order_by(TaskFile.task_id, TaskFile.path)
+        )
+        results = await self.repository.session.execute(stmt)
+
+        files: dict[UUID, list[dict[str, Any]]] = {tid: [] for tid in task_ids}
+        for row in results:
+            files[row.task_id].append({"path": row.path, "is_selected": bool(row.is_selected)})
+        return files
+
+
 class LabelKeybindService(SQLAlchemyAsyncRepositoryService[LabelKeybind]):
     """Handles database operations for label keybinds."""
 
@@ -149,3 +606,297 @@ class AnnotationService(SQLAlchemyAsyncRepositoryService[Annotation]):
     def __init__(self, **repo_kwargs: Any) -> None:
         self.repository: AnnotationRepository = self.repository_type(**repo_kwargs)  # type: ignore
         self.model_type = self.repository.model_type
+
+    async def get_next_unlabeled(
+        self, task_id: UUID, exclude_ids: Collection[int] = ()
+    ) -> Annotation | None:
+        """
+        Get the unlabeled annotation with the lowest id in a task, other than `exclude_ids`.
+        Served by the (task_id, labeled, id) index so the cost does not grow with task size.
+        """
+        stmt = (
+            self.repository.statement.where(
+                Annotation.task_id == task_id, Annotation.labeled.is_(False)
+            )
+            .order_by(Annotation.id)
+            .limit(1)
+        )
+        if len(exclude_ids) > 0:
+            stmt = stmt.where(Annotation.id.not_in(exclude_ids))
+        results = await self.repository.session.execute(stmt)
+        return results.scalars().first()
+
+    async def claim_next(
+        self,
+        task_id: UUID,
+        user_id: UUID,
+        lease_duration: timedelta,
+        exclude_ids: Collection[int] = (),
+    ) -> Annotation | None:
+        """Lease the next unlabeled annotation of a task to a user, see `claim_window`."""
+        claimed = await self.claim_window(
+            task_id, user_id, lease_duration, size=1, exclude_ids=exclude_ids
+        )
+        return claimed[0] if len(claimed) > 0 else None
+
+    async def claim_window(  # noqa: PLR0913 (too many arguments)
+        self,
+        task_id: UUID,
+        user_id: UUID,
+        lease_duration: timedelta,
+        size: int,
+        exclude_ids: Collection[int] = (),
+    ) -> Sequence[Annotation]:
+        """
+        Lease up to `size` unlabeled annotations of a task to a user so that concurrent annotators
+        on the same task are never handed the same image.
+
+        Live claims already held by the user are renewed and returned first (e.g. after a page
+        reload). The rest of the window is filled with the lowest id annotations that are
+        unclaimed or whose lease has expired. Each claim is a single UPDATE whose subquery picks
+        the rows, so SQLite's single-writer lock makes selecting and marking them atomic. On
+        PostgreSQL the subquery locks the rows it picks and skips the rows concurrent claims have
+        locked, so claims never wait on or overwrite each other.
+        Annotations in `exclude_ids`, e.g. labeled but not yet written, are never claimed.
+        """
+        now = datetime.now(UTC)
+        unlabeled = select(Annotation.id).where(
+            Annotation.task_id == task_id, Annotation.labeled.is_(False)
+        )
+        if len(exclude_ids) > 0:
+            unlabeled = unlabeled.where(Annotation.id.not_in(exclude_ids))
+        held = unlabeled.where(Annotation.claimed_by == user_id, Annotation.lease_expires_at > now)
+        claimable = unlabeled.where(
+            or_(Annotation.claimed_by.is_(None), Annotation.lease_expires_at <= now)
+        )
+
+        claimed_ids: list[int] = []
+        for candidates in (held, claimable):
+            remaining = size - len(claimed_ids)
+            if remaining <= 0:
+                break
+            stmt = (
+                update(Annotation)
+                .where(
+                    Annotation.id.in_(
+                        candidates.order_by(Annotation.id)
+                        .limit(remaining)
+                        .with_for_update(skip_locked=True)  # ignored by SQLite
+                    )
+                )
+                .values(claimed_by=user_id, lease_expires_at=now + lease_duration)
+                .returning(Annotation.id)
+                .execution_options(synchronize_session=False)
+            )
+            claimed_ids.extend((await self.repository.session.execute(stmt)).scalars().all())
+
+        if len(claimed_ids) == 0:
+            return []
+
+        stmt = (
+            self.repository.statement.where(Annotation.id.in_(claimed_ids))
+            .order_by(Annotation.id)
+            .execution_options(populate_existing=True)
+        )
+        results = await self.repository.session.execute(stmt)
+        return results.scalars().all()
+
+    async def get_task_annotation(self, task_id: UUID, annotation_id: int) -> Annotation | None:
+        """Get an annotation by id, provided it belongs to the given task."""
+        stmt = self.repository.statement.where(
+            Annotation.id == annotation_id, Annotation.task_id == task_id
+        )
+        results = await self.repository.session.execute(stmt)
+        return results.scalars().one_or_none()
+
+    async def get_first_filepath(self, task_id: UUID) -> str | None:
+        """Get the filepath of the lowest id annotation of a task, used as its thumbnail."""
+        stmt = (
+            select(Annotation.filepath)
+            .where(Annotation.task_id == task_id)
+            .order_by(Annotation.id)
+            .limit(1)
+        )
+        return (await self.repository.session.execute(stmt)).scalar_one_or_none()
+
+    async def get_prewarm_paths(
+        self, task_ids: Sequence[UUID], count: int
+    ) -> list[tuple[Path, str]]:
+        """
+        Images to render ahead of time for tasks: the thumbnail and the next `count` to label, as
+        (path, rendition variant) pairs. A single query fetches them for many tasks, a union of
+        one limited branch per task and variant, each stopping early on the task's id index.
+        """
+        prewarm_paths: list[tuple[Path, str]] = []
+        for batch in batched(task_ids, PREWARM_TASKS_PER_QUERY):
+            branches = []
+            for position, task_id in enumerate(batch):
+                by_id = (
+                    select(Annotation.filepath, Annotation.id)
+                    .where(Annotation.task_id == task_id)
+                    .order_by(Annotation.id)
+                )
+                variants = (
+                    ("thumbnail", by_id.limit(1)),
+                    ("display", by_id.where(Annotation.labeled.is_(False)).limit(count)),
+                )
+                for rank, (variant, stmt) in enumerate(variants):
+                    branch = stmt.add_columns(
+                        literal(2 * position + rank, Integer).label("rank"),
+                        literal(variant).label("variant"),
+                    ).subquery()  # a compound select cannot limit its terms directly
+                    branches.append(select(branch))
+            stmt = union_all(*branches).order_by(text("rank"), text("id"))
+            rows = await self.repository.session.execute(stmt)
+            prewarm_paths.extend((Path(row.filepath).resolve(), row.variant) for row in rows)
+        return prewarm_paths
+
+    async def bulk_label(  # noqa: PLR0913 (too many arguments)
+        self,
+        task_id: UUID,
+        *,
+        user_id: UUID,
+        label: str | None,
+        annotation_ids: Sequence[int] | None = None,
+        labeled: bool | None = None,
+        current_label: str | None = None,
+    ) -> int:
+        """
+        Give many annotations of a task the same label, or undo their labels when it is empty.
+        Annotations are selected by id or, without `annotation_ids`, by their labeled state and
+        current label. Annotations that already have the label are left untouched, claims on the
+        others are released. Returns the number of annotations updated.
+        """
+        label = label or None
+        is_labeled = label is not None
+        stmt = (
+            update(Annotation)
+            .where(
+                Annotation.task_id == task_id,
+                or_(
+                    Annotation.labeled.is_not(is_labeled), Annotation.label.is_distinct_from(label)
+                ),
+            )
+            .values(
+                label=label,
+                labeled=is_labeled,
+                labeled_by=user_id,
+                claimed_by=None,
+                lease_expires_at=None,
+                # set by hand, bulk updates bypass the ORM events that keep it current
+                updated_at=datetime.now(UTC),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        if labeled is not None:
+            stmt = stmt.where(Annotation.labeled.is_(labeled))
+        if current_label is not None:
+            stmt = stmt.where(Annotation.label == current_label)
+
+        session = self.repository.session
+        if annotation_ids is None:
+            return (await session.execute(stmt)).rowcount
+
+        updated = 0
+        for chunk in batched(annotation_ids, constants.BULK_LABEL_CHUNK_SIZE):
+            updated += (await session.execute(stmt.where(Annotation.id.in_(chunk)))).rowcount
+        return updated
+
+    async def renew_leases(self, task_id: UUID, user_id: UUID, lease_duration: timedelta) -> None:
+        """Extend every live claim a user holds on a task, called on annotator activity."""
+        now = datetime.now(UTC)
+        stmt = (
+            update(Annotation)
+            .where(
+                Annotation.task_id == task_id,
+                Annotation.claimed_by == user_id,
+                Annotation.labeled.is_(False),
+                Annotation.lease_expires_at > now,
+            )
+            .values(lease_expires_at=now + lease_duration)
+            .execution_options(synchronize_session=False)
+        )
+        await self.repository.session.execute(stmt)
+
+    async def release_claims(self, task_id: UUID, user_id: UUID) -> None:
+        """Return every annotation a user has claimed on a task to the work queue."""
+        stmt = (
+            update(Annotation)
+            .where(Annotation.task_id == task_id, Annotation.claimed_by == user_id)
+            .values(claimed_by=None, lease_expires_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        await self.repository.session.execute(stmt)
+
+
+class JobService(SQLAlchemyAsyncRepositoryService[Job]):
+    """Handles database operations for background jobs."""
+
+    repository_type = JobRepository
+
+    def __init__(self, **repo_kwargs: Any) -> None:
+        self.repository: JobRepository = self.repository_type(**repo_kwargs)  # type: ignore
+        self.model_type = self.repository.model_type
+
+    async def get_user_job(self, job_id: UUID, user_id: UUID) -> Job:
+        """Get a job submitted by a user."""
+        job = await self.get_one_or_none(id=job_id)
+        if job is None:
+            raise NotFoundException("Job does not exist!")
+        if job.user_id != user_id:
+            raise PermissionDeniedException("Job does not belong to user!")
+
+        return job
+
+    async def start(self, job_id: UUID) -> Job | None:
+        """
+        Mark a queued job as running. Returns None if the job is not queued anymore, e.g. it was
+        queued twice and another worker already picked it up.
+        """
+        stmt = (
+            update(Job)
+            .where(Job.id == job_id, Job.status == constants.JOB_QUEUED)
+            .values(status=constants.JOB_RUNNING, started_at=datetime.now(UTC))
+            .returning(Job)
+            .execution_options(synchronize_session=False)
+        )
+        return (await self.repository.session.execute(stmt)).scalar_one_or_none()
+
+    async def set_progress(self, job_id: UUID, progress: int) -> None:
+        stmt = (
+            update(Job)
+            .where(Job.id == job_id)
+            .values(progress=progress)
+            .execution_options(synchronize_session=False)
+        )
+        await self.repository.session.execute(stmt)
+
+    async def finish(self, job_id: UUID, result: str | None) -> None:
+        await self._end(job_id, constants.JOB_DONE, result=result)
+
+    async def fail(self, job_id: UUID, error: str) -> None:
+        await self._end(job_id, constants.JOB_FAILED, error=error)
+
+    async def fail_running(self, error: str) -> None:
+        """Fail every running job, used at startup for jobs a previous process was running."""
+        stmt = (
+            update(Job)
+            .where(Job.status == constants.JOB_RUNNING)
+            .values(status=constants.JOB_FAILED, error=error, finished_at=datetime.now(UTC))
+            .execution_options(synchronize_session=False)
+        )
+        await self.repository.session.execute(stmt)
+
+    async def get_queued_ids(self) -> list[UUID]:
+        """Get the ids of the jobs waiting for a worker, oldest first."""
+        stmt = select(Job.id).where(Job.status == constants.JOB_QUEUED).order_by(Job.created_at)
+        return list((await self.repository.session.execute(stmt)).scalars().all())
+
+    async def _end(self, job_id: UUID, status: str, **values: Any) -> None:
+        stmt = (
+            update(Job)
+            .where(Job.id == job_id)
+            .values(status=status, finished_at=datetime.now(UTC), **values)
+            .execution_options(synchronize_session=False)
+        )
+        await self.repository.session.execute(stmt)
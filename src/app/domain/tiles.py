@@ -0,0 +1,202 @@
+"""
+Deep Zoom (DZI) tile pyramids for images too large to send whole. The full resolution level is
+only ever stored as its compressed tiles, all cut in one banded pass over the decoded source.
+Pillow decodes most formats, compressed TIFFs included, as a single stream, so the source is
+decoded whole once; its size is bounded by MAX_PYRAMID_PIXELS. Every lower level is built once
+into an uncompressed array on disk, and its tiles are cut from memory maps of those arrays so
+serving a tile only ever reads the region it covers.
+"""
+
+import math
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from PIL import Image
+from pydicom import dcmread
+
+from app.domain.constants import DICOM_EXTENSIONS
+from app.domain.dicom import read_dicom_image
+
+TILE_FORMAT = "jpeg"
+TILE_MEDIA_TYPE = "image/jpeg"
+# Uncompressed pyramid levels that tiles below the full resolution are cut from
+LEVEL_SUFFIX = ".npy"
+# Rows of the higher level downscaled at a time, bounding memory use when building a level
+LEVEL_BAND_ROWS = 1024
+
+
+@dataclass(frozen=True)
+class Pyramid:
+    width: int
+    height: int
+    tile_size: int
+    overlap: int
+
+    @property
+    def max_level(self) -> int:
+        """Level of the full resolution image, level 0 is a single pixel."""
+        return math.ceil(math.log2(max(self.width, self.height, 1)))
+
+    def level_size(self, level: int) -> tuple[int, int]:
+        scale = 2 ** (self.max_level - level)
+        return math.ceil(self.width / scale), math.ceil(self.height / scale)
+
+    def has_tile(self, level: int, col: int, row: int) -> bool:
+        if not 0 <= level <= self.max_level:
+            return False
+        width, height = self.level_size(level)
+        columns, rows = math.ceil(width / self.tile_size), math.ceil(height / self.tile_size)
+        return 0 <= col < columns and 0 <= row < rows
+
+    def to_dzi(self) -> str:
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+            f'TileSize="{self.tile_size}" Overlap="{self.overlap}" Format="{TILE_FORMAT}">'
+            f'<Size Width="{self.width}" Height="{self.height}"/>'
+            "</Image>"
+        )
+
+
+def read_image_size(source: Path) -> tuple[int, int]:
+    """Read the dimensions of an image from its header, without decoding any pixel data."""
+    if source.suffix.lower() in DICOM_EXTENSIONS:
+        dataset = dcmread(source, stop_before_pixels=True)
+        return int(dataset.Columns), int(dataset.Rows)
+    with _open_unlimited(source) as image:
+        return image.size
+
+
+def open_source(source: str) -> Image.Image:
+    """Open a pyramid source, lazily, without Pillow's decompression bomb limit."""
+    if Path(source).suffix.lower() in DICOM_EXTENSIONS:
+        return read_dicom_image(source)
+
+    image = _open_unlimited(source)
+    # Decode JPEGs straight to RGB rather than converting a full resolution copy afterwards
+    image.draft("RGB", image.size)
+    return image
+
+
+def build_top_level(
+    source: str, tiles_dir: str, pyramid: Pyramid, quality: int
+) -> list[tuple[str, int]]:
+    """
+    Cut every tile of the full resolution level and build the level below it, converting the
+    source to RGB one band of rows at a time. The source itself is decoded whole, on the first
+    band. Runs in a worker process.
+
+    Returns the path and size of each file written.
+    """
+    written = []
+    with open_source(source) as image:
+        width, height = image.size
+        level_dir = Path(tiles_dir) / str(pyramid.max_level)
+        level_dir.mkdir(parents=True, exist_ok=True)
+        for row in range(math.ceil(height / pyramid.tile_size)):
+            top, bottom = _tile_span(pyramid, row, height)
+            band = image.crop((0, top, width, bottom)).convert("RGB")
+            for col in range(math.ceil(width / pyramid.tile_size)):
+                left, right = _tile_span(pyramid, col, width)
+                destination = level_dir / f"{col}_{row}.{TILE_FORMAT}"
+                _save_tile(band.crop((left, 0, right, bottom - top)), destination, quality)
+                written.append((str(destination), destination.stat().st_size))
+
+        if pyramid.max_level > 0:
+            destination = Path(tiles_dir) / f"{pyramid.max_level - 1}{LEVEL_SUFFIX}"
+            temp_destination = f"{destination}.{os.getpid()}.tmp"
+            level = _create_level(temp_destination, width, height)
+            for top in range(0, height, LEVEL_BAND_ROWS):
+                box = (0, top, width, min(top + LEVEL_BAND_ROWS, height))
+                band = np.asarray(image.crop(box).convert("RGB"))
+                level[top // 2 : top // 2 + math.ceil(band.shape[0] / 2)] = _halve(band)
+            level.flush()
+            del level
+            os.replace(temp_destination, destination)
+            written.append((str(destination), destination.stat().st_size))
+    return written
+
+
+def build_level(higher_level: str, destination: str) -> None:
+    """
+    Build a pyramid level by halving the level above it one band of rows at a time. Runs in a
+    worker process.
+    """
+    higher = np.load(higher_level, mmap_mode="r")
+    height, width = higher.shape[:2]
+    temp_destination = f"{destination}.{os.getpid()}.tmp"
+    level = _create_level(temp_destination, width, height)
+    for top in range(0, height, LEVEL_BAND_ROWS):  # LEVEL_BAND_ROWS is even, bands stay aligned
+        band = higher[top : top + LEVEL_BAND_ROWS]
+        level[top // 2 : top // 2 + math.ceil(band.shape[0] / 2)] = _halve(band)
+    level.flush()
+    del level, higher
+
+    os.replace(temp_destination, destination)
+
+
+def render_tile(
+    level_path: str, destination: str, tile: tuple[int, int], pyramid: Pyramid, quality: int
+) -> None:
+    """
+    Cut the (col, row) tile, with its overlap, out of a memory mapped level. Runs in a worker
+    process.
+    """
+    col, row = tile
+    level = np.load(level_path, mmap_mode="r")
+    height, width = level.shape[:2]
+    left, right = _tile_span(pyramid, col, width)
+    top, bottom = _tile_span(pyramid, row, height)
+
+    image = Image.fromarray(np.ascontiguousarray(level[top:bottom, left:right]))
+    del level
+    _save_tile(image, Path(destination), quality)
+
+
+def _open_unlimited(source: str | Path) -> Image.Image:
+    """
+    Open an image without Pillow's decompression bomb limit. Pyramids exist for whole-slide sized
+    images that are well past it, and sources are folders the annotators picked themselves. The
+    limit is restored afterwards for the renditions cut in the same process.
+    """
+    max_image_pixels = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        return Image.open(source)
+    finally:
+        Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+
+def _tile_span(pyramid: Pyramid, index: int, length: int) -> tuple[int, int]:
+    """Start and end, with the overlap, of the index-th tile along an axis of the given length."""
+    start = max(index * pyramid.tile_size - pyramid.overlap, 0)
+    end = min((index + 1) * pyramid.tile_size + pyramid.overlap, length)
+    return start, end
+
+
+def _halve(band: np.ndarray) -> np.ndarray:
+    """Halve a band of RGB rows by averaging 2x2 pixel blocks."""
+    band = band.astype(np.uint16)
+    # Repeat the last row/column of odd sized images so every pixel belongs to a 2x2 block
+    band = np.pad(band, ((0, band.shape[0] % 2), (0, band.shape[1] % 2), (0, 0)), mode="edge")
+    blocks = band[0::2, 0::2] + band[1::2, 0::2] + band[0::2, 1::2] + band[1::2, 1::2]
+    return (blocks + 2) // 4
+
+
+def _create_level(path: str, higher_width: int, higher_height: int) -> np.memmap:
+    """Create the array of the level below one of the given size."""
+    return open_memmap(
+        path,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(math.ceil(higher_height / 2), math.ceil(higher_width / 2), 3),
+    )
+
+
+def _save_tile(image: Image.Image, destination: Path, quality: int) -> None:
+    temp_destination = f"{destination}.{os.getpid()}.tmp"
+    image.save(temp_destination, format=TILE_FORMAT, quality=quality)
+    os.replace(temp_destination, destination)
@@ -13,6 +13,8 @@ SCHEMA_ENDPOINT = "/schema"
 # SYSTEM INFORMATION
 CHECK_PATH = "/api/system/check_path"
 CHECK_HEALTH = "/api/system/check_health"
+GET_BACKUP_STATUS = "/api/system/get_backup_status"
+GET_METRICS = "/api/system/get_metrics"
 
 # PAGE URLS
 LOGIN_PAGE = "/login"
@@ -33,7 +35,16 @@ UNASSIGN_TASK = "/api/tasks/unassign"
 UPDATE_TASK = "/api/tasks/update"
 EXPORT_TASK = "/api/tasks/export_annotations"
 
+# JOB
+SUBMIT_JOB = "/api/jobs/submit"
+GET_JOB = "/api/jobs/get_job"
+GET_JOB_RESULT = "/api/jobs/get_job_result"
+
 # ANNOTATION
 UPDATE_ANNOTATION = "/api/annotations/update_annotation"
+BULK_UPDATE_ANNOTATIONS = "/api/annotations/bulk_update_annotations"
 GET_NEXT_ANNOTATION = "/api/annotations/get_next_annotation"
 GET_ANY_ANNOTATION = "/api/annotations/get_annotation"
+GET_ANNOTATION_WINDOW = "/api/annotations/get_annotation_window"
+GET_ANNOTATION_DZI = "/api/annotations/get_annotation_dzi"
+GET_ANNOTATION_TILE = "/api/annotations/get_annotation_tile"
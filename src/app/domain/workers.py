@@ -0,0 +1,178 @@
+"""
+Coordination of the worker processes started by `app run --wc N`, which share nothing but the
+database and the file system. Serving several workers keeps every core busy serving images and
+rendering pages, and stays consistent through:
+
+- A lock file funneling the writes to a SQLite database through one process at a time. A
+  process holds it for the length of each transaction on its write connection, and processes
+  waiting for it retry with backoff rather than fail with "database is locked" once SQLite's
+  busy timeout ends.
+- Generation counters in shared memory, bumped by the worker that changes data other workers
+  may hold in an in-process cache, so those workers drop the stale entries.
+- A leader worker, the one holding the leader lock, running the duties that must run once per
+  server: background jobs and backups. Another worker takes over if it exits.
+
+Locks are `flock`s, so several workers are only supported on POSIX systems.
+"""
+
+import asyncio
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Any
+
+from litestar.exceptions import ImproperlyConfiguredException
+from sqlalchemy import event, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.util import await_only
+
+from app.config.base import ENGINE_PROFILE_SQLITE_WAL, ServerSettings, Settings, get_settings
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the app is served by a single process
+    fcntl = None  # type: ignore[assignment]
+
+settings = get_settings()
+
+COUNTER_FORMAT = "<Q"
+
+
+class FileLock:
+    """Exclusive lock shared by processes through a lock file."""
+
+    def __init__(self, path: Path, timeout: float = 0, max_backoff: float = 0.05) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.locked = False
+
+        self._fd: int | None = None
+
+    def try_acquire(self) -> bool:
+        """Take the lock unless another holder has it, without waiting."""
+        if self.locked:
+            return True
+        if self._fd is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self.locked = True
+        return True
+
+    async def acquire(self) -> None:
+        """Take the lock, retrying with exponential backoff for up to `timeout` seconds."""
+        deadline = time.monotonic() + self.timeout
+        backoff = 0.001
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Timed out waiting for {self.path}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def release(self) -> None:
+        if self.locked and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self.locked = False
+
+
+class SharedCounter:
+    """Counter in a memory-mapped file, read by every worker process without a system call."""
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = struct.calcsize(COUNTER_FORMAT)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)  # zero filled, extending never clears a count
+        self._map = mmap.mmap(self._fd, size)
+
+    @property
+    def value(self) -> int:
+        return struct.unpack_from(COUNTER_FORMAT, self._map)[0]
+
+    def increment(self) -> int:
+        fcntl.flock(self._fd, fcntl.LOCK_EX)  # concurrent increments are not lost
+        try:
+            value = self.value + 1
+            struct.pack_into(COUNTER_FORMAT, self._map, 0, value)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return value
+
+
+class WorkerCoordinator:
+    """What the worker processes of a server share, nothing when it runs a single process."""
+
+    def __init__(self, settings: ServerSettings) -> None:
+        self.workers = settings.WORKERS
+        self.run_dir = Path(settings.RUN_DIR).resolve()
+        self.leader_lock = FileLock(self.run_dir / "leader.lock")
+
+        self._counters: dict[str, SharedCounter] = {}
+
+    @property
+    def multi_process(self) -> bool:
+        return self.workers > 1
+
+    def is_leader(self) -> bool:
+        """
+        Whether this process runs the duties of the server, taking them over if no other worker
+        holds them, e.g. because their last leader exited.
+        """
+        return not self.multi_process or self.leader_lock.try_acquire()
+
+    def get_counter(self, name: str) -> SharedCounter | None:
+        """Generation counter shared by the workers, None when there is a single process."""
+        if not self.multi_process:
+            return None
+        if name not in self._counters:
+            self._counters[name] = SharedCounter(self.run_dir / f"{name}.generation")
+        return self._counters[name]
+
+    def check(self, settings: Settings) -> None:
+        """Raise if the configuration cannot be shared by several worker processes."""
+        if not self.multi_process:
+            return
+        if fcntl is None:
+            raise ImproperlyConfiguredException("Several workers are only supported on POSIX")
+        if settings.journal.WRITE_BEHIND:
+            raise ImproperlyConfiguredException(
+                "LABEL_WRITE_BEHIND keeps pending labels in the memory of a single process, "
+                "it cannot be enabled with several workers"
+            )
+        if (
+            make_url(settings.db.URL).get_backend_name() == "sqlite"
+            and settings.db.PROFILE != ENGINE_PROFILE_SQLITE_WAL
+        ):
+            raise ImproperlyConfiguredException(
+                f"Several workers on a SQLite database require the {ENGINE_PROFILE_SQLITE_WAL} "
+                "DATABASE_PROFILE, so that readers never lock writers out"
+            )
+
+    def serialize_writes(self, engine: AsyncEngine, timeout: float) -> None:
+        """
+        Let a single worker process at a time run a transaction on a write engine. The lock is
+        taken when a transaction begins rather than at its first write, as a transaction reading
+        an outdated snapshot could not write afterwards, and released when it ends.
+        """
+        lock = FileLock(self.run_dir / "write.lock", timeout)
+
+        @event.listens_for(engine.sync_engine, "begin")
+        def acquire_write_lock(*args: Any) -> None:
+            # Statements of an async engine run in a greenlet, which can wait on the event loop
+            await_only(lock.acquire())
+
+        @event.listens_for(engine.sync_engine, "commit")
+        @event.listens_for(engine.sync_engine, "rollback")
+        @event.listens_for(engine.sync_engine, "checkin")  # e.g. invalidated mid transaction
+        def release_write_lock(*args: Any) -> None:
+            lock.release()
+
+
+coordinator = WorkerCoordinator(settings.server)
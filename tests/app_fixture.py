@@ -13,11 +13,15 @@ from app.config.plugin_config import (
 )
 from app.domain.controllers import (
     AnnotationController,
+    JobController,
     PageController,
     SystemController,
     TaskController,
     UserController,
 )
+from app.domain.identity import identity_cache
+from app.domain.jobs import job_runner
+from app.domain.metrics import MetricsMiddleware
 from litestar import Litestar
 from litestar.middleware.session.client_side import CookieBackendConfig
 from litestar.testing import AsyncTestClient, create_async_test_client
@@ -31,6 +35,7 @@ async def fx_client(
 ) -> AsyncGenerator[AsyncTestClient[Litestar], Any]:
     settings = get_settings()
     client_session_config = CookieBackendConfig(secret=settings.app.SECRET_KEY)
+    identity_cache.clear()  # every test seeds a new database with the same users
 
     async with create_async_test_client(
         route_handlers=[
@@ -39,17 +44,20 @@ async def fx_client(
             SystemController,
             TaskController,
             AnnotationController,
+            JobController,
             static_files_router,
         ],
         plugins=[SQLAlchemyPlugin(alchemy_config), AppDirCLIPlugin(settings.cli)],
         template_config=template_config,
         on_app_init=[session_auth.on_app_init],
-        middleware=[session_auth.middleware],
+        middleware=[MetricsMiddleware, session_auth.middleware],
         session_config=client_session_config,
         raise_server_exceptions=True,
     ) as client:
         await client.set_session_data({"user_id": test_user["id"]})
         yield client
+        # requests, and the job workers they start, run on the client's event loop
+        client.blocking_portal.call(job_runner.shutdown)
 
 
 @pytest.fixture(autouse=True)
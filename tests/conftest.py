@@ -1,11 +1,16 @@
-from collections.abc import AsyncGenerator, AsyncIterator, Generator
+import os
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Callable, Generator
 from pathlib import Path
+from typing import Any
 from uuid import UUID
 
+import anyio
 import pytest
 from advanced_alchemy.base import orm_registry
 from advanced_alchemy.utils.fixtures import open_fixture_async
 from app.config import base
+from app.domain import constants
+from app.domain.queries import query_monitor
 from app.domain.schema import Task, User
 from app.domain.services import AnnotationService, LabelKeybindService, TaskService, UserService
 from fixture_options import FIXTURE_OPTIONS
@@ -17,8 +22,11 @@ from sqlalchemy.ext.asyncio import (
     AsyncEngine,
     AsyncSession,
     async_sessionmaker,
+    close_all_sessions,
     create_async_engine,
 )
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import NullPool
 
 pytestmark = pytest.mark.anyio
 pytest_plugins = ["app_fixture"]
@@ -77,29 +85,64 @@ def fx_test_task() -> dict[str, str]:
 
 @pytest.fixture(autouse=True)
 def _patch_client(  # type: ignore
-    client: AsyncTestClient[Litestar],
+    # Set up before the client, so they are torn down once its requests and jobs are done
     engine: AsyncEngine,
     sessionmaker: async_sessionmaker[AsyncSession],
+    client: AsyncTestClient[Litestar],
     monkeypatch: pytest.MonkeyPatch,
 ) -> None:
     monkeypatch.setitem(client.app.state, settings.db.ENGINE_DEPENDENCY_KEY, engine)
     monkeypatch.setitem(
         client.app.state, settings.db.SESSION_MAKER_CLASS_DEPENDENCY_KEY, sessionmaker
     )
+    # Requests over the query budget of their handler fail the test
+    monkeypatch.setattr(query_monitor, "strict", True)
+
+
+@pytest.fixture(name="wait_for_job")
+def fx_wait_for_job(
+    client: AsyncTestClient[Litestar],
+) -> Callable[[str], Awaitable[dict[str, Any]]]:
+    """Poll a background job through the API until it is done or has failed"""
+
+    async def wait_for_job(job_url: str) -> dict[str, Any]:
+        for _ in range(500):
+            job: dict[str, Any] = (await client.get(job_url)).json()
+            if job["status"] in (constants.JOB_DONE, constants.JOB_FAILED):
+                return job
+            await anyio.sleep(0.01)
+        raise TimeoutError(f"Job did not finish: {job}")
+
+    return wait_for_job
 
 
 @pytest.fixture(name="engine", autouse=True)
-def fx_engine() -> AsyncEngine:
-    """Creates async sql engine"""
-    return create_async_engine(
-        "sqlite+aiosqlite:///:memory:",
-        echo=False,
-    )
+async def fx_engine(
+    tmp_path_factory: pytest.TempPathFactory,
+) -> AsyncGenerator[AsyncEngine, None]:
+    """
+    Creates async sql engine, of a temporary SQLite database unless TEST_DATABASE_URL names
+    another, e.g. postgresql+asyncpg://postgres@localhost/annotations_test
+    """
+    database = tmp_path_factory.mktemp("database") / "test.db"  # kept out of tests' tmp_path
+    url = os.getenv("TEST_DATABASE_URL", f"sqlite+aiosqlite:///{database}")
+    # Sessions get connections of their own, as in the app: an in-memory database is a single
+    # connection, whose reset when one session closes rolls back what another has not committed.
+    # asyncpg connections also belong to the event loop that opened them, and the app client
+    # runs on its own loop.
+    engine = create_async_engine(url, echo=False, poolclass=NullPool)
+    yield engine
+    await engine.dispose()
 
 
 @pytest.fixture(name="sessionmaker")
-def fx_session_maker_factory(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
-    return async_sessionmaker(bind=engine, expire_on_commit=False)
+async def fx_session_maker_factory(
+    engine: AsyncEngine,
+) -> AsyncGenerator[async_sessionmaker[AsyncSession], None]:
+    yield async_sessionmaker(bind=engine, expire_on_commit=False)
+    # Tests hand new sessions straight to services, which never close them. Left open, they
+    # keep their transaction and its locks, and the next test cannot drop the tables.
+    await close_all_sessions()
 
 
 @pytest.fixture(name="session")
@@ -138,10 +181,18 @@ async def _seed_db(  # type: ignore
         for user_task_dict in user_tasks_assoc_table:
             user_id, task_id = list(user_task_dict.items())[0]
             user = (
-                await session.execute(select(User).where(User.id == UUID(user_id)))
+                await session.execute(
+                    select(User)
+                    .where(User.id == UUID(user_id))
+                    .options(selectinload(User.assigned_tasks))
+                )
             ).scalar_one()
             task = (
-                await session.execute(select(Task).where(Task.id == UUID(task_id)))
+                await session.execute(
+                    select(Task)
+                    .where(Task.id == UUID(task_id))
+                    .options(selectinload(Task.contributors))
+                )
             ).scalar_one()
 
             user.assigned_tasks.append(task)
@@ -0,0 +1,156 @@
+import json
+from collections.abc import Awaitable, Callable
+from typing import Any
+from uuid import UUID
+
+import pytest
+from fixture_options import TestTask
+from litestar import Litestar
+from litestar.status_codes import HTTP_202_ACCEPTED, HTTP_403_FORBIDDEN
+from litestar.testing import AsyncTestClient
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.domain import constants, urls
+from app.domain.jobs import job_runner
+from app.domain.schema import Annotation, Job, Task, TaskFile
+
+pytestmark = pytest.mark.anyio
+
+WaitForJob = Callable[[str], Awaitable[dict[str, Any]]]
+
+
+class TestJobs:
+    async def test_export_job(
+        self,
+        client: AsyncTestClient[Litestar],
+        test_task: TestTask,
+        session: AsyncSession,
+        wait_for_job: WaitForJob,
+    ):
+        await session.execute(
+            update(Annotation)
+            .where(Annotation.task_id == UUID(test_task["id"]), Annotation.id.in_([1, 2, 3]))
+            .values(label="pancreas", labeled=True)
+        )
+        await session.commit()
+
+        response = await client.post(
+            urls.SUBMIT_JOB, json={"kind": constants.JOB_EXPORT_TASK, "task_id": test_task["id"]}
+        )
+        assert response.status_code == HTTP_202_ACCEPTED
+        assert response.json()["status"] == constants.JOB_QUEUED
+
+        job = await wait_for_job(response.json()["url"])
+        assert job["status"] == constants.JOB_DONE, job
+        assert job["progress"] == 3  # noqa: PLR2004
+
+        download = await client.get(job["result_url"])
+        exported = json.loads(download.text)
+        assert [record["annotation_id"] for record in exported] == [1, 2, 3]
+        assert all(record["label"] == "pancreas" for record in exported)
+        assert "_annotations.json" in download.headers["content-disposition"]
+
+    async def test_rescan_job(
+        self,
+        client: AsyncTestClient[Litestar],
+        test_task: TestTask,
+        session: AsyncSession,
+        wait_for_job: WaitForJob,
+    ):
+        response = await client.post(
+            urls.SUBMIT_JOB, json={"kind": constants.JOB_RESCAN_TASK, "task_id": test_task["id"]}
+        )
+        job = await wait_for_job(response.json()["url"])
+        assert job["status"] == constants.JOB_DONE, job
+        assert job["result_url"] is None
+
+        catalogued = (
+            (
+                await session.execute(
+                    select(TaskFile.path).where(TaskFile.task_id == UUID(test_task["id"]))
+                )
+            )
+            .scalars()
+            .all()
+        )
+        assert len(catalogued) > 0
+
+    async def test_submit_for_unassigned_task(
+        self, client: AsyncTestClient[Litestar], session: AsyncSession, test_task: TestTask
+    ):
+        other_task_id = (
+            await session.execute(select(Task.id).where(Task.id != UUID(test_task["id"])))
+        ).scalar()
+        response = await client.post(
+            urls.SUBMIT_JOB,
+            json={"kind": constants.JOB_EXPORT_TASK, "task_id": str(other_task_id)},
+        )
+        assert response.status_code == HTTP_403_FORBIDDEN
+
+    async def test_ingestion_cannot_be_submitted(
+        self, client: AsyncTestClient[Litestar], test_task: TestTask
+    ):
+        response = await client.post(
+            urls.SUBMIT_JOB, json={"kind": constants.JOB_INGEST_TASK, "task_id": test_task["id"]}
+        )
+        assert response.json()["status_code"] == 400  # noqa: PLR2004
+
+    async def test_job_of_other_user(
+        self, client: AsyncTestClient[Litestar], session: AsyncSession, test_task: TestTask
+    ):
+        job = Job(kind=constants.JOB_EXPORT_TASK, status=constants.JOB_QUEUED, user_id=None)
+        session.add(job)
+        await session.commit()
+
+        response = await client.get(urls.GET_JOB, params={"job_id": str(job.id)})
+        assert response.status_code == HTTP_403_FORBIDDEN
+
+    async def test_failed_job(
+        self,
+        client: AsyncTestClient[Litestar],
+        test_task: TestTask,
+        wait_for_job: WaitForJob,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        async def fail(*_: Any) -> None:
+            raise RuntimeError("Root folder is gone")
+
+        monkeypatch.setitem(job_runner.handlers, constants.JOB_RESCAN_TASK, fail)
+        response = await client.post(
+            urls.SUBMIT_JOB, json={"kind": constants.JOB_RESCAN_TASK, "task_id": test_task["id"]}
+        )
+        job = await wait_for_job(response.json()["url"])
+        assert job["status"] == constants.JOB_FAILED
+        assert job["error"] == "Root folder is gone"
+
+    async def test_resume(  # noqa: PLR0913 (too many arguments)
+        self,
+        client: AsyncTestClient[Litestar],
+        test_user: dict[str, str | int | float],
+        *,
+        test_task: TestTask,
+        engine: AsyncEngine,
+        session: AsyncSession,
+        wait_for_job: WaitForJob,
+    ):
+        """Jobs left running by a previous process fail, jobs that never started are run"""
+        jobs = [
+            Job(
+                kind=constants.JOB_RESCAN_TASK,
+                status=status,
+                user_id=UUID(str(test_user["id"])),
+                task_id=UUID(test_task["id"]),
+            )
+            for status in (constants.JOB_RUNNING, constants.JOB_QUEUED)
+        ]
+        session.add_all(jobs)
+        await session.commit()
+        interrupted_id, queued_id = jobs[0].id, jobs[1].id
+
+        client.blocking_portal.call(job_runner.resume, engine)  # on the loop serving requests
+
+        interrupted = await wait_for_job(f"{urls.GET_JOB}?job_id={interrupted_id}")
+        assert interrupted["status"] == constants.JOB_FAILED
+        queued = await wait_for_job(f"{urls.GET_JOB}?job_id={queued_id}")
+        assert queued["status"] == constants.JOB_DONE
@@ -1,5 +1,8 @@
 import json
 import random
+from collections.abc import AsyncIterator
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
 from typing import Any, cast
 from uuid import UUID
 
@@ -7,12 +10,25 @@ import pytest
 from fixture_options import FIXTURE_OPTIONS, TestTask
 from litestar import Litestar
 from litestar.response import File
+from litestar.status_codes import (
+    HTTP_200_OK,
+    HTTP_204_NO_CONTENT,
+    HTTP_304_NOT_MODIFIED,
+    HTTP_400_BAD_REQUEST,
+    HTTP_403_FORBIDDEN,
+    HTTP_404_NOT_FOUND,
+    HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+)
 from litestar.testing import AsyncTestClient
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import selectinload
 
-from app.domain import urls
+from app.config.base import JournalSettings
+from app.domain import controllers, urls
+from app.domain.journal import LabelJournal, LabelWrite
 from app.domain.schema import Annotation, Task
+from app.domain.services import AnnotationService
 
 pytestmark = pytest.mark.anyio
 
@@ -21,12 +37,19 @@ with open("tests/fixtures/tasks.json") as jf:
     test_task: dict[str, str] = tmp[0]
     random_task: dict[str, str] = tmp[1]
 
+with open("tests/fixtures/users.json") as jf:
+    other_user: dict[str, str] = json.load(jf)[1]
+
 
 class TestAnnotations:
     @pytest.fixture(name="test_annotation")
     async def annotation_fixture(self, test_task: TestTask, session: AsyncSession) -> Annotation:
         task = (
-            await session.execute(select(Task).where(Task.id == UUID(test_task["id"])))
+            await session.execute(
+                select(Task)
+                .where(Task.id == UUID(test_task["id"]))
+                .options(selectinload(Task.annotations))
+            )
         ).scalar_one()
         annotation = task.annotations[0]
 
@@ -62,13 +85,77 @@ class TestAnnotations:
                 expected_json.items() <= response.json().items()
             )  # is expected_json subset of response.json
 
+    async def test_get_annotation_conditional(
+        self, client: AsyncTestClient[Litestar], test_task: TestTask
+    ) -> None:
+        """Revisiting an annotation should be answered with a 304 instead of the image"""
+        params = {"task_id": test_task["id"], "annotation_id": 1}
+        response = await client.get(urls.GET_ANY_ANNOTATION, params=params)
+        etag = response.headers["etag"]
+        assert response.headers["content-type"] == "image/png"
+        assert "no-cache" in response.headers["cache-control"]
+
+        cached = await client.get(
+            urls.GET_ANY_ANNOTATION, params=params, headers={"if-none-match": f"W/{etag}"}
+        )
+        assert cached.status_code == HTTP_304_NOT_MODIFIED
+        assert cached.content == b""
+        assert cached.headers["etag"] == etag
+        assert cached.headers["X-Metadata-AnnotationID"] == "1"
+
+        stale = await client.get(
+            urls.GET_ANY_ANNOTATION, params=params, headers={"if-none-match": '"stale"'}
+        )
+        assert stale.status_code == HTTP_200_OK
+
+    async def test_get_annotation_tiles(
+        self, client: AsyncTestClient[Litestar], test_task: TestTask
+    ) -> None:
+        params = {"task_id": test_task["id"], "annotation_id": 1}
+        response = await client.get(urls.GET_ANNOTATION_DZI, params=params)
+        assert response.status_code == HTTP_200_OK
+        assert "deepzoom" in response.text
+
+        tile = await client.get(
+            urls.GET_ANNOTATION_TILE, params={**params, "level": 0, "col": 0, "row": 0}
+        )
+        assert tile.status_code == HTTP_200_OK
+        assert tile.headers["content-type"] == "image/jpeg"
+
+        missing = await client.get(
+            urls.GET_ANNOTATION_TILE, params={**params, "level": 0, "col": 1, "row": 0}
+        )
+        assert missing.status_code == HTTP_404_NOT_FOUND
+
+    async def test_get_annotation_tiles_too_large(
+        self,
+        client: AsyncTestClient[Litestar],
+        test_task: TestTask,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        monkeypatch.setattr(controllers.rendition_cache, "max_pyramid_pixels", 1)
+        params = {"task_id": test_task["id"], "annotation_id": 1}
+        response = await client.get(urls.GET_ANNOTATION_DZI, params=params)
+        assert response.status_code == HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
+        tile = await client.get(
+            urls.GET_ANNOTATION_TILE, params={**params, "level": 0, "col": 0, "row": 0}
+        )
+        assert tile.status_code == HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
 
 async def test_get_next_annotation_none_left(
     client: AsyncTestClient[Litestar], session: AsyncSession, test_task: TestTask
 ) -> None:
     """Test response to get next annotation for task when there are no more annotations to label"""
     async with session.begin():
-        task = (await session.execute(select(Task).where(Task.id == test_task["id"]))).scalar_one()
+        task = (
+            await session.execute(
+                select(Task)
+                .where(Task.id == test_task["id"])
+                .options(selectinload(Task.annotations))
+            )
+        ).scalar_one()
         for anno in task.annotations:
             anno.labeled = True
             anno.label = random.choice(["humerus", "scapula", "tibia", "meniscus"])
@@ -86,6 +173,130 @@ async def test_get_next_annotation_happy(
     assert "image" in file_response.headers.get("content-type", "")
 
 
+async def test_get_next_annotation_unknown_window(
+    client: AsyncTestClient[Litestar], test_task: TestTask
+) -> None:
+    response = await client.get(
+        urls.GET_NEXT_ANNOTATION, params={"task_id": test_task["id"], "window": "abdomen"}
+    )
+    assert response.status_code == HTTP_400_BAD_REQUEST
+
+
+async def test_label_page_malformed_task_id(client: AsyncTestClient[Litestar]) -> None:
+    response = await client.get(urls.LABEL_PAGE, params={"task_id": "not-a-uuid"})
+    assert response.status_code == HTTP_400_BAD_REQUEST
+
+
+async def test_get_next_annotation_lowest_unlabeled_id(
+    client: AsyncTestClient[Litestar], session: AsyncSession, test_task: TestTask
+) -> None:
+    """Next annotation should deterministically be the unlabeled annotation with the lowest id"""
+    async with session.begin():
+        task = (
+            await session.execute(
+                select(Task)
+                .where(Task.id == test_task["id"])
+                .options(selectinload(Task.annotations))
+            )
+        ).scalar_one()
+        annotation_ids = sorted(a.id for a in task.annotations)
+        for anno in task.annotations:
+            if anno.id in annotation_ids[:2]:
+                anno.labeled = True
+                anno.label = "humerus"
+
+    response = await client.get(urls.GET_NEXT_ANNOTATION, params={"task_id": test_task["id"]})
+    assert response.headers["X-Metadata-AnnotationID"] == str(annotation_ids[2])
+
+
+async def test_get_next_annotation_concurrent_annotators(
+    client: AsyncTestClient[Litestar], test_user: dict[str, str], test_task: TestTask
+) -> None:
+    """Annotators working on the same task should each be leased a different annotation"""
+    params = {"task_id": test_task["id"]}
+    first = await client.get(urls.GET_NEXT_ANNOTATION, params=params)
+    repeat = await client.get(urls.GET_NEXT_ANNOTATION, params=params)
+    await client.set_session_data({"user_id": other_user["id"]})
+    second = await client.get(urls.GET_NEXT_ANNOTATION, params=params)
+
+    first_id = first.headers["X-Metadata-AnnotationID"]
+    assert repeat.headers["X-Metadata-AnnotationID"] == first_id  # live claim is kept on reload
+    assert second.headers["X-Metadata-AnnotationID"] != first_id
+
+
+async def test_get_next_annotation_all_leased(
+    client: AsyncTestClient[Litestar], session: AsyncSession, test_task: TestTask
+) -> None:
+    """An annotation leased to another annotator is never shared: the client is asked to wait"""
+    async with session.begin():
+        await session.execute(
+            update(Annotation)
+            .where(Annotation.task_id == UUID(test_task["id"]))
+            .values(
+                claimed_by=UUID(other_user["id"]),
+                lease_expires_at=datetime.now(UTC) + timedelta(minutes=5),
+            )
+        )
+
+    response = await client.get(urls.GET_NEXT_ANNOTATION, params={"task_id": test_task["id"]})
+    assert response.status_code == HTTP_204_NO_CONTENT
+    assert "X-Metadata-AnnotationID" not in response.headers
+    assert int(response.headers["Retry-After"]) > 0
+
+
+async def test_get_annotation_undecodable(
+    client: AsyncTestClient[Litestar], session: AsyncSession, test_task: TestTask, tmp_path: Path
+) -> None:
+    """A DICOM file that cannot be decoded is a 415, which still names its annotation"""
+    source = tmp_path / "broken.dcm"
+    source.write_bytes(b"not a DICOM file")
+    async with session.begin():
+        await session.execute(
+            update(Annotation).where(Annotation.id == 1).values(filepath=str(source))
+        )
+
+    params = {"task_id": test_task["id"], "annotation_id": 1}
+    response = await client.get(urls.GET_ANY_ANNOTATION, params=params)
+    assert response.status_code == HTTP_415_UNSUPPORTED_MEDIA_TYPE
+    assert response.headers["X-Metadata-AnnotationID"] == "1"
+
+
+async def test_get_annotation_window(
+    client: AsyncTestClient[Litestar], test_task: TestTask
+) -> None:
+    """Prefetch windows should be stable for one annotator and disjoint between annotators"""
+    params = {"task_id": test_task["id"], "count": 3}
+    first = (await client.get(urls.GET_ANNOTATION_WINDOW, params=params)).json()
+    repeat = (await client.get(urls.GET_ANNOTATION_WINDOW, params=params)).json()
+    await client.set_session_data({"user_id": other_user["id"]})
+    second = (await client.get(urls.GET_ANNOTATION_WINDOW, params=params)).json()
+
+    first_ids = [a["annotation_id"] for a in first]
+    second_ids = [a["annotation_id"] for a in second]
+    assert len(first_ids) == 3  # noqa: PLR2004
+    assert [a["annotation_id"] for a in repeat] == first_ids
+    assert set(first_ids).isdisjoint(second_ids)
+
+
+async def test_claim_next_reclaims_expired_lease(
+    session: AsyncSession, test_task: TestTask
+) -> None:
+    """An annotation whose lease has expired should be handed to the next annotator who asks"""
+    task_id = UUID(test_task["id"])
+    async with AnnotationService.new(session) as annotations_service:
+        expired = await annotations_service.claim_next(
+            task_id, UUID(other_user["id"]), timedelta(seconds=-1)
+        )
+        reclaimed = await annotations_service.claim_next(
+            task_id, UUID(test_task["creator_id"]), timedelta(minutes=5)
+        )
+
+    assert expired is not None
+    assert reclaimed is not None
+    assert reclaimed.id == expired.id
+    assert reclaimed.claimed_by == UUID(test_task["creator_id"])
+
+
 @pytest.mark.parametrize(
     "task_id, annotation_id, expected_status, expected_response",
     [
@@ -119,3 +330,153 @@ async def test_update_annotation(
     )
     assert response.status_code == expected_status
     assert expected_response.items() <= response.json().items()
+
+
+async def test_bulk_update_annotations(
+    client: AsyncTestClient[Litestar], session: AsyncSession, test_task: TestTask
+) -> None:
+    """One label is applied to annotations selected by id or by filter, in a single request"""
+    stmt = select(Annotation.id).where(Annotation.task_id == UUID(test_task["id"]))
+    annotation_ids = sorted((await session.execute(stmt)).scalars().all())
+    total = len(annotation_ids)
+    params = {"task_id": test_task["id"]}
+
+    # ids of annotations outside the task are ignored
+    data = {"label": "normal", "annotation_ids": [*annotation_ids[:3], 10**9]}
+    response = await client.patch(urls.BULK_UPDATE_ANNOTATIONS, params=params, json=data)
+    assert response.status_code == HTTP_200_OK
+    assert response.json() == {
+        "updated": 3,
+        "total": total,
+        "labeled": 3,
+        "labeled_by_user": 3,
+        "progress": round(3 / total * 100, 2),
+    }
+
+    data = {"label": "abnormal", "filter": {"labeled": False}}
+    response = await client.patch(urls.BULK_UPDATE_ANNOTATIONS, params=params, json=data)
+    assert response.json()["updated"] == total - 3
+    assert response.json()["progress"] == 100  # noqa: PLR2004
+
+    data = {"label": "", "filter": {"label": "normal"}}
+    response = await client.patch(urls.BULK_UPDATE_ANNOTATIONS, params=params, json=data)
+    assert response.json()["updated"] == 3  # noqa: PLR2004
+    assert response.json()["labeled"] == total - 3
+
+    stmt = select(Annotation.labeled, Annotation.label).where(Annotation.id.in_(annotation_ids))
+    rows = (await session.execute(stmt.order_by(Annotation.id))).all()
+    assert [tuple(row) for row in rows] == [(False, None)] * 3 + [(True, "abnormal")] * (total - 3)
+
+
+@pytest.mark.parametrize(
+    "task_id, data, expected_status",
+    [
+        (random_task["id"], {"label": "normal", "annotation_ids": [1]}, HTTP_403_FORBIDDEN),
+        (test_task["id"], {"label": "normal"}, HTTP_400_BAD_REQUEST),
+        (
+            test_task["id"],
+            {"label": "normal", "annotation_ids": [1], "filter": {"labeled": False}},
+            HTTP_400_BAD_REQUEST,
+        ),
+    ],
+    ids=["task-not-assigned-user", "no-selection", "two-selections"],
+)
+async def test_bulk_update_annotations_rejected(
+    client: AsyncTestClient[Litestar], task_id: str, data: dict[str, Any], expected_status: int
+) -> None:
+    response = await client.patch(
+        urls.BULK_UPDATE_ANNOTATIONS, params={"task_id": task_id}, json=data
+    )
+    assert response.status_code == expected_status
+
+
+class TestWriteBehind:
+    @pytest.fixture(name="journal")
+    async def journal_fixture(
+        self, client: AsyncTestClient[Litestar], tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+    ) -> AsyncIterator[LabelJournal]:
+        """Write-behind journal that is only flushed on demand"""
+        journal_settings = JournalSettings(
+            WRITE_BEHIND=True, PATH=str(tmp_path / "labels.jsonl"), FLUSH_INTERVAL_MS=60_000
+        )
+        journal = LabelJournal(journal_settings, timedelta(minutes=5))
+        monkeypatch.setattr(controllers, "label_journal", journal)
+        yield journal
+        client.blocking_portal.call(journal.shutdown)  # the flusher runs on the client's loop
+
+    async def test_labels_are_journaled_then_flushed(
+        self,
+        client: AsyncTestClient[Litestar],
+        session: AsyncSession,
+        test_task: TestTask,
+        journal: LabelJournal,
+    ) -> None:
+        stmt = select(Annotation.id).where(Annotation.task_id == UUID(test_task["id"]))
+        first_id, second_id = sorted((await session.execute(stmt)).scalars().all())[:2]
+
+        for annotation_id, label in [
+            (first_id, "normal"),
+            (first_id, "abnormal"),
+            (second_id, "x"),
+        ]:
+            params = {"task_id": test_task["id"], "annotation_id": annotation_id}
+            response = await client.patch(
+                urls.UPDATE_ANNOTATION, params=params, json={"label": label}
+            )
+            assert response.status_code == HTTP_200_OK
+        # Progress accounts for the journaled labels, the last one per annotation wins
+        assert response.json()["labeled"] == 2  # noqa: PLR2004
+        assert response.json()["labeled_by_user"] == 2  # noqa: PLR2004
+
+        labels_stmt = (
+            select(Annotation.label)
+            .where(Annotation.id.in_([first_id, second_id]))
+            .order_by(Annotation.id)
+        )
+        assert (await session.execute(labels_stmt)).scalars().all() == [None, None]
+        # Journaled annotations are not handed out to label again
+        response = await client.get(
+            urls.GET_ANNOTATION_WINDOW, params={"task_id": test_task["id"], "count": 4}
+        )
+        window_ids = {a["annotation_id"] for a in response.json()}
+        assert window_ids.isdisjoint({first_id, second_id})
+
+        assert client.blocking_portal.call(journal.flush) == 2  # noqa: PLR2004
+        session.expire_all()
+        assert (await session.execute(labels_stmt)).scalars().all() == ["abnormal", "x"]
+        assert journal.path.read_text() == ""
+        progress = (
+            await client.patch(
+                urls.UPDATE_ANNOTATION,
+                params={"task_id": test_task["id"], "annotation_id": -999},
+                json={"label": ""},
+            )
+        ).json()
+        assert progress["labeled"] == 2  # noqa: PLR2004
+
+    async def test_replay(
+        self, engine: AsyncEngine, session: AsyncSession, test_task: TestTask, tmp_path: Path
+    ) -> None:
+        """Journaled labels left by a crash are written, a line cut short by it is skipped"""
+        stmt = select(Annotation.id).where(Annotation.task_id == UUID(test_task["id"]))
+        annotation_id = (await session.execute(stmt.limit(1))).scalar_one()
+        write = LabelWrite(
+            annotation_id=annotation_id,
+            task_id=UUID(test_task["id"]),
+            user_id=UUID(FIXTURE_OPTIONS.test_user["id"]),
+            label="normal",
+            at=datetime.now(UTC),
+        )
+        path = tmp_path / "labels.jsonl"
+        path.write_text(write.to_json() + '\n{"annotation_id": 1, "ta')
+
+        journal_settings = JournalSettings(
+            WRITE_BEHIND=False, PATH=str(path), FLUSH_INTERVAL_MS=60_000
+        )
+        journal = LabelJournal(journal_settings, timedelta(minutes=5))
+        assert await journal.replay(engine) == 1
+        await journal.shutdown()
+
+        annotation = await session.get_one(Annotation, annotation_id)
+        assert (annotation.label, annotation.labeled) == ("normal", True)
+        assert path.read_text() == ""
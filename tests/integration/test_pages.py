@@ -0,0 +1,30 @@
+from pathlib import Path
+
+import pytest
+from fixture_options import FIXTURE_OPTIONS, TestTask
+from litestar import Litestar
+from litestar.status_codes import HTTP_200_OK
+from litestar.testing import AsyncTestClient
+
+from app.config import base
+from app.domain import urls
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(
+        not Path(base.get_settings().template.TEMPLATE_DIR).is_dir(),
+        reason="Needs the page templates, built into TEMPLATE_DIR",
+    ),
+]
+
+
+async def test_pages(client: AsyncTestClient[Litestar], test_task: TestTask) -> None:
+    total = FIXTURE_OPTIONS.num_annotations_per_task
+
+    response = await client.get(urls.TASK_PANEL_PAGE)
+    assert response.status_code == HTTP_200_OK, response.text
+    assert f"0 / {total} annotated" in response.text
+
+    response = await client.get(urls.LABEL_PAGE, params={"task_id": test_task["id"]})
+    assert response.status_code == HTTP_200_OK, response.text
+    assert f"0 / {total} labeled" in response.text
@@ -1,12 +1,26 @@
+import csv
+import gzip
+import json
+import os
 import random
+from collections.abc import Awaitable, Callable
+from datetime import UTC, datetime, timedelta
 from pathlib import Path
 from typing import Any, TypedDict
 from urllib.parse import quote
+from uuid import UUID
 
 import pytest
-from app.domain import urls
-from app.domain.schema import Annotation, Task
-from fixture_options import TestTask
+from app.domain import constants, exports, urls
+from app.domain.loading import LOAD_PROFILES
+from app.domain.schema import Annotation, Task, TaskFile
+from app.domain.services import (
+    AnnotationService,
+    TaskFileService,
+    TaskService,
+    scan_image_folder,
+)
+from fixture_options import FIXTURE_OPTIONS, TestTask
 from litestar import Litestar
 from litestar.status_codes import (
     HTTP_200_OK,
@@ -15,8 +29,10 @@ from litestar.status_codes import (
     HTTP_401_UNAUTHORIZED,
 )
 from litestar.testing import AsyncTestClient
-from sqlalchemy import select, update
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
 pytestmark = pytest.mark.anyio
 
@@ -64,7 +80,11 @@ class TestTaskCreation:
             json=self.test_task,
         )
         inserted_task = (
-            await session.execute(select(Task).where(Task.title == self.test_task["title"]))
+            await session.execute(
+                select(Task)
+                .where(Task.title == self.test_task["title"])
+                .options(selectinload(Task.label_keybinds))
+            )
         ).scalar_one()
         inserted_lks = [
             {"label": lk.to_dict()["label"], "keybind": lk.to_dict()["keybind"]}
@@ -72,14 +92,24 @@ class TestTaskCreation:
         ]
         assert inserted_lks == self.test_task["label_keybinds"]
 
-    async def test_annotation_creation(self, session: AsyncSession):
+    async def test_annotation_creation(
+        self,
+        session: AsyncSession,
+        wait_for_job: Callable[[str], Awaitable[dict[str, Any]]],
+    ):
         """When a task is created, corresponding annotations should be created for images in root"""
-        await self.client.post(
+        response = await self.client.post(
             urls.CREATE_TASK,
             json=self.test_task,
         )
+        job = await wait_for_job(response.json()["job_url"])
+        assert job["status"] == "done", job
         inserted_task = (
-            await session.execute(select(Task).where(Task.title == self.test_task["title"]))
+            await session.execute(
+                select(Task)
+                .where(Task.title == self.test_task["title"])
+                .options(selectinload(Task.annotations))
+            )
         ).scalar_one()
 
         inserted_annos = [anno.to_dict() for anno in inserted_task.annotations]
@@ -165,7 +195,9 @@ class TestTaskCreation:
         task_construct = {
             "title": title,
             "root": quote(root),
-            "label_keybinds": [{"label": j, "keybind": k} for (j, k) in zip(labels, keybinds, strict=False)],
+            "label_keybinds": [
+                {"label": j, "keybind": k} for (j, k) in zip(labels, keybinds, strict=False)
+            ],
         }
 
         response = await self.client.post(
@@ -222,7 +254,11 @@ class TestTaskUpdate:
             urls.UPDATE_TASK, json=self.task, params={"task_id": test_task["id"]}
         )
         updated_task = (
-            await session.execute(select(Task).where(Task.id == test_task["id"]))
+            await session.execute(
+                select(Task)
+                .where(Task.id == test_task["id"])
+                .options(selectinload(Task.label_keybinds), selectinload(Task.annotations))
+            )
         ).scalar_one()
         updated_lks = [
             {"label": lk.label, "keybind": lk.keybind} for lk in updated_task.label_keybinds
@@ -250,7 +286,11 @@ class TestTaskUpdate:
         await session.commit()
 
         old_task = (
-            await session.execute(select(Task).where(Task.id == test_task["id"]))
+            await session.execute(
+                select(Task)
+                .where(Task.id == test_task["id"])
+                .options(selectinload(Task.annotations))
+            )
         ).scalar_one()
         old_annos = [anno.to_dict() for anno in old_task.annotations]
         old_filepaths = [anno["filepath"] for anno in old_annos]
@@ -261,7 +301,7 @@ class TestTaskUpdate:
             urls.UPDATE_TASK, json=new_test_task, params={"task_id": test_task["id"]}
         )
 
-        await session.refresh(old_task)
+        await session.refresh(old_task, ["label_keybinds", "annotations"])
         updated_lks = [{"label": lk.label, "keybind": lk.keybind} for lk in old_task.label_keybinds]
         updated_annos = [anno.to_dict() for anno in old_task.annotations]
         updated_filepaths = [anno["filepath"] for anno in updated_annos]
@@ -277,3 +317,441 @@ class TestTaskUpdate:
             assert anno["labeled"]
 
         assert response.status_code == HTTP_200_OK
+
+
+class TestTaskSummaries:
+    """Test the aggregate task summaries used to render the task panel and label pages"""
+
+    async def test_assigned_summary(
+        self,
+        test_user: dict[str, str | int | float],
+        test_task: TestTask,
+        session: AsyncSession,
+    ):
+        stmt = (
+            update(Annotation)
+            .where(Annotation.task_id == UUID(test_task["id"]), Annotation.id.in_([1, 2, 3]))
+            .values(label="pancreas", labeled=True)
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+        async with TaskService.new(session) as tasks_service:
+            summaries = await tasks_service.get_task_summaries(UUID(str(test_user["id"])))
+
+        assert [s["id"] for s in summaries] == [UUID(test_task["id"])]
+        assert summaries[0]["creator_name"] == test_user["username"]
+        assert summaries[0]["labeled_count"] == 3  # noqa: PLR2004
+        assert summaries[0]["total_count"] == FIXTURE_OPTIONS.num_annotations_per_task
+
+    async def test_unassigned_summary(
+        self,
+        test_user: dict[str, str | int | float],
+        test_task: TestTask,
+        session: AsyncSession,
+    ):
+        async with TaskService.new(session) as tasks_service:
+            summaries = await tasks_service.get_task_summaries(
+                UUID(str(test_user["id"])), assigned=False
+            )
+
+        assert UUID(test_task["id"]) not in [s["id"] for s in summaries]
+        assert len(summaries) == FIXTURE_OPTIONS.num_users * FIXTURE_OPTIONS.num_tasks_per_user
+        for summary in summaries:
+            assert summary["labeled_count"] == 0
+            assert summary["total_count"] == FIXTURE_OPTIONS.num_annotations_per_task
+
+    async def test_label_keybinds_by_task(
+        self,
+        test_user: dict[str, str | int | float],
+        test_task: TestTask,
+        session: AsyncSession,
+    ):
+        task_id = UUID(test_task["id"])
+        async with TaskService.new(session) as tasks_service:
+            label_keybinds = await tasks_service.get_label_keybinds_by_task(
+                UUID(str(test_user["id"])), [task_id]
+            )
+
+        assert len(label_keybinds[task_id]) == FIXTURE_OPTIONS.num_lks_per_user
+
+
+class TestTaskProgress:
+    """The progress counters of a task follow every change to its annotations"""
+
+    async def assert_counters_match(self, session: AsyncSession, task_id: UUID) -> None:
+        counted = (
+            await session.execute(
+                select(
+                    func.count(Annotation.id).filter(Annotation.labeled.is_(True)),
+                    func.count(Annotation.id),
+                ).where(Annotation.task_id == task_id)
+            )
+        ).one()
+        stored = (
+            await session.execute(
+                select(Task.labeled_count, Task.total_count).where(Task.id == task_id)
+            )
+        ).one()
+        assert tuple(stored) == tuple(counted)
+
+    async def test_counters_follow_annotations(
+        self, client: AsyncTestClient[Litestar], test_task: TestTask, session: AsyncSession
+    ):
+        task_id = UUID(test_task["id"])
+        params = {"task_id": test_task["id"], "annotation_id": 1}
+        labeled = await client.patch(urls.UPDATE_ANNOTATION, params=params, json={"label": "tibia"})
+        assert labeled.json()["labeled"] == 1
+        assert labeled.json()["labeled_by_user"] == 1
+        await self.assert_counters_match(session, task_id)
+
+        undone = await client.patch(urls.UPDATE_ANNOTATION, params=params, json={"label": ""})
+        assert undone.json()["labeled"] == 0
+        assert undone.json()["labeled_by_user"] == 0
+
+        await session.execute(
+            update(Annotation)
+            .where(Annotation.task_id == task_id, Annotation.id.in_([2, 3]))
+            .values(label="pancreas", labeled=True)
+        )
+        await session.execute(delete(Annotation).where(Annotation.id == 3))
+        await session.commit()
+        await self.assert_counters_match(session, task_id)
+
+    async def test_repair_progress(self, test_task: TestTask, session: AsyncSession):
+        await session.execute(update(Task).values(labeled_count=999, total_count=0))
+        await session.commit()
+
+        async with TaskService.new(session) as tasks_service:
+            repaired = await tasks_service.repair_progress()
+        await session.commit()
+
+        assert repaired == (await session.execute(select(func.count(Task.id)))).scalar_one()
+        await self.assert_counters_match(session, UUID(test_task["id"]))
+
+
+class TestLoadProfiles:
+    """Relationships and columns left out of a load profile raise rather than load lazily"""
+
+    async def test_unloaded_relationship_raises(self, test_task: TestTask, session: AsyncSession):
+        task = (await session.execute(select(Task).where(Task.id == test_task["id"]))).scalar_one()
+        with pytest.raises(InvalidRequestError):
+            _ = task.annotations
+
+    async def test_labeling_profile(self, test_task: TestTask, session: AsyncSession):
+        load = LOAD_PROFILES[constants.LOAD_PROFILE_LABELING][Annotation]
+        async with AnnotationService.new(session, load=load) as annotations_service:
+            annotation = await annotations_service.get_next_unlabeled(UUID(test_task["id"]))
+
+        assert annotation is not None
+        assert annotation.filepath
+        with pytest.raises(InvalidRequestError):
+            _ = annotation.label
+
+
+class TestTaskFileCatalog:
+    """Test the persisted catalog of image files in task root folders"""
+
+    async def test_catalog_filled_on_create(
+        self,
+        client: AsyncTestClient[Litestar],
+        session: AsyncSession,
+        wait_for_job: Callable[[str], Awaitable[dict[str, Any]]],
+    ):
+        root = "/home/sameed/projects/hfhs_annotation_interface/tests/fixtures/annotations/test"
+        response = await client.post(
+            urls.CREATE_TASK,
+            json={"title": "Catalogued Task", "root": quote(root), "label_keybinds": []},
+        )
+        await wait_for_job(response.json()["job_url"])
+        task = (
+            await session.execute(
+                select(Task)
+                .where(Task.title == "Catalogued Task")
+                .options(selectinload(Task.annotations))
+            )
+        ).scalar_one()
+        catalogued = (
+            (await session.execute(select(TaskFile.path).where(TaskFile.task_id == task.id)))
+            .scalars()
+            .all()
+        )
+
+        assert task.root_folder_mtime_ns == Path(root).stat().st_mtime_ns
+        assert sorted(catalogued) == sorted(anno.filepath for anno in task.annotations)
+
+    async def test_ingest_root_folder_in_batches(
+        self, test_task: TestTask, session: AsyncSession, tmp_path: Path
+    ):
+        task_id = UUID(test_task["id"])
+        await session.execute(delete(Annotation).where(Annotation.task_id == task_id))
+        for i in range(5):
+            (tmp_path / f"{i}.png").write_bytes(b"image")
+        (tmp_path / "notes.txt").write_bytes(b"text")
+
+        progress: list[int] = []
+
+        async def on_progress(count: int) -> None:
+            progress.append(count)
+
+        async with TaskService.new(session) as tasks_service:
+            ingested = await tasks_service.ingest_root_folder(
+                task_id, str(tmp_path), batch_size=2, on_progress=on_progress
+            )
+
+        assert ingested == 5  # noqa: PLR2004
+        assert progress == [2, 4, 5]
+        annotations = (
+            (await session.execute(select(Annotation).where(Annotation.task_id == task_id)))
+            .scalars()
+            .all()
+        )
+        assert sorted(anno.filepath for anno in annotations) == sorted(
+            (tmp_path / f"{i}.png").as_posix() for i in range(5)
+        )
+        assert not any(anno.labeled for anno in annotations)
+        async with TaskFileService.new(session) as task_files_service:
+            assert len(await task_files_service.get_paths(task_id)) == 5  # noqa: PLR2004
+        # Recorded as scanned, so the panel does not list the folder again
+        mtime_ns = (
+            await session.execute(select(Task.root_folder_mtime_ns).where(Task.id == task_id))
+        ).scalar_one()
+        assert mtime_ns == tmp_path.stat().st_mtime_ns
+
+    async def test_failed_ingestion_is_not_scanned(
+        self, test_task: TestTask, session: AsyncSession, tmp_path: Path
+    ):
+        """A task whose ingestion failed is rescanned, which catalogs the rest of its folder"""
+        task_id = UUID(test_task["id"])
+        await session.execute(
+            update(Task)
+            .where(Task.id == task_id)
+            .values(root_folder=str(tmp_path), root_folder_mtime_ns=None)
+        )
+        await session.commit()
+        for i in range(4):
+            (tmp_path / f"{i}.png").write_bytes(b"image")
+
+        async def fail(count: int) -> None:
+            raise OSError("Root folder went away")
+
+        async with TaskService.new(session) as tasks_service:
+            with pytest.raises(OSError, match="went away"):
+                await tasks_service.ingest_root_folder(
+                    task_id, str(tmp_path), batch_size=2, on_progress=fail
+                )
+        mtime_ns = (
+            await session.execute(select(Task.root_folder_mtime_ns).where(Task.id == task_id))
+        ).scalar_one()
+        assert mtime_ns is None
+
+        async with TaskFileService.new(session) as task_files_service:
+            await task_files_service.refresh_catalogs([task_id], unscanned_only=True)
+            assert len(await task_files_service.get_paths(task_id)) == 4  # noqa: PLR2004
+
+    async def test_ingest_root_folder_after_rescan(
+        self, test_task: TestTask, session: AsyncSession, tmp_path: Path
+    ):
+        """Files a rescan catalogued before ingestion reached them get exactly one annotation"""
+        task_id = UUID(test_task["id"])
+        await session.execute(delete(Annotation).where(Annotation.task_id == task_id))
+        for i in range(2):
+            (tmp_path / f"{i}.png").write_bytes(b"image")
+        async with TaskFileService.new(session) as task_files_service:
+            await task_files_service.refresh_catalog(task_id, str(tmp_path))
+        for i in range(2, 5):
+            (tmp_path / f"{i}.png").write_bytes(b"image")
+
+        async with TaskService.new(session) as tasks_service:
+            await tasks_service.ingest_root_folder(task_id, str(tmp_path), batch_size=2)
+
+        filepaths = (
+            (
+                await session.execute(
+                    select(Annotation.filepath).where(Annotation.task_id == task_id)
+                )
+            )
+            .scalars()
+            .all()
+        )
+        assert sorted(filepaths) == sorted((tmp_path / f"{i}.png").as_posix() for i in range(5))
+
+    async def test_incremental_refresh(
+        self, test_task: TestTask, session: AsyncSession, tmp_path: Path
+    ):
+        task_id = UUID(test_task["id"])
+        await session.execute(
+            update(Task).where(Task.id == task_id).values(root_folder=str(tmp_path))
+        )
+        for name in ("a.png", "b.png", "notes.txt"):
+            (tmp_path / name).write_bytes(b"image")
+
+        async with TaskFileService.new(session) as task_files_service:
+            assert await task_files_service.refresh_catalog(task_id, str(tmp_path))
+            paths = await task_files_service.get_paths(task_id)
+            assert paths == [(tmp_path / name).as_posix() for name in ("a.png", "b.png")]
+
+            # An unchanged folder is not listed again
+            mtime_ns = tmp_path.stat().st_mtime_ns
+            assert not await task_files_service.refresh_catalog(task_id, str(tmp_path), mtime_ns)
+
+            (tmp_path / "a.png").unlink()
+            (tmp_path / "c.png").write_bytes(b"image")
+            os.utime(tmp_path, ns=(mtime_ns + 1, mtime_ns + 1))
+            await task_files_service.refresh_catalogs([task_id])
+            paths = await task_files_service.get_paths(task_id)
+            assert paths == [(tmp_path / name).as_posix() for name in ("b.png", "c.png")]
+
+    async def test_files_by_task(self, test_task: TestTask, session: AsyncSession):
+        task_id = UUID(test_task["id"])
+        async with TaskFileService.new(session) as task_files_service:
+            await task_files_service.refresh_catalogs([task_id])
+            files = (await task_files_service.get_files_by_task([task_id]))[task_id]
+
+        stmt = select(Annotation.filepath).where(Annotation.task_id == task_id)
+        selected = (await session.execute(stmt)).scalars().all()
+        assert [f["path"] for f in files if f["is_selected"]] == sorted(selected)
+        assert len(files) == len(list(Path(test_task["root_folder"]).iterdir()))
+
+    async def test_symlinked_files_resolved(self, tmp_path: Path):
+        images = tmp_path / "images"
+        images.mkdir()
+        (images / "a.png").write_bytes(b"")
+        (tmp_path / "b.png").write_bytes(b"")
+        (images / "b.png").symlink_to(tmp_path / "b.png")
+
+        paths = scan_image_folder(images.resolve())
+        assert sorted(paths) == sorted(
+            [(images / "a.png").resolve().as_posix(), (tmp_path / "b.png").resolve().as_posix()]
+        )
+
+
+class TestTaskExport:
+    async def test_streamed_export(
+        self,
+        client: AsyncTestClient[Litestar],
+        test_user: dict[str, str | int | float],
+        test_task: TestTask,
+        session: AsyncSession,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        monkeypatch.setattr(exports.settings.app, "EXPORT_BATCH_SIZE", 2)
+        task_id = UUID(test_task["id"])
+        await session.execute(
+            update(Annotation)
+            .where(Annotation.task_id == task_id, Annotation.id.in_([1, 2, 3]))
+            .values(label="pancreas", labeled=True)
+        )
+        await session.execute(
+            update(Annotation)
+            .where(Annotation.task_id == task_id, Annotation.id == 2)
+            .values(labeled_by=UUID(str(test_user["id"])))
+        )
+        await session.commit()
+
+        response = await client.get(urls.EXPORT_TASK, params={"task_id": test_task["id"]})
+        assert response.status_code == HTTP_200_OK
+        assert "_annotations.json" in response.headers["content-disposition"]
+
+        exported = json.loads(response.text)
+        assert [record["annotation_id"] for record in exported] == [1, 2, 3]
+        assert [record["labeled_by"] for record in exported] == [
+            "Unknown",
+            test_user["username"],
+            "Unknown",
+        ]
+        assert all(record["task_id"] == test_task["id"] for record in exported)
+
+    async def test_compact_formats(
+        self, client: AsyncTestClient[Litestar], test_task: TestTask, session: AsyncSession
+    ):
+        await session.execute(
+            update(Annotation)
+            .where(Annotation.task_id == UUID(test_task["id"]), Annotation.id.in_([1, 2]))
+            .values(label="pancreas", labeled=True)
+        )
+        await session.commit()
+        params = {"task_id": test_task["id"]}
+
+        response = await client.get(urls.EXPORT_TASK, params={**params, "format": "jsonl"})
+        assert response.headers["content-type"].startswith("application/jsonl")
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [line["annotation_id"] for line in lines] == [1, 2]
+        assert lines[0]["labeled_by"] == "Unknown"
+
+        response = await client.get(
+            urls.EXPORT_TASK, params={**params, "format": "csv", "compress": "gzip"}
+        )
+        assert "_annotations.csv.gz" in response.headers["content-disposition"]
+        rows = list(csv.DictReader(gzip.decompress(response.content).decode().splitlines()))
+        assert [row["annotation_id"] for row in rows] == ["1", "2"]
+        assert rows[0]["task_id"] == test_task["id"]
+        assert rows[0]["label"] == "pancreas"
+
+        response = await client.get(urls.EXPORT_TASK, params={**params, "format": "xml"})
+        assert response.status_code == HTTP_400_BAD_REQUEST
+
+    async def test_delta_export(
+        self,
+        client: AsyncTestClient[Litestar],
+        test_task: TestTask,
+        test_user: dict[str, str | int | float],
+        session: AsyncSession,
+    ):
+        task_id = UUID(test_task["id"])
+        now = datetime.now(UTC)
+
+        async def label(ids: list[int], updated_at: datetime, label: str = "pancreas") -> None:
+            await session.execute(
+                update(Annotation)
+                .where(Annotation.task_id == task_id, Annotation.id.in_(ids))
+                .values(label=label, labeled=True, updated_at=updated_at)
+            )
+            await session.commit()
+
+        async def export(since: str | None = None) -> tuple[list[int], str]:
+            params = {"task_id": test_task["id"], "format": "jsonl"}
+            if since is not None:
+                params["since"] = since
+            response = await client.get(urls.EXPORT_TASK, params=params)
+            records = [json.loads(line) for line in response.text.splitlines()]
+            labels.update({record["annotation_id"]: record["label"] for record in records})
+            ids = [record["annotation_id"] for record in records]
+            return ids, response.headers["x-export-cursor"]
+
+        labels: dict[int, str | None] = {}
+
+        await label([1, 2, 3], now - timedelta(minutes=2))
+        ids, cursor = await export()
+        assert ids == [1, 2, 3]
+
+        await label([5, 4], now - timedelta(minutes=1))
+        await label([2], now - timedelta(seconds=30), label="liver")  # relabeled
+        await label([6], now)  # too recent, left to the next sync
+        ids, cursor = await export(since=cursor)
+        assert ids == [4, 5, 2]
+
+        ids, next_cursor = await export(since=cursor)
+        assert ids == []
+        assert next_cursor == cursor
+
+        await session.execute(
+            update(Annotation)
+            .where(Annotation.task_id == task_id, Annotation.id == 3)
+            .values(
+                labeled=False,
+                labeled_by=UUID(str(test_user["id"])),
+                updated_at=now - timedelta(seconds=20),
+            )
+        )
+        await session.commit()
+        ids, cursor = await export(since=cursor)
+        assert ids == [3]
+        assert labels == {1: "pancreas", 2: "liver", 3: None, 4: "pancreas", 5: "pancreas"}
+        ids, _ = await export()
+        assert ids == [1, 2, 4, 5, 6]
+
+        response = await client.get(
+            urls.EXPORT_TASK, params={"task_id": test_task["id"], "since": "not a cursor"}
+        )
+        assert response.status_code == HTTP_400_BAD_REQUEST
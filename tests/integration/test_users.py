@@ -6,14 +6,20 @@ from uuid import UUID
 import pytest
 from app.domain import urls
 from app.domain.constants import DEFAULT_KEYBINDS_IN_ORDER
-from app.domain.schema import User
+from app.domain.schema import Task, User
 from app.domain.services import TaskService, UserService
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from litestar import Litestar
-from litestar.status_codes import HTTP_200_OK, HTTP_201_CREATED, HTTP_401_UNAUTHORIZED
+from litestar.status_codes import (
+    HTTP_200_OK,
+    HTTP_201_CREATED,
+    HTTP_401_UNAUTHORIZED,
+    HTTP_403_FORBIDDEN,
+)
 from litestar.testing import AsyncTestClient
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import selectinload
 
 pytestmark = pytest.mark.anyio
 
@@ -102,10 +108,14 @@ async def test_assign_user_task(
         urls.ASSIGN_TASK, json={"tasks_to_add_ids": [_id for _id in snt_ids]}
     )
 
-    async with TaskService.new(sessionmaker()) as tasks_service:
+    async with TaskService.new(
+        sessionmaker(), load=[selectinload(Task.label_keybinds)]
+    ) as tasks_service:
         updated_tasks = await tasks_service.get_many_by_id([_id for _id in snt_ids])
 
-    async with UserService.new(sessionmaker()) as users_service:
+    async with UserService.new(
+        sessionmaker(), load=[selectinload(User.label_keybinds)]
+    ) as users_service:
         updated_user = await users_service.get_one(id=UUID(test_user["id"]))  # type: ignore
 
     for updated_task in updated_tasks:
@@ -143,21 +153,30 @@ async def test_unassign_user_from_task(
     - ^^ ensures that keybinds are there again if the task is reassigned
     """
     # Ideally would not have to do act-arrange-assert but need to in order to view database updates
-    async with UserService.new(sessionmaker()) as users_service:
+    async with UserService.new(
+        sessionmaker(), load=[selectinload(User.label_keybinds)]
+    ) as users_service:
         old_user = await users_service.get_one(id=test_user["id"])  # type: ignore
         old_user_lks = [str(lk.id) for lk in old_user.label_keybinds]
 
-    async with TaskService.new(sessionmaker()) as tasks_service:
+    async with TaskService.new(
+        sessionmaker(), load=[selectinload(Task.label_keybinds)]
+    ) as tasks_service:
         old_task = await tasks_service.get_one(id=test_task["id"])
         old_task_lks = [str(lk.id) for lk in old_task.label_keybinds]
 
     response = await client.delete(urls.UNASSIGN_TASK, params={"task_id": test_task["id"]})
 
-    async with UserService.new(sessionmaker()) as users_service:
+    async with UserService.new(
+        sessionmaker(),
+        load=[selectinload(User.label_keybinds), selectinload(User.assigned_tasks)],
+    ) as users_service:
         user = await users_service.get_one(id=test_user["id"])  # type: ignore
         user_lks = [str(lk.id) for lk in user.label_keybinds]
 
-    async with TaskService.new(sessionmaker()) as tasks_service:
+    async with TaskService.new(
+        sessionmaker(), load=[selectinload(Task.label_keybinds)]
+    ) as tasks_service:
         task = await tasks_service.get_one(id=test_task["id"])
         task_lks = [str(lk.id) for lk in task.label_keybinds]
 
@@ -165,3 +184,33 @@ async def test_unassign_user_from_task(
     assert old_user_lks == user_lks
     assert old_task_lks == task_lks
     assert response.status_code == HTTP_200_OK
+
+
+async def test_identity_cache_invalidated_on_assign(
+    client: AsyncTestClient[Litestar],
+    test_task: dict[str, str | int | float],
+    sessionmaker: async_sessionmaker[AsyncSession],
+):
+    """Labeling checks the cached identity, which must pick up a task assigned since"""
+    async with TaskService.new(
+        sessionmaker(), load=[selectinload(Task.annotations)]
+    ) as tasks_service:
+        temp = await tasks_service.get_all_tasks()
+        other_task = [task for task in temp if task.id != UUID(test_task["id"])][0]  # type: ignore
+    annotation_id = other_task.annotations[0].id
+    params = {"task_id": str(other_task.id), "annotation_id": annotation_id}
+
+    response = await client.patch(urls.UPDATE_ANNOTATION, params=params, json={"label": "humerus"})
+    assert response.status_code == HTTP_403_FORBIDDEN
+
+    response = await client.post(urls.ASSIGN_TASK, json={"tasks_to_add_ids": [str(other_task.id)]})
+    assert response.status_code == HTTP_200_OK
+
+    response = await client.patch(urls.UPDATE_ANNOTATION, params=params, json={"label": "humerus"})
+    assert response.status_code == HTTP_200_OK
+
+    response = await client.delete(urls.UNASSIGN_TASK, params={"task_id": str(other_task.id)})
+    assert response.status_code == HTTP_200_OK
+
+    response = await client.patch(urls.UPDATE_ANNOTATION, params=params, json={"label": "humerus"})
+    assert response.status_code == HTTP_403_FORBIDDEN
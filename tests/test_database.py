@@ -0,0 +1,115 @@
+from collections.abc import AsyncIterator
+from pathlib import Path
+
+import pytest
+from advanced_alchemy.extensions.litestar import SQLAlchemyPlugin
+from litestar import get, post
+from litestar.status_codes import HTTP_200_OK, HTTP_201_CREATED
+from litestar.testing import create_async_test_client
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.config.base import ENGINE_PROFILE_SQLITE_WAL, DatabaseSettings
+from app.config.plugin_config import ReadWriteSQLAlchemyConfig
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(name="db_settings")
+def fx_db_settings(tmp_path: Path) -> DatabaseSettings:
+    return DatabaseSettings(
+        URL=f"sqlite+aiosqlite:///{tmp_path / 'test.db'}",
+        PROFILE=ENGINE_PROFILE_SQLITE_WAL,
+        SQLITE_BUSY_TIMEOUT_MS=1234,
+    )
+
+
+@pytest.fixture(name="engines")
+async def fx_engines(
+    db_settings: DatabaseSettings,
+) -> AsyncIterator[tuple[AsyncEngine, AsyncEngine]]:
+    write_engine, read_engine = db_settings.get_engine(), db_settings.get_read_engine()
+    assert read_engine is not None
+    yield write_engine, read_engine
+    await write_engine.dispose()
+    await read_engine.dispose()
+
+
+async def get_pragma(engine: AsyncEngine, name: str) -> str | int:
+    async with engine.connect() as conn:
+        return (await conn.execute(text(f"PRAGMA {name}"))).scalar_one()
+
+
+async def test_sqlite_wal_profile(engines: tuple[AsyncEngine, AsyncEngine]) -> None:
+    write_engine, read_engine = engines
+    for engine in engines:
+        assert await get_pragma(engine, "journal_mode") == "wal"
+        assert await get_pragma(engine, "synchronous") == 1  # NORMAL
+        assert await get_pragma(engine, "busy_timeout") == 1234  # noqa: PLR2004
+    assert write_engine.pool.size() == 1  # type: ignore[attr-defined]
+
+    async with write_engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE t (x INTEGER)"))
+    async with read_engine.connect() as conn:
+        with pytest.raises(OperationalError, match="readonly"):
+            await conn.execute(text("INSERT INTO t VALUES (1)"))
+
+
+async def test_engine_profile_validation(db_settings: DatabaseSettings) -> None:
+    assert DatabaseSettings(URL=db_settings.URL).get_read_engine() is None
+
+    with pytest.raises(ValueError, match="Unknown"):
+        DatabaseSettings(URL=db_settings.URL, PROFILE="fast").get_engine()
+    with pytest.raises(ValueError, match="requires a SQLite database file"):
+        DatabaseSettings(
+            URL="sqlite+aiosqlite:///:memory:", PROFILE=ENGINE_PROFILE_SQLITE_WAL
+        ).get_engine()
+
+
+async def test_read_only_handlers_use_read_engine(
+    engines: tuple[AsyncEngine, AsyncEngine],
+) -> None:
+    async def is_query_only(db_session: AsyncSession) -> bool:
+        return bool((await db_session.execute(text("PRAGMA query_only"))).scalar_one())
+
+    @get("/read")
+    async def read(db_session: AsyncSession) -> bool:
+        return await is_query_only(db_session)
+
+    @get("/claim", uses_writer=True)
+    async def claim(db_session: AsyncSession) -> bool:
+        return await is_query_only(db_session)
+
+    @post("/write")
+    async def write(db_session: AsyncSession) -> bool:
+        return await is_query_only(db_session)
+
+    write_engine, read_engine = engines
+    config = ReadWriteSQLAlchemyConfig(
+        engine_instance=write_engine, read_engine_instance=read_engine
+    )
+    async with create_async_test_client(
+        route_handlers=[read, claim, write], plugins=[SQLAlchemyPlugin(config)]
+    ) as client:
+        response = await client.get("/read")
+        assert (response.status_code, response.json()) == (HTTP_200_OK, True)
+        response = await client.get("/claim")
+        assert (response.status_code, response.json()) == (HTTP_200_OK, False)
+        response = await client.post("/write")
+        assert (response.status_code, response.json()) == (HTTP_201_CREATED, False)
+
+
+async def test_postgresql_pool_options() -> None:
+    db_settings = DatabaseSettings(
+        URL="postgresql+asyncpg://app@localhost/annotations",
+        POOL_SIZE=3,
+        MAX_OVERFLOW=2,
+        POOL_PRE_PING=True,
+    )
+    engine = db_settings.get_engine()  # connects lazily, no server is needed
+    assert engine.pool.size() == 3  # type: ignore[attr-defined]  # noqa: PLR2004
+    assert engine.pool._max_overflow == 2  # type: ignore[attr-defined]  # noqa: PLR2004
+    assert engine.pool._pre_ping is True
+    assert db_settings.get_read_engine() is None  # writers are not serialized
+    await engine.dispose()
@@ -0,0 +1,74 @@
+import pytest
+from fixture_options import TestTask
+from litestar import Litestar
+from litestar.status_codes import HTTP_200_OK
+from litestar.testing import AsyncTestClient
+
+from app.domain import urls
+from app.domain.metrics import Histogram, Metrics, RequestStats, format_labels, metrics
+
+pytestmark = pytest.mark.anyio
+
+
+def get_sample(text: str, name: str, **labels: str) -> float:
+    """Value of a sample in a text exposition, the first one if several have these labels."""
+    for line in text.splitlines():
+        sample, _, value = line.rpartition(" ")
+        if sample.partition("{")[0] == name and all(
+            f'{label}="{v}"' in sample for label, v in labels.items()
+        ):
+            return float(value)
+    raise AssertionError(f"No {name} sample with labels {labels}")
+
+
+async def test_histogram() -> None:
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+
+    assert list(histogram.samples('route="/"')) == [
+        '_bucket{route="/",le="0.1"} 2',  # upper bounds are inclusive
+        '_bucket{route="/",le="1.0"} 3',
+        '_bucket{route="/",le="+Inf"} 4',
+        '_sum{route="/"} 3.65',
+        '_count{route="/"} 4',
+    ]
+
+
+async def test_render() -> None:
+    registry = Metrics()
+    registry.record("GET", "/a", 200, 0.02, RequestStats(statements=3, db_seconds=0.01))
+    registry.record("GET", "/a", 404, 0.001, RequestStats(statements=1))
+    registry.image_bytes["task"] += 1024
+
+    text = registry.render()
+    assert "# TYPE app_request_duration_seconds histogram" in text
+    assert get_sample(text, "app_requests_total", route="/a", status="404") == 1
+    assert get_sample(text, "app_request_duration_seconds_count", route="/a") == 2  # noqa: PLR2004
+    assert get_sample(text, "app_request_db_statements_sum", route="/a") == 4  # noqa: PLR2004
+    assert get_sample(text, "app_request_db_seconds_total", route="/a") == 0.01  # noqa: PLR2004
+    assert get_sample(text, "app_image_bytes_total", task_id="task") == 1024  # noqa: PLR2004
+    assert text.endswith("\n")
+
+
+async def test_format_labels() -> None:
+    assert format_labels(route='/a"b\\c\n') == 'route="/a\\"b\\\\c\\n"'
+
+
+async def test_get_metrics(client: AsyncTestClient[Litestar], test_task: TestTask) -> None:
+    served = metrics.image_bytes[test_task["id"]]
+    image = await client.get(urls.GET_NEXT_ANNOTATION, params={"task_id": test_task["id"]})
+    assert image.status_code == HTTP_200_OK
+
+    response = await client.get(urls.GET_METRICS)
+    assert response.status_code == HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    route = urls.GET_NEXT_ANNOTATION
+    assert get_sample(text, "app_requests_total", route=route, status="200") >= 1
+    assert get_sample(text, "app_request_db_statements_sum", route=route) > 0
+    assert get_sample(text, "app_request_db_seconds_total", route=route) > 0
+    assert get_sample(text, "app_image_bytes_total", task_id=test_task["id"]) == served + len(
+        image.content
+    )
+    assert get_sample(text, "app_requests_in_flight") == 1  # the metrics request itself
@@ -0,0 +1,84 @@
+from collections import Counter
+from pathlib import Path
+
+import pytest
+from fixture_options import TestTask
+from litestar import get
+from litestar.status_codes import HTTP_200_OK, HTTP_500_INTERNAL_SERVER_ERROR
+from litestar.testing import create_async_test_client
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.config.base import AppSettings
+from app.domain.metrics import MetricsMiddleware, metrics
+from app.domain.queries import QueryBudgetExceededError, QueryMonitor, query_monitor
+from app.domain.schema import Annotation
+from app.domain.services import AnnotationService
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_find_repeated(caplog: pytest.LogCaptureFixture) -> None:
+    monitor = QueryMonitor(AppSettings(QUERY_REPEAT_THRESHOLD=2))
+    statements = Counter({"SELECT a FROM t WHERE id = ?": 3, "SELECT b FROM t": 2})
+
+    assert monitor.find_repeated("/r", statements) == [("SELECT a FROM t WHERE id = ?", 3)]
+    assert "Likely N+1 in /r, executed 3 times: SELECT a FROM t" in caplog.text
+    assert monitor.find_repeated("/r", Counter({"SELECT b FROM t": 2})) == []
+
+
+async def test_check_budget(caplog: pytest.LogCaptureFixture) -> None:
+    monitor = QueryMonitor(AppSettings(QUERY_BUDGET_STRICT=False))
+    monitor.check_budget("/r", None, 100, [])
+    monitor.check_budget("/r", 3, 3, [])
+    monitor.check_statement("/r", 3, 4)
+    assert caplog.text == ""
+
+    monitor.check_budget("/r", 3, 4, [("SELECT a\n  FROM t", 4)])
+    assert "/r executed 4 statements, over its budget of 3, 4 times SELECT a FROM t" in (
+        caplog.text
+    )
+
+    monitor.strict = True
+    monitor.check_statement("/r", 3, 3)
+    with pytest.raises(QueryBudgetExceededError, match="over its budget of 3"):
+        monitor.check_statement("/r", 3, 4)
+
+
+async def test_request_over_budget(engine: AsyncEngine, monkeypatch: pytest.MonkeyPatch) -> None:
+    @get("/within", query_budget=2)
+    async def within() -> None:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    @get("/over", query_budget=2)
+    async def over() -> None:
+        async with engine.connect() as conn:
+            for _ in range(3):  # the same statement, repeated
+                await conn.execute(text("SELECT 1"))
+
+    monkeypatch.setattr(query_monitor, "strict", True)
+    monkeypatch.setattr(query_monitor, "repeat_threshold", 2)
+    async with create_async_test_client(
+        route_handlers=[within, over], middleware=[MetricsMiddleware]
+    ) as client:
+        assert (await client.get("/within")).status_code == HTTP_200_OK
+        # The third statement raises, failing the request
+        assert (await client.get("/over")).status_code == HTTP_500_INTERNAL_SERVER_ERROR
+    assert metrics.repeated_statements["GET", "/over"] == 1
+
+
+async def test_get_prewarm_paths(session: AsyncSession, test_task: TestTask) -> None:
+    stmt = select(Annotation).where(Annotation.task_id == test_task["id"]).order_by(Annotation.id)
+    annotations = list((await session.execute(stmt)).scalars())
+    annotations[1].labeled = True
+    await session.commit()
+
+    async with AnnotationService.new(session=session) as annotations_service:
+        prewarm_paths = await annotations_service.get_prewarm_paths(
+            [test_task["id"], test_task["id"]], 2
+        )
+    thumbnail = (Path(annotations[0].filepath).resolve(), "thumbnail")
+    display = [(Path(a.filepath).resolve(), "display") for a in (annotations[0], annotations[2])]
+    assert prewarm_paths == [thumbnail, *display, thumbnail, *display]
+    assert await annotations_service.get_prewarm_paths([], 2) == []
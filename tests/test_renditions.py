@@ -0,0 +1,217 @@
+from collections.abc import Generator
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pytest
+from PIL import Image
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+from app.config.base import RenditionSettings
+from app.domain.dicom import read_dicom_image
+from app.domain.renditions import (
+    RENDITION_MEDIA_TYPE,
+    ImageTooLargeError,
+    RenditionCache,
+    UndecodableImageError,
+)
+from app.domain.tiles import LEVEL_SUFFIX, Pyramid
+
+pytestmark = pytest.mark.anyio
+
+# Level of the full resolution of a 1000x300 image, level 0 is a single pixel
+SLIDE_MAX_LEVEL = 10
+# Largest per channel difference of a pixel once downscaled and JPEG encoded
+TILE_PIXEL_TOLERANCE = 2
+# White, in 8-bit grayscale, what windowing maps values above the window to
+WHITE = 255
+
+
+@pytest.fixture(name="cache")
+def fx_cache(tmp_path: Path) -> Generator[RenditionCache, None, None]:
+    cache = RenditionCache(
+        RenditionSettings(CACHE_DIR=str(tmp_path / "cache"), WORKERS=1, THUMBNAIL_SIZE=64)
+    )
+    yield cache
+    cache.shutdown()
+
+
+def make_image(path: Path, size: tuple[int, int]) -> Path:
+    Image.linear_gradient("L").resize(size).convert("RGB").save(path)
+    return path
+
+
+async def test_large_image_is_downscaled(cache: RenditionCache, tmp_path: Path):
+    source = make_image(tmp_path / "large.png", (400, 200))
+
+    rendition = await cache.get(source, "thumbnail")
+    assert rendition.media_type == RENDITION_MEDIA_TYPE
+    assert rendition.path.is_relative_to(cache.cache_dir)
+    with Image.open(rendition.path) as image:
+        assert image.size == (64, 32)
+
+    # Served from the cache on the next request
+    assert await cache.get(source, "thumbnail") == rendition
+
+
+async def test_small_image_serves_original(cache: RenditionCache, tmp_path: Path):
+    source = make_image(tmp_path / "small.png", (48, 32))
+
+    rendition = await cache.get(source, "thumbnail")
+    assert rendition.path == source
+    assert rendition.media_type == "image/png"
+    assert await cache.get(source, "thumbnail") == rendition
+
+
+async def test_modified_image_gets_new_rendition(cache: RenditionCache, tmp_path: Path):
+    source = make_image(tmp_path / "image.png", (400, 200))
+    first = await cache.get(source, "thumbnail")
+
+    make_image(source, (200, 400))
+    second = await cache.get(source, "thumbnail")
+    assert second.path != first.path
+    with Image.open(second.path) as image:
+        assert image.size == (32, 64)
+
+
+async def test_least_recently_used_rendition_is_evicted(cache: RenditionCache, tmp_path: Path):
+    sources = [make_image(tmp_path / f"{i}.png", (400, 400)) for i in range(3)]
+    first, second = [await cache.get(source, "thumbnail") for source in sources[:2]]
+    cache.max_bytes = first.path.stat().st_size + second.path.stat().st_size
+
+    await cache.get(sources[0], "thumbnail")  # first is now more recently used than second
+    third = await cache.get(sources[2], "thumbnail")
+    assert first.path.exists()
+    assert not second.path.exists()
+    assert third.path.exists()
+
+
+def make_dicom(path: Path, photometric_interpretation: str = "MONOCHROME2") -> Path:
+    """Write a 400x200 CT slice whose left half is air (-1000 HU) and right half bone (1000 HU)"""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dataset = Dataset()
+    dataset.file_meta = meta
+    dataset.SOPClassUID = CTImageStorage
+    dataset.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    dataset.Rows, dataset.Columns = 200, 400
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = photometric_interpretation
+    dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 16, 12, 11
+    dataset.PixelRepresentation = 0
+    dataset.RescaleIntercept, dataset.RescaleSlope = -1024, 1
+
+    pixels = np.full((200, 400), 24, dtype=np.uint16)
+    pixels[:, 200:] = 2024
+    dataset.PixelData = pixels.tobytes()
+    dataset.save_as(path, enforce_file_format=True)
+    return path
+
+
+async def test_read_dicom_image_applies_window(tmp_path: Path):
+    source = str(make_dicom(tmp_path / "slice.dcm"))
+
+    image = read_dicom_image(source, "soft_tissue")
+    assert image.mode == "L"
+    assert image.size == (400, 200)
+    assert image.getpixel((0, 0)) == 0
+    assert image.getpixel((399, 0)) == WHITE
+
+    image = read_dicom_image(source, "bone")  # 1000 HU is inside the bone window
+    assert 0 < image.getpixel((399, 0)) < WHITE
+
+    inverted = read_dicom_image(str(make_dicom(tmp_path / "inverted.dcm", "MONOCHROME1")))
+    assert inverted.getpixel((0, 0)) == WHITE
+    assert inverted.getpixel((399, 0)) == 0
+
+
+async def test_dicom_is_transcoded_per_window(cache: RenditionCache, tmp_path: Path):
+    source = make_dicom(tmp_path / "slice.dcm")
+
+    soft_tissue = await cache.get(source, "display", "soft_tissue")
+    bone = await cache.get(source, "display", "bone")
+    assert soft_tissue.media_type == RENDITION_MEDIA_TYPE
+    assert soft_tissue.path != bone.path
+    with Image.open(soft_tissue.path) as image:
+        assert image.size == (400, 200)
+
+
+async def test_undecodable_dicom_is_remembered(
+    cache: RenditionCache, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    source = tmp_path / "broken.dcm"
+    source.write_bytes(b"not a DICOM file")
+
+    with pytest.raises(UndecodableImageError):
+        await cache.get(source, "display")
+
+    async def render(*_: Any) -> bool:
+        raise AssertionError("the failure should be served from the cache")
+
+    monkeypatch.setattr(cache, "_render", render)
+    with pytest.raises(UndecodableImageError):
+        await cache.get(source, "display")
+
+
+async def test_pyramid_layout():
+    pyramid = Pyramid(width=1000, height=300, tile_size=254, overlap=1)
+    assert pyramid.max_level == SLIDE_MAX_LEVEL
+    assert pyramid.level_size(SLIDE_MAX_LEVEL) == (1000, 300)
+    assert pyramid.level_size(SLIDE_MAX_LEVEL - 1) == (500, 150)
+    assert pyramid.level_size(0) == (1, 1)
+    assert pyramid.has_tile(SLIDE_MAX_LEVEL, 3, 1)
+    assert not pyramid.has_tile(SLIDE_MAX_LEVEL, 4, 0)
+    assert not pyramid.has_tile(SLIDE_MAX_LEVEL - 1, 0, 1)
+    assert not pyramid.has_tile(SLIDE_MAX_LEVEL + 1, 0, 0)
+    assert 'TileSize="254" Overlap="1"' in pyramid.to_dzi()
+
+
+async def test_tiles_are_cut_from_lazily_built_levels(cache: RenditionCache, tmp_path: Path):
+    source = tmp_path / "slide.png"
+    Image.new("RGB", (1000, 300), (200, 40, 90)).save(source)
+    cache.tile_size, cache.tile_overlap = 254, 1
+
+    pyramid = await cache.get_pyramid(source)
+    assert (pyramid.width, pyramid.height) == (1000, 300)
+
+    middle = await cache.get_tile(source, pyramid, SLIDE_MAX_LEVEL, 1, 0)
+    with Image.open(middle.path) as tile:
+        assert tile.size == (254 + 2, 254 + 1)  # overlap on both sides, top row has none above
+    # The full resolution level is cut into tiles at once and never stored uncompressed
+    assert len(list(middle.path.parent.iterdir())) == 4 * 2
+
+    corner = await cache.get_tile(source, pyramid, SLIDE_MAX_LEVEL - 1, 1, 0)
+    with Image.open(corner.path) as tile:
+        assert tile.size == (500 - 254 + 1, 150)
+        pixel = zip(tile.getpixel((10, 10)), (200, 40, 90), strict=True)
+        assert all(abs(a - b) <= TILE_PIXEL_TOLERANCE for a, b in pixel)
+
+    # Only the levels needed for the requested tiles were built
+    levels = sorted(path.name for path in cache.cache_dir.rglob(f"*{LEVEL_SUFFIX}"))
+    assert levels == [f"{SLIDE_MAX_LEVEL - 1}{LEVEL_SUFFIX}"]
+    assert middle.key != corner.key
+
+
+async def test_pyramid_of_image_past_decompression_bomb_limit(
+    cache: RenditionCache, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    source = tmp_path / "slide.png"
+    Image.new("RGB", (1000, 300)).save(source)
+    max_image_pixels = 1000  # the 1000x300 image is a decompression bomb past this limit
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", max_image_pixels)
+
+    pyramid = await cache.get_pyramid(source)
+    assert (pyramid.width, pyramid.height) == (1000, 300)
+    assert Image.MAX_IMAGE_PIXELS == max_image_pixels  # restored for renditions
+
+
+async def test_pyramid_of_image_past_size_limit(cache: RenditionCache, tmp_path: Path):
+    source = make_image(tmp_path / "slide.png", (1000, 300))
+    cache.max_pyramid_pixels = 1000 * 300 - 1
+
+    with pytest.raises(ImageTooLargeError):
+        await cache.get_pyramid(source)
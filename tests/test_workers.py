@@ -0,0 +1,112 @@
+from pathlib import Path
+from uuid import UUID
+
+import pytest
+from litestar.exceptions import ImproperlyConfiguredException
+from sqlalchemy import text, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.config.base import (
+    ENGINE_PROFILE_SQLITE_WAL,
+    AppSettings,
+    DatabaseSettings,
+    JournalSettings,
+    ServerSettings,
+    Settings,
+)
+from app.domain.identity import IdentityCache
+from app.domain.schema import User
+from app.domain.workers import FileLock, SharedCounter, WorkerCoordinator
+
+pytestmark = pytest.mark.anyio
+
+
+def make_coordinator(run_dir: Path) -> WorkerCoordinator:
+    return WorkerCoordinator(ServerSettings(WORKERS=2, RUN_DIR=str(run_dir)))
+
+
+async def test_file_lock(tmp_path: Path) -> None:
+    lock, other = FileLock(tmp_path / "a.lock", timeout=0.05), FileLock(tmp_path / "a.lock")
+    await lock.acquire()
+    assert not other.try_acquire()
+    with pytest.raises(TimeoutError):
+        await FileLock(tmp_path / "a.lock", timeout=0.05).acquire()
+
+    lock.release()
+    lock.release()  # a no-op once released
+    assert other.try_acquire()
+
+
+async def test_shared_counter(tmp_path: Path) -> None:
+    counter, other = (SharedCounter(tmp_path / "a.generation") for _ in range(2))
+    assert counter.value == 0
+    assert counter.increment() == 1
+    assert other.increment() == 2  # noqa: PLR2004
+    assert counter.value == 2  # noqa: PLR2004
+
+
+async def test_leader_takeover(tmp_path: Path) -> None:
+    leader, follower = make_coordinator(tmp_path), make_coordinator(tmp_path)
+    assert leader.is_leader()
+    assert not follower.is_leader()
+    assert leader.is_leader()
+
+    leader.leader_lock.release()  # as when the leader exits
+    assert follower.is_leader()
+    assert not leader.is_leader()
+    assert WorkerCoordinator(ServerSettings(WORKERS=1)).is_leader()
+
+
+async def test_identity_invalidated_across_workers(
+    engine: AsyncEngine, test_user: dict[str, str | int | float], tmp_path: Path
+) -> None:
+    cache, other = (
+        IdentityCache(AppSettings(), make_coordinator(tmp_path).get_counter("identity"))
+        for _ in range(2)
+    )
+    user_id = UUID(str(test_user["id"]))
+    user = await other.get(engine, user_id)
+    assert user is not None
+
+    async with engine.begin() as conn:
+        await conn.execute(update(User).where(User.id == user_id).values(username="renamed"))
+    assert await other.get(engine, user_id) == user  # cached
+
+    cache.invalidate(user_id)
+    user = await other.get(engine, user_id)
+    assert user is not None
+    assert user.username == "renamed"
+
+
+async def test_configuration_check(tmp_path: Path) -> None:
+    coordinator = make_coordinator(tmp_path)
+    url = f"sqlite+aiosqlite:///{tmp_path / 'app.db'}"
+    wal = DatabaseSettings(URL=url, PROFILE=ENGINE_PROFILE_SQLITE_WAL)
+    coordinator.check(Settings(db=wal))
+
+    with pytest.raises(ImproperlyConfiguredException, match="sqlite_wal"):
+        coordinator.check(Settings(db=DatabaseSettings(URL=url)))
+    with pytest.raises(ImproperlyConfiguredException, match="LABEL_WRITE_BEHIND"):
+        coordinator.check(Settings(db=wal, journal=JournalSettings(WRITE_BEHIND=True)))
+
+
+async def test_writes_are_serialized(tmp_path: Path) -> None:
+    db_settings = DatabaseSettings(
+        URL=f"sqlite+aiosqlite:///{tmp_path / 'app.db'}", PROFILE=ENGINE_PROFILE_SQLITE_WAL
+    )
+    engines = [db_settings.get_engine(), db_settings.get_engine()]  # as in two workers
+    for engine in engines:
+        make_coordinator(tmp_path).serialize_writes(engine, timeout=0.05)
+
+    async with engines[0].connect() as conn:
+        async with conn.begin():
+            await conn.execute(text("CREATE TABLE t (x INTEGER)"))
+            with pytest.raises(TimeoutError):
+                async with engines[1].begin() as other:
+                    await other.execute(text("INSERT INTO t VALUES (1)"))
+        # Released when the transaction ends, though the connection is still checked out
+        async with engines[1].begin() as other:
+            await other.execute(text("INSERT INTO t VALUES (1)"))
+
+    for engine in engines:
+        await engine.dispose()